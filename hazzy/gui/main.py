@@ -25,25 +25,30 @@
 #   does not exist or is not valid, one window containing one blank screen will
 #   be created for the user to add widgets to.
 
+import sys
 import time
 
-from utilities import logger
+# Start the profiler first, so it can time all the other imports
+from utilities import profiler
+profiler.enable_from_args(sys.argv)
+
+with profiler.span('logger init'):
+    from utilities import logger
 log = logger.get('MAIN')
 
 def log_time(task, times=[time.time(), time.time()]):
     now = time.time()
     log.debug("yellow<Time:> {:.3f} (green<{:+.3f}>) - {}".format(now - times[0], now - times[1], task))
     times[1] = now
+    profiler.mark(task)
 
 log_time("in script")
 
 import os
-import sys
 import datetime
 import linuxcnc, hal
 import traceback
 
-from lxml import etree
 from datetime import datetime
 
 log_time('python imports done')
@@ -87,20 +92,25 @@ log_time('done checking requirements')
 # Import our own modules
 from utilities.constants import Paths
 from utilities import notifications
-from utilities import ini_info
+with profiler.span('ini_info init'):
+    from utilities import ini_info
 from utilities import command
 from utilities import jogging
 from utilities import status
+from utilities import preferences
+from utilities import lazy_import
 
 from widget_factory.dialogs.file_dialog import FileDialog
 
 from widget_chooser import WidgetChooser
-from widget_window import WidgetWindow
 from screen_stack import ScreenStack
 from widget_area import WidgetArea
 from header_bar import HeaderBar
 from about import About
 
+# Only needed to load and save the layout
+etree = lazy_import.lazy_module('lxml.etree')
+
 log_time('module imports done')
 
 
@@ -114,6 +124,9 @@ class Hazzy(Gtk.Application):
         self.settings = Gtk.Settings.get_default()
         self.set_gtk_theme('Adwaita')
 
+        # Set to 1 by a --profile-startup run that fails its checks
+        self.exit_status = 0
+
         log_time('done initializing')
 
     def do_startup(self):
@@ -164,11 +177,32 @@ class Hazzy(Gtk.Application):
     def do_activate(self):
         Gtk.Application.do_activate(self)
 
-        self.load_from_xml()
+        self.deferred_ok = lazy_import.check_deferred()
+
+        with profiler.span('load_from_xml'):
+            self.load_from_xml()
+
+        if profiler.enabled:
+            window = self.get_windows()[0]
+            window.first_draw_id = window.connect_after('draw', self.on_first_draw)
+        elif ini_info.get_prewarm_widgets():
+            GLib.idle_add(self.prewarm_widgets, priority=GLib.PRIORITY_LOW)
 
         GLib.idle_add(log_time, "in main loop")
         log_time("app activate done")
 
+    def on_first_draw(self, window, cr):
+        window.disconnect(window.first_draw_id)
+        profiler.mark('first frame')
+        GLib.idle_add(self.on_startup_profiled)
+
+    def on_startup_profiled(self):
+        profiler.finish()
+        if not self.deferred_ok:
+            self.exit_status = 1
+        self.quit()
+        return False
+
     def do_shutdown(self):
         Gtk.Application.do_shutdown(self)
 
@@ -177,6 +211,7 @@ class Hazzy(Gtk.Application):
         log.info("Total session duration: {}".format(run_time))
 
         self.save_to_xml()
+        preferences.flush()
 
     def on_window_delete_event(self, window, event):
         # If only one window quit hazzy, else just close window.
@@ -354,22 +389,16 @@ class Hazzy(Gtk.Application):
                 screen_title = scr.get('title')
                 screen_obj = window.screen_stack.add_screen(screen_title)
 
-                # Widgets
+                # Widgets, these are only imported and created once their
+                # screen is shown
                 for widget in scr.iter('widget'):
                     package = widget.get('package')
                     props = self.get_properties(widget)
-                    try:
-                        widget_obj = WidgetWindow(package)
-                        widget_obj.overlay.set_visible(False)
-                        window.screen_stack.place_widget(screen_obj,
-                                                        widget_obj,
-                                                        int(props['x']),
-                                                        int(props['y']),
-                                                        int(props['w']),
-                                                        int(props['h']))
-                    except ImportError:
-                        log.error('The package "{}" could not be imported'.format(package))
-                        continue
+                    screen_obj.add_placeholder(package,
+                                               int(props['x']),
+                                               int(props['y']),
+                                               int(props['w']),
+                                               int(props['h']))
 
             if scr is None:
                 # There were no screens, add an initial one
@@ -380,6 +409,17 @@ class Hazzy(Gtk.Application):
             window = self.new_window()
             window.screen_stack.add_screen()
 
+    def prewarm_widgets(self):
+        # Create the widgets on screens that have not been shown yet, one
+        # at a time when there is nothing else to do
+        for window in self.get_windows():
+            for screen in window.screen_stack.get_children():
+                if screen.placeholders:
+                    screen.load_widget(screen.placeholders[0])
+                    return True
+        log_time('prewarm widgets done')
+        return False
+
     def save_to_xml(self):
 
         # Create XML root element & comment
@@ -445,7 +485,8 @@ class Hazzy(Gtk.Application):
 # =========================================================
 
     def new_window(self, begin_editing=False):
-        window = HazzyWindow(self)
+        with profiler.span('build HazzyWindow'):
+            window = HazzyWindow(self)
         window.connect('delete-event', self.on_window_delete_event)
         self.edit_layout_action.set_state(GLib.Variant.new_boolean(begin_editing))
         window.chooser_button.set_visible(begin_editing)
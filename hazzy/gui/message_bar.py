@@ -47,6 +47,7 @@ class MessageBar(Gtk.Revealer):
         self.time_out_id = None
         self.signal_1_id = None
         self.signal_2_id = None
+        self.cancel_callback = None
 
         # Main Bar
         self.bar = Gtk.Box(homogeneous=Gtk.Orientation.HORIZONTAL)
@@ -62,6 +63,12 @@ class MessageBar(Gtk.Revealer):
         self.label.set_line_wrap(True)
         self.bar.pack_start(self.label, False, False, 0)
 
+        # Progress bar
+        self.progress_bar = Gtk.ProgressBar()
+        self.progress_bar.set_valign(Gtk.Align.CENTER)
+        self.progress_bar.set_margin_left(5)
+        self.bar.pack_start(self.progress_bar, True, True, 0)
+
         # Close button
         self.close_button = Gtk.Button()
         close_icon = Gtk.Image.new_from_icon_name('window-close-symbolic',
@@ -76,15 +83,21 @@ class MessageBar(Gtk.Revealer):
         self.button_1 = Gtk.Button(label='Yes')
         self.bar.pack_end(self.button_1, False, False, 0)
 
+        self.cancel_button = Gtk.Button(label='Cancel')
+        self.cancel_button.connect('clicked', self.on_cancel_progress_clicked)
+        self.bar.pack_end(self.cancel_button, False, False, 0)
+
     def close(self, widget=None):
         self.reveal(False)
         # Ether the message timed out or user closed, either way, no timeout
         self.time_out_id = None
+        self.cancel_callback = None
         self.disconnect_signals()
 
     def show_info(self, message='Undefined', timeout=2):
         self.button_1.hide()
         self.button_2.hide()
+        self.hide_progress()
         self.close_button.show()
         self.label.set_text(message)
         self.set_style('blue')
@@ -98,6 +111,7 @@ class MessageBar(Gtk.Revealer):
     def show_warning(self, message='Undefined', timeout=10):
         self.button_1.hide()
         self.button_2.hide()
+        self.hide_progress()
         self.close_button.show()
         self.label.set_text(message)
         self.set_style('yellow')
@@ -107,6 +121,7 @@ class MessageBar(Gtk.Revealer):
     def show_error(self, message='Undefined', timeout=None):
         self.button_1.hide()
         self.button_2.hide()
+        self.hide_progress()
         self.close_button.show()
         self.label.set_text(message)
         self.set_style('red')
@@ -117,6 +132,7 @@ class MessageBar(Gtk.Revealer):
         self.close_button.hide()
         self.button_1.show()
         self.button_2.show()
+        self.hide_progress()
 
         self.label.set_text(message)
         self.set_style('blue')
@@ -133,6 +149,33 @@ class MessageBar(Gtk.Revealer):
                                                     self.on_no_clicked,
                                                     callback, *args, **kwargs)
 
+    def show_progress(self, message='Undefined', fraction=0.0, cancel_callback=None):
+        """Show the progress of a long running task, stays shown until
+        replaced by another message. If `cancel_callback` is given a Cancel
+        button is shown that calls it."""
+        self.button_1.hide()
+        self.button_2.hide()
+        self.close_button.hide()
+        self.label.set_text(message)
+        self.progress_bar.set_fraction(fraction)
+        self.progress_bar.show()
+        self.cancel_callback = cancel_callback
+        self.cancel_button.set_visible(cancel_callback is not None)
+        self.set_style('blue')
+        self.reveal(True)
+        self.set_timout(None)
+
+    def hide_progress(self):
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        self.cancel_callback = None
+
+    def on_cancel_progress_clicked(self, widget):
+        callback = self.cancel_callback
+        self.close()
+        if callback:
+            callback()
+
     def show_confirmation(selfm, message='Undefined'):
         raise NotImplemented
 
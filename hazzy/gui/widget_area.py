@@ -38,6 +38,11 @@ from gi.repository import Gtk
 from gi.repository import Gdk
 
 from widget_window import WidgetWindow
+from widget_window import WidgetPlaceholder
+
+from utilities import profiler
+from utilities import logger
+log = logger.get(__name__)
 
 # Grid size in pixels used for "Snap to Grid"
 GRID_SIZE = 20
@@ -92,6 +97,48 @@ class WidgetArea(Gtk.Fixed):
         self.dx_max = 0
         self.dy_max = 0
 
+        # Widgets that will be created when the screen is first shown
+        self.placeholders = []
+        self.connect('map', self.on_map)
+
+    def add_placeholder(self, package, x, y, w, h):
+        '''Add a widget that is only imported and created once the screen
+        is shown, or when load_widget() is called for it.'''
+        placeholder = WidgetPlaceholder(package)
+        self.put(placeholder, x, y)
+        placeholder.set_size_request(w, h)
+        self.placeholders.append(placeholder)
+        return placeholder
+
+    def on_map(self, widget):
+        self.load_widgets()
+
+    def load_widgets(self):
+        while self.placeholders:
+            self.load_widget(self.placeholders[0])
+
+    def load_widget(self, placeholder):
+        '''Replace `placeholder` with the WidgetWindow it stands in for.'''
+        self.placeholders.remove(placeholder)
+
+        x = self.child_get_property(placeholder, 'x')
+        y = self.child_get_property(placeholder, 'y')
+        size = placeholder.get_size_request()
+
+        try:
+            with profiler.span('build WidgetWindow {}'.format(placeholder.package)):
+                widget_window = WidgetWindow(placeholder.package)
+        except ImportError:
+            log.error('The package "{}" could not be imported'.format(placeholder.package))
+            placeholder.destroy()
+            return None
+
+        widget_window.show_overlay(placeholder.overlay_visible)
+        placeholder.destroy()
+
+        self.put(widget_window, x, y)
+        widget_window.set_size_request(size.width, size.height)
+        return widget_window
 
     def on_drag_data_received(self, widget, drag_context, x, y, data, info, time):
         '''Add widget when receive drag to WidgetArea from the WidgetChooser.'''
@@ -24,8 +24,6 @@
 #   in the hazzy widget dir and in the maichine config directory.
 
 import os
-import sys
-import ast
 
 import gi
 
@@ -34,20 +32,41 @@ gi.require_version('Gdk', '3.0')
 
 from gi.repository import Gtk
 from gi.repository import Gdk
+from gi.repository import GLib
 from gi.repository import GdkPixbuf
 
-# Setup paths
-PYDIR = os.path.abspath(os.path.dirname(__file__))
-HAZZYDIR = os.path.abspath(os.path.join(PYDIR, '../..'))
-WIDGET_DIR = os.path.join(HAZZYDIR, 'hazzy/modules')
-
-WIDGET_DIRS = [WIDGET_DIR, os.environ['CONFIG_DIR']]
-
 from widget_factory import entry_widgets
+from utilities import widget_catalog
 from utilities import logger
 
 # Setup logging
 log = logger.get(__name__)
+
+# Width the widget images are scaled to
+ICON_WIDTH = 200
+
+# Scaled images, shared by the choosers of all the windows
+ICONS = {}
+
+def load_icon(path):
+    '''Returns the image at `path` scaled to ICON_WIDTH, or None if it
+    can't be loaded.'''
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    icon = ICONS.get(path)
+    if icon is not None and icon[0] == mtime:
+        return icon[1]
+    try:
+        image = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, ICON_WIDTH, -1, True)
+    except GLib.Error as e:
+        log.warning('Could not load widget image "{}": {}'.format(path, e.message))
+        return None
+    ICONS[path] = (mtime, image)
+    return image
+
+
 class WidgetChooser(Gtk.Popover):
     def __init__(self, screen_stack):
         Gtk.Popover.__init__(self)
@@ -77,6 +96,16 @@ class WidgetChooser(Gtk.Popover):
         self.add(self.scrolled)
 
         self.image_missing = Gtk.IconTheme.get_default().load_icon('image-missing', 48, 0)
+
+        # Blank images shown until the widget images are scrolled into view
+        self.blank_images = {}
+        self.views = []
+        self.load_icons_id = None
+
+        vadj = self.scrolled.get_vadjustment()
+        vadj.connect('value-changed', self.queue_load_icons)
+        vadj.connect('changed', self.queue_load_icons)
+
         self.get_widgets()
 
         self.connect('notify::visible', self.on_popup)
@@ -87,94 +116,61 @@ class WidgetChooser(Gtk.Popover):
         self.hide()
 
     def get_widgets(self):
-
-        categories = {}
-
-        for widget_dir in WIDGET_DIRS:
-
-            sys.path.append(widget_dir)
-
-            for root, subdirs, files in os.walk(widget_dir):
-
-                # Ignore directories starting with '_'
-                if os.path.split(root)[1].startswith('_'):
-                    continue
-
-                # Ignore non widgets. i.e. dirs with no 'widget.info' file
-                info_file = os.path.join(root, 'widget.info')
-                if not os.path.exists(info_file):
-                    continue
-
-                with open(info_file, 'r') as fh:
-                    lines = fh.readlines()
-
-                info = {}
-                for line in lines:
-                    line = line.strip()
-
-                    # Skip blank or comment lines
-                    if not line or line[0] in ['#', ';']:
-                        continue
-
-                    key, value = line.split(':')
-                    info[key.strip()] = ast.literal_eval(value.strip())
-
-                if info.get('image'):
-                    info['image'] = os.path.join(root, info['image'])
-                else:
-                    info['image'] = os.path.join(root, 'widget.png')
-
-                path = os.path.relpath(root, widget_dir).split('/')
-
-                # Determine package for import, and category name for display
-                if len(path) == 1:
-                    category = info.get('category') or 'Uncategorized'
-                    package = path[0]
-                elif len(path) == 2:
-                    category = info.get('category') or path[0]
-                    package = path[1]
-
-                info['import_str'] = '.'.join(path)
-
-                log.debug("LOADING: {} in {} category".format(package, category))
-
-                if not category in categories.keys():
-                    categories[category] = {}
-
-                categories[category][package] = info
-
-#        import json
-#        print json.dumps(categories, sort_keys=True, indent=4)
-
+        categories = widget_catalog.get_categories()
         self.populate(categories)
 
-
     def populate(self, categories):
 
         for category, packages in sorted(categories.items()):
             expander = Expander(category)
+            expander.revealer.connect('notify::child-revealed', self.queue_load_icons)
             icon_vew = WidgetView()
             expander.add(icon_vew)
             self.box.pack_start(expander, False, False, 0)
+            self.views.append((expander, icon_vew))
 
             count = 0
             for package, info in sorted(packages.items()):
                 name = info.get('name', package)
                 import_str = info['import_str']
-                image_path = info.get('image')
+                image_size = info.get('image_size')
 
-                if os.path.exists(image_path):
-                    image = GdkPixbuf.Pixbuf.new_from_file(image_path)
-                    w, h = image.get_width(), image.get_height()
-                    scale = 200 / float(w)
-                    image = image.scale_simple(w * scale, h * scale, GdkPixbuf.InterpType.BILINEAR)
+                if image_size:
+                    image = self.get_blank_image(*image_size)
+                    icon_vew.add_item(name, image, import_str, info['image'])
                 else:
-                    image = self.image_missing
-
-                icon_vew.add_item(name, image, import_str)
+                    icon_vew.add_item(name, self.image_missing, import_str)
                 count += 1
             expander.set_item_count(count)
 
+    def get_blank_image(self, width, height):
+        height = max(int(height * ICON_WIDTH / float(width or 1)), 1)
+        image = self.blank_images.get(height)
+        if image is None:
+            image = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, ICON_WIDTH, height)
+            image.fill(0)
+            self.blank_images[height] = image
+        return image
+
+    def queue_load_icons(self, *args):
+        if self.load_icons_id is None:
+            self.load_icons_id = GLib.idle_add(self.load_visible_icons)
+
+    def load_visible_icons(self):
+        '''Load the images of the widgets that are scrolled into view.'''
+        self.load_icons_id = None
+        vadj = self.scrolled.get_vadjustment()
+        top = vadj.get_value()
+        bottom = top + vadj.get_page_size()
+        for expander, view in self.views:
+            if not expander.revealer.get_child_revealed():
+                continue
+            coords = view.translate_coordinates(self.box, 0, 0)
+            if coords is None:
+                continue
+            view.load_icons(top - coords[1], bottom - coords[1], self.image_missing)
+        return False
+
     def on_popup(self, widget, data):
         child = self.screen_stack.get_visible_child()
         if child is None:
@@ -241,7 +237,7 @@ class WidgetView(Gtk.IconView):
         self.set_item_width(130)
         self.set_columns(1)
 
-        self.model = Gtk.ListStore(str, GdkPixbuf.Pixbuf, str)
+        self.model = Gtk.ListStore(str, GdkPixbuf.Pixbuf, str, str)
         self.set_model(self.model)
 
         # Enable DnD
@@ -255,8 +251,21 @@ class WidgetView(Gtk.IconView):
 
         self.connect('focus-out-event', self.on_focus_out)
 
-    def add_item(self, name, image, import_str):
-        self.model.append([name, image, import_str])
+    def add_item(self, name, image, import_str, image_path=None):
+        self.model.append([name, image, import_str, image_path])
+
+    def load_icons(self, top, bottom, image_missing):
+        '''Load the images of the items between `top` and `bottom`, in
+        the coordinates of the view.'''
+        for row in self.model:
+            image_path = row[3]
+            if image_path is None:
+                continue
+            found, rect = self.get_cell_rect(row.path, None)
+            if not found or rect.y + rect.height < top or rect.y > bottom:
+                continue
+            row[1] = load_icon(image_path) or image_missing
+            row[3] = None
 
     def on_focus_out(self, widget, event):
         if not self.drag:
@@ -132,6 +132,9 @@ class WidgetWindow(Gtk.EventBox):
     def show_question(self, *args, **kwargs):
         self.message_bar.show_question(*args, **kwargs)
 
+    def show_progress(self, *args, **kwargs):
+        self.message_bar.show_progress(*args, **kwargs)
+
     def on_button_press(self, widget, event):
         # Remove focus when clicking on WidgetWindow
         self.get_toplevel().set_focus(None)
@@ -267,3 +270,22 @@ class WidgetWindow(Gtk.EventBox):
             self.parent.child_resize_end(self)
 
         self.drag_active = False
+
+
+class WidgetPlaceholder(Gtk.EventBox):
+    '''Stands in for a WidgetWindow that has not been created yet, keeping
+    its package and place in the layout until its screen is first shown.'''
+
+    def __init__(self, package):
+        Gtk.EventBox.__init__(self)
+
+        self.package = package
+        self.overlay_visible = False
+
+        self.style_context = self.get_style_context()
+        self.style_context.add_class("WidgetWindow")
+
+        self.show()
+
+    def show_overlay(self, visible):
+        self.overlay_visible = visible
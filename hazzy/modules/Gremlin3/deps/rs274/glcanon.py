@@ -24,6 +24,8 @@ import linuxcnc
 import array
 import gcode
 import os
+
+from utilities import toolpath
 import re
 
 
@@ -83,14 +85,17 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
     lineno = -1
 
     def __init__(self, colors, geometry, is_foam=0):
-        # traverse list - [line number, [start position], [end position], [tlo x, tlo y, tlo z]]
-        self.traverse = [];
+        # tool length offsets used by the segments, see utilities/toolpath.py
+        self.offsets = toolpath.OffsetTable()
+        self.offset_index = self.offsets.get_index((0, 0, 0))
+        # traverse store - [line number, [start position], [end position], [tlo x, tlo y, tlo z]]
+        self.traverse = toolpath.SegmentStore(self.offsets)
         self.traverse_append = self.traverse.append
-        # feed list - [line number, [start position], [end position], feedrate, [tlo x, tlo y, tlo z]]
-        self.feed = [];
+        # feed store - [line number, [start position], [end position], feedrate, [tlo x, tlo y, tlo z]]
+        self.feed = toolpath.SegmentStore(self.offsets, feedrate=True)
         self.feed_append = self.feed.append
-        # arcfeed list - [line number, [start position], [end position], feedrate, [tlo x, tlo y, tlo z]]
-        self.arcfeed = [];
+        # arcfeed store - [line number, [start position], [end position], feedrate, [tlo x, tlo y, tlo z]]
+        self.arcfeed = toolpath.SegmentStore(self.offsets, feedrate=True)
         self.arcfeed_append = self.arcfeed.append
         # dwell list - [line number, color, pos x, pos y, pos z, plane]
         self.dwells = [];
@@ -134,6 +139,10 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         self.notify = 0
         self.notify_message = ""
         self.highlight_line = None
+        self.vertex_buffer = None
+        self.dwell_index = None
+        # True while the program is being parsed in a background thread
+        self.loading = False
 
     def comment(self, arg):
         if arg.startswith("AXIS,"):
@@ -175,7 +184,9 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         self.lineno = self.state.sequence_number
 
     def draw_lines(self, lines, for_selection, j=0, geometry=None):
-        return linuxcnc.draw_lines(geometry or self.geometry, lines, for_selection)
+        # linuxcnc.draw_lines only accepts lists, so pass the segments in chunks
+        for chunk in lines.chunks():
+            linuxcnc.draw_lines(geometry or self.geometry, chunk, for_selection)
 
     def colored_lines(self, color, lines, for_selection, j=0):
         if self.is_foam:
@@ -200,7 +211,7 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         return linuxcnc.draw_dwells(self.geometry, dwells, alpha, for_selection, self.is_lathe())
 
     def calc_extents(self):
-        self.min_extents, self.max_extents, self.min_extents_notool, self.max_extents_notool = gcode.calc_extents(
+        self.min_extents, self.max_extents, self.min_extents_notool, self.max_extents_notool = toolpath.calc_extents(
             self.arcfeed, self.feed, self.traverse)
         if self.is_foam:
             min_z = min(self.foam_z, self.foam_w)
@@ -227,6 +238,7 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         self.uo = uo
         self.vo = vo
         self.wo = wo
+        self.offset_index = self.offsets.get_index((xo, yo, zo))
 
     def set_spindle_rate(self, arg):
         pass
@@ -244,7 +256,7 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         if self.suppress > 0: return
         l = self.rotate_and_translate(x, y, z, a, b, c, u, v, w)
         if not self.first_move:
-            self.traverse_append((self.lineno, self.lo, l, [self.xo, self.yo, self.zo]))
+            self.traverse_append(self.lineno, self.lo, l, 0, self.offset_index)
         self.lo = l
 
     def rigid_tap(self, x, y, z):
@@ -253,9 +265,9 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         l = self.rotate_and_translate(x, y, z, 0, 0, 0, 0, 0, 0)[:3]
         l += [self.lo[3], self.lo[4], self.lo[5],
               self.lo[6], self.lo[7], self.lo[8]]
-        self.feed_append((self.lineno, self.lo, l, self.feedrate, [self.xo, self.yo, self.zo]))
+        self.feed_append(self.lineno, self.lo, l, self.feedrate, self.offset_index)
         #        self.dwells_append((self.lineno, self.colors['dwell'], x + self.offset_x, y + self.offset_y, z + self.offset_z, 0))
-        self.feed_append((self.lineno, l, self.lo, self.feedrate, [self.xo, self.yo, self.zo]))
+        self.feed_append(self.lineno, l, self.lo, self.feedrate, self.offset_index)
 
     def arc_feed(self, *args):
         if self.suppress > 0: return
@@ -271,10 +283,10 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         lo = self.lo
         lineno = self.lineno
         feedrate = self.feedrate
-        to = [self.xo, self.yo, self.zo]
+        offset_index = self.offset_index
         append = self.arcfeed_append
         for l in segs:
-            append((lineno, lo, l, feedrate, to))
+            append(lineno, lo, l, feedrate, offset_index)
             lo = l
         self.lo = lo
 
@@ -282,7 +294,7 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         if self.suppress > 0: return
         self.first_move = False
         l = self.rotate_and_translate(x, y, z, a, b, c, u, v, w)
-        self.feed_append((self.lineno, self.lo, l, self.feedrate, [self.xo, self.yo, self.zo]))
+        self.feed_append(self.lineno, self.lo, l, self.feedrate, self.offset_index)
         self.lo = l
 
     straight_probe = straight_feed
@@ -298,37 +310,55 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
         color = self.colors['dwell']
         self.dwells_append((self.lineno, color, self.lo[0], self.lo[1], self.lo[2], self.state.plane / 10 - 17))
 
+    def build_line_index(self):
+        """Index the segments and dwells by line number, so highlighting a
+        line does not need to search the whole program."""
+        for store in (self.traverse, self.feed, self.arcfeed):
+            store.build_line_index()
+        self.dwell_index = {}
+        for dwell in self.dwells:
+            self.dwell_index.setdefault(dwell[0], []).append(dwell)
+
+    def publish(self, complete=False):
+        """Make the segments parsed so far visible to the GTK thread. Once
+        the parse is complete all the segments are visible."""
+        for store in (self.traverse, self.feed, self.arcfeed):
+            store.publish(complete)
+        if complete:
+            self.loading = False
+
     def highlight(self, lineno, geometry):
+        if self.dwell_index is None:
+            self.build_line_index()
         glLineWidth(3)
         c = self.colors['selected']
         glColor3f(*c)
-        glBegin(GL_LINES)
-        coords = []
-        for line in self.traverse:
-            if line[0] != lineno: continue
-            linuxcnc.line9(geometry, line[1], line[2])
-            coords.append(line[1][:3])
-            coords.append(line[2][:3])
-        for line in self.arcfeed:
-            if line[0] != lineno: continue
-            linuxcnc.line9(geometry, line[1], line[2])
-            coords.append(line[1][:3])
-            coords.append(line[2][:3])
-        for line in self.feed:
-            if line[0] != lineno: continue
-            linuxcnc.line9(geometry, line[1], line[2])
-            coords.append(line[1][:3])
-            coords.append(line[2][:3])
-        glEnd()
-        for line in self.dwells:
-            if line[0] != lineno: continue
+        sums = [0.0, 0.0, 0.0]
+        points = 0
+        # The vertex buffer can only be used if it was built for this geometry
+        buffer = self.vertex_buffer if geometry == self.geometry else None
+        if not buffer:
+            glBegin(GL_LINES)
+        for kind in toolpath.KINDS:
+            store = getattr(self, kind)
+            for first, last in store.line_ranges(lineno):
+                if buffer:
+                    buffer.draw_segments(kind, first, last)
+                else:
+                    for index in xrange(first, last):
+                        start, end = store.position(index)
+                        linuxcnc.line9(geometry, start, end)
+                points += store.add_points(first, last, sums)
+        if not buffer:
+            glEnd()
+        for line in self.dwell_index.get(lineno, ()):
             self.draw_dwells([(line[0], c) + line[2:]], 2, 0)
-            coords.append(line[2:5])
+            for axis in range(3):
+                sums[axis] += line[2 + axis]
+            points += 1
         glLineWidth(1)
-        if coords:
-            x = reduce(lambda x, y: x + y, [c[0] for c in coords]) / len(coords)
-            y = reduce(lambda x, y: x + y, [c[1] for c in coords]) / len(coords)
-            z = reduce(lambda x, y: x + y, [c[2] for c in coords]) / len(coords)
+        if points:
+            x, y, z = [total / points for total in sums]
         else:
             x = (self.min_extents[0] + self.max_extents[0]) / 2
             y = (self.min_extents[1] + self.max_extents[1]) / 2
@@ -356,6 +386,46 @@ class GLCanon(Translated, ArcsToSegmentsMixin):
                              len(self.traverse) + len(self.feed) + len(self.arcfeed))
             glLineWidth(1)
 
+    def draw_buffers(self, no_traverse=True):
+        """Draw the program from vertex buffers. Returns False if they can't
+        be used, in which case the display lists should be used instead."""
+        if self.loading:
+            # A partial program is drawn from display lists, the vertex
+            # buffers are only created once the parse has finished
+            return False
+        if self.vertex_buffer is None:
+            if self.is_foam or not toolpath.available(self.geometry):
+                self.vertex_buffer = False
+            else:
+                try:
+                    self.vertex_buffer = toolpath.Toolpath.from_canon(self)
+                except Exception, detail:
+                    print "Could not create vertex buffers, using display lists:", detail
+                    self.vertex_buffer = False
+        if not self.vertex_buffer:
+            return False
+
+        if not no_traverse:
+            glEnable(GL_LINE_STIPPLE)
+            self.color_with_alpha('traverse')
+            self.vertex_buffer.draw('traverse')
+            glDisable(GL_LINE_STIPPLE)
+        else:
+            self.color_with_alpha('straight_feed')
+            self.vertex_buffer.draw('feed')
+            self.color_with_alpha('arc_feed')
+            self.vertex_buffer.draw('arcfeed')
+
+            glLineWidth(2)
+            self.draw_dwells(self.dwells, self.colors.get('dwell_alpha', 1 / 3.), 0)
+            glLineWidth(1)
+        return True
+
+    def delete_buffers(self):
+        if self.vertex_buffer:
+            self.vertex_buffer.delete()
+        self.vertex_buffer = None
+
 
 def with_context(f):
     def inner(self, *args, **kw):
@@ -441,6 +511,7 @@ class GlCanonDraw(object):
         self.lp = lp
         self.canon = g
         self._dlists = {}
+        self.stale_canons = []
         self.select_buffer_size = 100
         self.cached_tool = -1
         self.initialised = 0
@@ -483,6 +554,10 @@ class GlCanonDraw(object):
         self.initialised = 1
 
     def set_canon(self, canon):
+        # The old canon's vertex buffers are freed on the next redraw,
+        # since the GL context may not be current here
+        if self.canon is not None and self.canon is not canon:
+            self.stale_canons.append(self.canon)
         self.canon = canon
 
     @with_context
@@ -563,7 +638,7 @@ class GlCanonDraw(object):
         self.update_highlight_variable(line)
         highlight = self.dlist('highlight')
         glNewList(highlight, GL_COMPILE)
-        if line is not None and self.canon is not None:
+        if line is not None and self.canon is not None and not self.canon.loading:
             if self.is_foam():
                 glPushMatrix()
                 glTranslatef(0, 0, self.get_foam_z())
@@ -851,6 +926,9 @@ class GlCanonDraw(object):
             self.hershey.plot_string(f, .5)
             glPopMatrix()
 
+    def get_machine_speed(self):
+        return self.stat.current_vel
+
     def to_internal_linear_unit(self, v, unit=None):
         if unit is None:
             unit = self.stat.linear_units
@@ -1090,6 +1168,9 @@ class GlCanonDraw(object):
         s = self.stat
         s.poll()
 
+        while self.stale_canons:
+            self.stale_canons.pop().delete_buffers()
+
         machine_limit_min, machine_limit_max = self.soft_limits()
 
         glDisable(GL_LIGHTING)
@@ -1102,8 +1183,8 @@ class GlCanonDraw(object):
                 glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
             if self.get_show_rapids():
-                glCallList(self.dlist('program_rapids', gen=self.make_main_list))
-            glCallList(self.dlist('program_norapids', gen=self.make_main_list))
+                self.draw_program('program_rapids', False)
+            self.draw_program('program_norapids', True)
             glCallList(self.dlist('highlight'))
 
             if self.get_program_alpha():
@@ -1522,7 +1603,7 @@ class GlCanonDraw(object):
             g92_offset = self.to_internal_units(s.g92_offset)
             tlo_offset = self.to_internal_units(s.tool_offset)
             dtg = self.to_internal_linear_unit(s.distance_to_go)
-            spd = self.to_internal_linear_unit(s.current_vel)
+            spd = self.to_internal_linear_unit(self.get_machine_speed())
 
             if self.get_show_metric():
                 positions = self.from_internal_units(positions, 1)
@@ -1811,6 +1892,12 @@ class GlCanonDraw(object):
         if self.canon: self.canon.draw(1, True)
         glEndList()
 
+    def draw_program(self, name, no_traverse):
+        # Vertex buffers can't be compiled into display lists, so they are drawn directly
+        if self.canon is not None and self.canon.draw_buffers(no_traverse):
+            return
+        glCallList(self.dlist(name, gen=self.make_main_list))
+
     def make_main_list(self, unused=None):
         program = self.dlist('program_norapids')
         rapids = self.dlist('program_rapids')
@@ -1825,16 +1912,28 @@ class GlCanonDraw(object):
     def load_preview(self, f, canon, *args):
         self.set_canon(canon)
         result, seq = gcode.parse(f, canon, *args)
+        self.build_preview(canon, result)
+        self.show_preview(canon)
+        return result, seq
 
+    def build_preview(self, canon, result):
+        """Prepare a parsed program for drawing. This does not touch GL, so
+        it can be called from the thread that parsed the program."""
         if result <= gcode.MIN_ERROR:
-            self.canon.progress.nextphase(1)
+            canon.progress.nextphase(1)
             canon.calc_extents()
-            self.stale_dlist('program_rapids')
-            self.stale_dlist('program_norapids')
-            self.stale_dlist('select_rapids')
-            self.stale_dlist('select_norapids')
-
-        return result, seq
+            canon.build_line_index()
+
+    def show_preview(self, canon):
+        """Draw all of a program built by build_preview()."""
+        canon.publish(complete=True)
+        self.stale_program()
+
+    def stale_program(self):
+        self.stale_dlist('program_rapids')
+        self.stale_dlist('program_norapids')
+        self.stale_dlist('select_rapids')
+        self.stale_dlist('select_norapids')
 
     def from_internal_units(self, pos, unit=None):
         if unit is None:
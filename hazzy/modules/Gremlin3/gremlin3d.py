@@ -50,11 +50,21 @@ from deps.rs274 import interpret
 import linuxcnc
 import gcode
 
+from utilities import status
+from utilities import preview_cache
+from utilities import program_info
+
+# Setup logging
+from utilities import logger
+log = logger.get(__name__)
+
 import re
 import tempfile
 import shutil
 import os
 import sys
+import time
+import threading
 
 import thread
 
@@ -62,7 +72,36 @@ import thread
 class DummyProgress:
     def nextphase(self, unused): pass
 
-    def progress(self): pass
+    def progress(self, count, force=False): pass
+
+
+class PreviewProgress:
+    """Progress of a preview being parsed in a background thread. `callback`
+    is called from the parse thread with the phase and the percent done in
+    that phase, at most every `interval` seconds."""
+
+    def __init__(self, callback, interval=0.1):
+        self.callback = callback
+        self.interval = interval
+        self.phase = 0
+        self.total = 1
+        self.last = 0
+
+    def nextphase(self, total):
+        self.phase += 1
+        self.total = max(total, 1)
+        self.progress(0, force=True)
+
+    def progress(self, count, force=False):
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        self.callback(self.phase, min(count * 100 / self.total, 100))
+
+
+class LoadCancelled(Exception):
+    pass
 
 
 class StatCanon(glcanon.GLCanon, interpret.StatMixin):
@@ -71,6 +110,7 @@ class StatCanon(glcanon.GLCanon, interpret.StatMixin):
         interpret.StatMixin.__init__(self, stat, random)
         self.progress = DummyProgress()
         self.lathe_view_option = lathe_view_option
+        self.aborted = False
 
     def is_lathe(self): return self.lathe_view_option
 
@@ -78,6 +118,15 @@ class StatCanon(glcanon.GLCanon, interpret.StatMixin):
         glcanon.GLCanon.change_tool(self, pocket)
         interpret.StatMixin.change_tool(self, pocket)
 
+    def check_abort(self):
+        if self.aborted:
+            raise LoadCancelled()
+
+    def next_line(self, st):
+        glcanon.GLCanon.next_line(self, st)
+        self.progress.progress(self.lineno)
+        self.check_abort()
+
 
 class Gremlin3D(Gtk.GLArea, glnav3.GlNavBase,
                 glcanon.GlCanonDraw):
@@ -103,17 +152,23 @@ class Gremlin3D(Gtk.GLArea, glnav3.GlNavBase,
                                               get_color('backplotprobing'),
                                               self.get_geometry()
                                               )
-        thread.start_new_thread(self.logger.start, (.01,))
+        # Log the backplot at the same rate the status is sampled at
+        thread.start_new_thread(self.logger.start, (1.0 / status.status.poll_rate,))
 
-        glcanon.GlCanonDraw.__init__(self, linuxcnc.stat(), self.logger)
+        # Read from the shared status snapshots rather than polling NML
+        glcanon.GlCanonDraw.__init__(self, status.StatProxy(), self.logger)
 
         self.current_view = 'z'
 
         self.select_primed = None
 
+        # Canon of the preview being parsed in the background, if any
+        self.loading_canon = None
+
         self.connect_after('realize', self.realize)
         self.connect('configure_event', self.reshape)
         self.connect('map-event', self.map)
+        self.connect('unmap', self.on_unmap)
         self.connect('draw', self.on_draw)
         self.connect('motion-notify-event', self.motion)
         self.connect('button-press-event', self.pressed)
@@ -131,6 +186,11 @@ class Gremlin3D(Gtk.GLArea, glnav3.GlNavBase,
                         Gdk.EventMask.LEAVE_NOTIFY_MASK)
         self.fingerprint = ()
 
+        # Status 'snapshot' handler and pending poll tick callback, only
+        # while mapped
+        self.snapshot_id = None
+        self.poll_tick_id = None
+
         self.lat = 0
         self.minlat = -90
         self.maxlat = 90
@@ -208,25 +268,49 @@ class Gremlin3D(Gtk.GLArea, glnav3.GlNavBase,
         self.logger.clear()
 
     def map(self, *args):
-        GObject.timeout_add(50, self.poll)
+        # Check for changes when the status changes, instead of on a timer
+        if self.snapshot_id is None:
+            self.snapshot_id = status.status.connect('snapshot', self.queue_poll)
+        self.queue_poll()
+
+    def on_unmap(self, *args):
+        if self.snapshot_id is not None:
+            status.status.disconnect(self.snapshot_id)
+            self.snapshot_id = None
+        if self.poll_tick_id is not None:
+            self.remove_tick_callback(self.poll_tick_id)
+            self.poll_tick_id = None
+
+    def queue_poll(self, *args):
+        # Poll at most once per frame, however often the status changes
+        if self.poll_tick_id is None:
+            self.poll_tick_id = self.add_tick_callback(self.on_poll_tick)
+
+    def on_poll_tick(self, widget, frame_clock):
+        # Keep polling each frame while things are changing, so backplot
+        # points logged after the last status change are drawn too
+        if self.poll():
+            return True
+        self.poll_tick_id = None
+        return False
 
     def poll(self):
+        '''Redraw if anything shown has changed, returns True if it has.'''
         s = self.stat
         try:
             s.poll()
         except:
-            return
+            return False
         fingerprint = (self.logger.npts, self.soft_limits(),
                        s.actual_position, s.joint_actual_position,
                        s.homed, s.g5x_offset, s.g92_offset, s.limit, s.tool_in_spindle,
-                       s.motion_mode, s.current_vel)
+                       s.motion_mode, self.get_machine_speed())
 
         if fingerprint != self.fingerprint:
             self.fingerprint = fingerprint
             self.queue_draw()
-
-        # return self.visible
-        return True
+            return True
+        return False
 
     @glcanon.with_context
     def realize(self):
@@ -260,11 +344,22 @@ class Gremlin3D(Gtk.GLArea, glnav3.GlNavBase,
         elif not filename and not s.file:
             return
 
+        # Only the latest file is previewed, stop parsing the previous one
+        if self.loading_canon is not None:
+            self.loading_canon.aborted = True
+            self.loading_canon = None
+
         td = tempfile.mkdtemp()
         self._current_file = filename
         try:
+            # The parse thread reads the machine state from its own proxy
+            stat = status.StatProxy()
+            stat.poll()
             random = int(self.inifile.find("EMCIO", "RANDOM_TOOLCHANGER") or 0)
-            canon = StatCanon(self.colors, self.get_geometry(), self.lathe_option, s, random)
+            canon = StatCanon(self.colors, self.get_geometry(), self.lathe_option, stat, random)
+            canon.progress = PreviewProgress(lambda phase, percent:
+                                             self.parse_progress(canon, phase, percent))
+            canon.loading = True
             parameter = self.inifile.find("RS274NGC", "PARAMETER_FILE")
             temp_parameter = os.path.join(td, os.path.basename(parameter or "linuxcnc.var"))
             if parameter:
@@ -273,14 +368,98 @@ class Gremlin3D(Gtk.GLArea, glnav3.GlNavBase,
 
             unitcode = "G%d" % (20 + (s.linear_units == 1))
             initcode = self.inifile.find("RS274NGC", "RS274NGC_STARTUP_CODE") or ""
-            result, seq = self.load_preview(filename, canon, unitcode, initcode)
-            if result > gcode.MIN_ERROR:
-                self.report_gcode_error(result, seq, filename)
-
+        except Exception:
+            shutil.rmtree(td)
+            raise
+
+        # Show the program while it is parsed, the segments are drawn as
+        # the parse thread publishes them
+        self.set_canon(canon)
+        self.stale_program()
+        self.loading_canon = canon
+
+        parser = threading.Thread(target=self.parse_preview,
+                                  args=(canon, filename, td, unitcode, initcode),
+                                  name='PreviewParser')
+        parser.daemon = True
+        parser.start()
+
+    def parse_preview(self, canon, filename, td, *args):
+        """Parse a program for the preview, runs in a background thread."""
+        try:
+            key = preview_cache.get_key(filename, ('file', canon.parameter_file),
+                                        canon.tools, canon.random, canon.geometry, *args)
+            cached = preview_cache.load(key, canon)
+            if cached is not None:
+                result, seq = cached
+                canon.progress.nextphase(1)
+                canon.build_line_index()
+            else:
+                canon.progress.nextphase(program_info.get_line_count(filename))
+                result, seq = gcode.parse(filename, canon, *args)
+                self.build_preview(canon, result)
+                preview_cache.save(key, canon, result, seq)
+            program_info.update_preview(filename, canon)
+        except LoadCancelled:
+            return
+        except Exception as e:
+            log.exception(e)
+            GObject.idle_add(self.loading_failed, canon, filename, e)
+            return
         finally:
             shutil.rmtree(td)
+        GObject.idle_add(self.loading_finished, canon, result, seq)
+
+    def parse_progress(self, canon, phase, percent):
+        # Called from the parse thread, so publish the segments parsed so
+        # far before the GTK thread draws them
+        canon.publish()
+        GObject.idle_add(self.update_loading, canon, phase, percent)
+
+    @glcanon.with_context
+    def update_loading(self, canon, phase, percent):
+        if canon is not self.loading_canon:
+            return False
+        self.stale_program()
+        self.queue_draw()
+        self.loading_progress(phase, percent)
+        return False
+
+    @glcanon.with_context
+    def loading_finished(self, canon, result, seq):
+        if canon is not self.loading_canon:
+            return False
+        self.loading_canon = None
+        self.show_preview(canon)
+
+        # The highlight can't be drawn until the program has loaded
+        line = self.get_highlight_line()
+        if line is not None:
+            self.update_highlight_variable(None)
+            self.set_highlight_line(line)
 
         self.set_current_view()
+        self.queue_draw()
+        self.loading_progress(canon.progress.phase, 100)
+        if result > gcode.MIN_ERROR:
+            self.report_gcode_error(result, seq, self._current_file)
+        return False
+
+    @glcanon.with_context
+    def loading_failed(self, canon, filename, error):
+        canon.loading = False
+        if canon is not self.loading_canon:
+            return False
+        self.loading_canon = None
+        self.queue_draw()
+        self.loading_progress(canon.progress.phase, 100)
+        self.report_preview_error(filename, error)
+        return False
+
+    def loading_progress(self, phase, percent):
+        """Called on the GTK thread as the preview loads. Phase 1 is parsing
+        the program and phase 2 is building the preview."""
+        pass
 
     def get_program_alpha(self):
         return self.program_alpha
@@ -315,6 +494,13 @@ class Gremlin3D(Gtk.GLArea, glnav3.GlNavBase,
     def get_show_machine_speed(self):
         return self.show_velocity
 
+    def get_machine_speed(self):
+        # Averaged from the position samples, so the readout is steady
+        speed = status.get_velocity()
+        if speed is None:
+            return self.stat.current_vel
+        return speed
+
     def get_show_metric(self):
         return self.metric_units
 
@@ -511,6 +697,10 @@ class Gremlin3D(Gtk.GLArea, glnav3.GlNavBase,
         sys.stderr.write("G-Code error in " + os.path.basename(filename) + "\n" + "Near line "
                          + str(seq) + " of\n" + filename + "\n" + error_str + "\n")
 
+    def report_preview_error(self, filename, error):
+        sys.stderr.write("Could not preview " + os.path.basename(filename) + "\n"
+                         + str(error) + "\n")
+
     # These are for external controlling of the view
 
     def zoom_in(self):
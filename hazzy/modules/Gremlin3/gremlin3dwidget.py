@@ -108,16 +108,18 @@ class Area3D(gremlin3d.Gremlin3D):
         # labelbox.add(self.label)
         # fixed.put(labelbox, 0, self.height - 20)
 
-    #    def fileloading(self, current_line):
-    #        self.progressbar.show()
-    #        percent = current_line * 100 / self.line_count
-    #        if self.percent != percent:
-    #            self.percent = percent
-    #            msg = "Generating preview {}%".format(self.percent)
-    #            self.progressbar.set_text(msg)
-    #            self.progressbar.set_fraction(self.percent / 100)
-    #            log.debug(msg)
-    #            self.emit('loading_progress', percent)
+    def loading_progress(self, phase, percent):
+        if phase == 1:
+            msg = "Parsing G-code {}%".format(percent)
+        else:
+            msg = "Generating preview"
+        self.label.set_text(msg)
+        # Building the preview is reported as the end of parsing
+        if phase == 2 and percent != 100:
+            return
+        if self.percent != percent:
+            self.percent = percent
+            self.emit('loading-progress', percent)
 
     def realize(self, widget):
         gremlin3d.Gremlin3D.realize(widget)
@@ -46,8 +46,6 @@ PYDIR = os.path.abspath(os.path.dirname(__file__))
 # Setup logging
 log = logger.get(__name__)
 
-Gst.init(None)
-
 
 class GstWidget(Gtk.Box):
     title = 'Video'
@@ -178,6 +176,10 @@ class GstWidget(Gtk.Box):
 class Pipeline(object):
 
     def __init__(self):
+        # GStreamer is set up when the first video widget is created, not
+        # when this module is imported
+        if not Gst.is_initialized():
+            Gst.init(None)
         self.pipe = Gst.Pipeline.new()
         self.bus = None
 
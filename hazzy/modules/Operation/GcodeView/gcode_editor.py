@@ -23,7 +23,6 @@
 #   current-line view while a program is running.
 
 # ToDo:
-#   Update the curring line while program is running.
 #   Lots more ...
 
 
@@ -44,6 +43,7 @@ UI = os.path.join(PYDIR, 'ui', 'gcode_view.ui')
 
 # Import our own modules
 from utilities import command
+from utilities import status
 from utilities import logger
 from utilities import ini_info
 from utilities.constants import MessageType
@@ -88,6 +88,9 @@ class GcodeEditor(Gtk.Bin):
 
         self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
 
+        # File selected in the FileChooser, whose line count is shown
+        self.selected_path = None
+
         self.file_chooser = FileChooser(widget_window)
         self.file_chooser.connect('file-activated', self.on_filechooser_file_activated)
         self.file_chooser.connect('selection-changed', self.on_filechooser_selection_changed)
@@ -102,6 +105,8 @@ class GcodeEditor(Gtk.Bin):
         self.gcode_view_page = self.builder.get_object('gcode_view_page')
 
         self.gcode_view = GcodeView()
+        self.gcode_view.connect('loading-progress', self.on_loading_progress)
+        self.gcode_view.connect('file-loaded', self.on_file_loaded)
         self.gcode_buffer = self.gcode_view.get_buffer()
         self.gcode_buffer.connect('mark-set', self.on_mark_set)
         self.gcode_buffer.connect('notify::has-selection', self.on_text_selected)
@@ -117,6 +122,8 @@ class GcodeEditor(Gtk.Bin):
         self.source_map.set_view(self.gcode_view)
         self.map_scrolled.add(self.source_map)
 
+        status.on_changed('stat.motion_line', self.on_motion_line_changed)
+
     def on_mark_set(self, buf, cursor_iter, mark):
         # If this is not the (cursor) "insert" mark, disregard
         if mark != buf.get_insert():
@@ -189,7 +196,7 @@ class GcodeEditor(Gtk.Bin):
         else:
             path = self.gcode_view.current_file
 
-        self.check_modified_and_load_editor(path)
+        self.check_modified_and_load_editor(path, run_view=True)
 
         self.edit_button_box.hide()
         self.gcode_view.set_editable(False)
@@ -203,18 +210,34 @@ class GcodeEditor(Gtk.Bin):
         self.gcode_view.set_editable(True)
         self.check_modified_and_load_editor(path)
 
+    def on_motion_line_changed(self, widget, line):
+        if self.gcode_view.run_view and line > 0:
+            self.gcode_view.follow_line(line)
+
+    def on_loading_progress(self, widget, fraction):
+        self.line_count_label.set_text('{:.0%}'.format(fraction))
+
+    def on_file_loaded(self, widget, path):
+        self.line_count_label.set_text(str(self.gcode_view.get_program_length()))
+
     def on_filechooser_selection_changed(self, widget, path):
         self.widget_window.set_title(path)
         is_file = os.path.isfile(path)
         self.edit_radiobutton.set_sensitive(is_file)
         self.run_radiobutton.set_sensitive(is_file)
 
+        self.selected_path = path
         if is_file:
-            line_count = self.file_chooser.count_lines(path)
-            self.line_count_label.set_text(str(line_count))
+            # Counted in the background if the file has not been indexed
+            self.line_count_label.set_text('')
+            self.file_chooser.count_lines(path, self.on_line_count)
         else:
             self.line_count_label.set_text('0')
 
+    def on_line_count(self, path, line_count):
+        if path == self.selected_path and line_count is not None:
+            self.line_count_label.set_text(str(line_count))
+
 # Helpers
 #============================
 
@@ -227,21 +250,22 @@ class GcodeEditor(Gtk.Bin):
         else:
             return path[0]
 
-    def check_modified_and_load_editor(self, path):
+    def check_modified_and_load_editor(self, path, run_view=False):
         if self.gcode_buffer.get_modified():
             fname = os.path.split(self.gcode_view.current_file)[1]
             msg = '"{}" has been modified, save changes?'.format(fname)
-            self.widget_window.show_question(msg, self.on_save_changes_response, path)
+            self.widget_window.show_question(msg, self.on_save_changes_response,
+                                             path, run_view)
         else:
-            if path != self.gcode_view.current_file:
-                self.gcode_view.load_file(path)
+            if path != self.gcode_view.current_file or run_view != self.gcode_view.run_view:
+                self.gcode_view.load_file(path, run_view)
 
-    def on_save_changes_response(self, response, path):
+    def on_save_changes_response(self, response, path, run_view):
         if response == Gtk.ResponseType.YES:
             self.gcode_view.save()
-            self.gcode_view.load_file(path)
+            self.gcode_view.load_file(path, run_view)
         else:
-            self.gcode_view.load_file(path)
+            self.gcode_view.load_file(path, run_view)
 
     # The GtkSource does not return True after handling a button
     # press, so we have to do so here so the handler in the WidgetWindow
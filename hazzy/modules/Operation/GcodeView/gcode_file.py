@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Memory mapped access to a g-code file, read in chunks that end on line
+#   boundaries, with an index of the byte offset each line starts at.
+#   Used by the GcodeView to load large programs without reading the whole
+#   file into memory at once.
+
+import os
+import mmap
+import array
+
+
+# Bytes read per chunk
+CHUNK_SIZE = 256 * 1024
+
+
+class GcodeFile(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Empty files can't be mapped
+                self.data = ''
+        self.size = len(self.data)
+
+        # Byte offset of the start of each line, the same as the lines in a
+        # GtkTextBuffer there is always one more line than there are newlines
+        self.offsets = array.array('L', [0])
+
+        # Number of bytes indexed so far
+        self.indexed = 0
+
+    @property
+    def complete(self):
+        return self.indexed >= self.size
+
+    @property
+    def progress(self):
+        if not self.size:
+            return 1.0
+        return float(self.indexed) / self.size
+
+    def get_line_count(self):
+        '''Returns the number of lines indexed so far.'''
+        return len(self.offsets)
+
+    def read_chunk(self, size=CHUNK_SIZE):
+        '''Index the next chunk of the file and return its text, or None at
+        the end of the file. Chunks end after a newline, so they never split
+        a line or a multi-byte character.'''
+        start = self.indexed
+        if start >= self.size:
+            return None
+
+        end = min(start + size, self.size)
+        if end < self.size:
+            newline = self.data.rfind('\n', start, end)
+            if newline == -1:
+                # A line longer than the chunk size
+                newline = self.data.find('\n', end)
+            end = self.size if newline == -1 else newline + 1
+
+        find = self.data.find
+        append = self.offsets.append
+        pos = find('\n', start, end)
+        while pos != -1:
+            append(pos + 1)
+            pos = find('\n', pos + 1, end)
+
+        self.indexed = end
+        return self.data[start:end]
+
+    def index_to(self, lnum):
+        '''Index the file at least as far as line `lnum` (zero based).'''
+        while lnum >= len(self.offsets) and not self.complete:
+            self.read_chunk()
+
+    def get_line_offset(self, lnum):
+        '''Returns the byte offset line `lnum` (zero based) starts at.'''
+        self.index_to(lnum)
+        lnum = min(max(lnum, 0), len(self.offsets) - 1)
+        return self.offsets[lnum]
+
+    def get_lines(self, first, last):
+        '''Returns the text of lines `first` up to `last` (zero based).'''
+        start = self.get_line_offset(first)
+        self.index_to(last)
+        if last < len(self.offsets):
+            end = self.offsets[last]
+        else:
+            end = self.size
+        return self.data[start:end]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = ''
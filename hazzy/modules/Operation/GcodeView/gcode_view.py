@@ -32,6 +32,8 @@ gi.require_version('GtkSource', '3.0')
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import Gio
+from gi.repository import GLib
+from gi.repository import GObject
 from gi.repository import Pango
 from gi.repository import GtkSource
 
@@ -40,9 +42,16 @@ PYDIR = os.path.abspath(os.path.dirname(__file__))
 LANGDIR = os.path.join(PYDIR, 'gcode_highlight', "language-specs")
 STYLEDIR = os.path.join(PYDIR, 'gcode_highlight', "styles")
 
+from gcode_file import GcodeFile
+
 from utilities import logger
 log = logger.get(__name__)
 
+# Number of lines shown in the run view, and how close the current line
+# can get to the edge of them before the window is moved
+RUN_VIEW_LINES = 1000
+RUN_VIEW_MARGIN = 100
+
 
 class GcodeMap(GtkSource.Map):
     def __init__(self):
@@ -52,7 +61,32 @@ class GcodeMap(GtkSource.Map):
         self.props.font_desc = Pango.FontDescription('1')
 
 
+class LineNumberRenderer(GtkSource.GutterRendererText):
+    '''Line numbers for the run view, where the buffer only holds a window
+    of the lines in the file, starting at line `offset`.'''
+
+    def __init__(self):
+        GtkSource.GutterRendererText.__init__(self)
+        self.set_alignment(1, 0.5)
+        self.set_padding(4, -1)
+        self.offset = 0
+
+    def set_offset(self, offset, line_count):
+        self.offset = offset
+        width, height = self.measure(str(line_count))
+        self.set_size(width)
+        self.queue_draw()
+
+    def do_query_data(self, start, end, state):
+        self.set_text(str(start.get_line() + self.offset + 1), -1)
+
+
 class GcodeView(GtkSource.View):
+    __gtype_name__ = 'GcodeView'
+    __gsignals__ = {
+        'loading-progress': (GObject.SignalFlags.RUN_FIRST, None, (float,)),
+        'file-loaded': (GObject.SignalFlags.RUN_FIRST, None, (str,)),
+    }
 
     def __init__(self):
         GtkSource.View.__init__(self)
@@ -90,6 +124,26 @@ class GcodeView(GtkSource.View):
         self.current_file = None
         self.error_line = None
 
+        # The line being executed is highlighted once per frame
+        self.follow_target = None
+        self.followed_line = None
+        self.follow_id = None
+
+        # The file being loaded into the buffer, and the idle callback
+        # inserting it a chunk at a time
+        self.gcode_file = None
+        self.load_source = None
+
+        # In the run view the buffer only holds the lines around the
+        # current line, starting at self.window_start
+        self.run_view = False
+        self.window_start = 0
+        self.window_end = 0
+        self.line_renderer = LineNumberRenderer()
+        self.line_renderer.set_visible(False)
+        gutter = self.get_gutter(Gtk.TextWindowType.LEFT)
+        gutter.insert(self.line_renderer, -30)
+
         self.show()
 
     def add_mark_category(self, category, bg_color):
@@ -99,16 +153,86 @@ class GcodeView(GtkSource.View):
         att.set_background(color)
         self.set_mark_attributes(category, att, 1)
 
-    def load_file(self, fn=None):
+    def load_file(self, fn=None, run_view=False):
+        """Load a file into the buffer. The file is inserted in chunks from
+        idle callbacks, so large files do not block the UI. In the run view
+        only a window of lines around the current line is loaded."""
+        self.cancel_load()
         self.current_file = fn
+        self.run_view = run_view
+        self.followed_line = None
+
+        self.set_show_line_numbers(not run_view)
+        self.line_renderer.set_visible(run_view)
+
+        # Highlighting is done once the text is in, and then only as the
+        # text is drawn, rather than again after every chunk
+        self.buf.set_highlight_syntax(False)
         self.buf.begin_not_undoable_action()
+        self.buf.set_text('')
+
         if not fn:
-            self.buf.set_text('')
+            self.on_load_finished()
+            return
+
+        try:
+            self.gcode_file = GcodeFile(fn)
+        except (IOError, OSError) as e:
+            log.error('Could not open "{0}": {1}'.format(fn, e))
+            self.on_load_finished()
+            return
+
+        if run_view:
+            self.window_start = self.window_end = 0
+            self.show_run_window(1)
+            self.on_load_finished()
+            # Index the rest of the file in the background
+            self.load_source = GLib.idle_add(self.index_chunk)
         else:
-            with open(fn, 'r') as f:
-                self.buf.set_text(f.read())
+            self.load_source = GLib.idle_add(self.load_chunk)
+
+    def load_chunk(self):
+        text = self.gcode_file.read_chunk()
+        if text is None:
+            self.load_source = None
+            self.on_load_finished()
+            return False
+        self.buf.insert(self.buf.get_end_iter(), text)
+        self.emit('loading-progress', self.gcode_file.progress)
+        return True
+
+    def index_chunk(self):
+        if self.gcode_file.read_chunk() is None:
+            self.load_source = None
+            self.emit('loading-progress', 1.0)
+            self.emit('file-loaded', self.current_file)
+            return False
+        self.emit('loading-progress', self.gcode_file.progress)
+        return True
+
+    def cancel_load(self):
+        if self.load_source is not None:
+            GLib.source_remove(self.load_source)
+            self.load_source = None
+            if not self.run_view:
+                self.buf.end_not_undoable_action()
+        if self.gcode_file is not None:
+            self.gcode_file.close()
+            self.gcode_file = None
+
+    def is_loading(self):
+        return self.load_source is not None and not self.run_view
+
+    def on_load_finished(self):
         self.buf.end_not_undoable_action()
         self.buf.set_modified(False)
+        self.buf.place_cursor(self.buf.get_start_iter())
+        self.buf.set_highlight_syntax(True)
+
+        if not self.run_view and self.gcode_file is not None:
+            # The whole file is in the buffer now
+            self.gcode_file.close()
+            self.gcode_file = None
 
         if self.error_line:
             self.highlight_line(self.error_line, 'error')
@@ -116,6 +240,41 @@ class GcodeView(GtkSource.View):
         else:
             self.highlight_line(None)
 
+        # The run view is loaded once the whole file has been indexed
+        if not self.run_view or self.gcode_file is None:
+            self.emit('loading-progress', 1.0)
+            self.emit('file-loaded', self.current_file or '')
+
+    def show_run_window(self, lnum):
+        """Make sure line `lnum` is in the run view window, moving the
+        window if needed. Returns the line's number in the buffer."""
+        if self.gcode_file is None:
+            return lnum
+        line = lnum - 1
+        first = self.window_start
+        last = self.window_end
+        at_start = first == 0
+        at_end = self.gcode_file.complete and last >= self.gcode_file.get_line_count()
+        if (first == last
+                or not (at_start or line >= first + RUN_VIEW_MARGIN)
+                or not (at_end or line < last - RUN_VIEW_MARGIN)):
+            first = max(line - RUN_VIEW_LINES / 2, 0)
+            last = first + RUN_VIEW_LINES
+            text = self.gcode_file.get_lines(first, last)
+            if last < self.gcode_file.get_line_count():
+                # Drop the newline, it would add an empty line to the buffer
+                text = text[:-1]
+            else:
+                last = self.gcode_file.get_line_count()
+            self.buf.begin_not_undoable_action()
+            self.buf.set_text(text)
+            self.buf.end_not_undoable_action()
+            self.buf.set_modified(False)
+            self.window_start = first
+            self.window_end = last
+            self.line_renderer.set_offset(first, self.gcode_file.get_line_count())
+        return lnum - self.window_start
+
     def highlight_line(self, lnum=None, style=None):
         style = style or 'none' # Must be a string
         if not lnum or lnum == -1:
@@ -123,6 +282,9 @@ class GcodeView(GtkSource.View):
                 self.buf.delete_mark(self.mark)
                 self.mark = None
             return
+        window_start = self.window_start
+        if self.run_view:
+            lnum = self.show_run_window(lnum)
         iter = self.buf.get_iter_at_line(lnum-1)
         if not self.mark:
             self.mark = self.buf.create_source_mark(style, style, iter)
@@ -131,7 +293,29 @@ class GcodeView(GtkSource.View):
             self.mark = self.buf.create_source_mark(style, style, iter)
         else:
             self.buf.move_mark(self.mark, iter)
-        self.scroll_to_mark(self.mark, 0, True, 0, 0.5)
+
+        # Only scroll if the line is not already in view. If the run view
+        # window moved the text has changed, so always scroll.
+        rect = self.get_visible_rect()
+        y, height = self.get_line_yrange(iter)
+        if (window_start != self.window_start
+                or y < rect.y or y + height > rect.y + rect.height):
+            self.scroll_to_mark(self.mark, 0, True, 0, 0.5)
+
+    def follow_line(self, lnum):
+        """Highlight the line being executed. LinuxCNC can advance hundreds
+        of lines a second, so the updates are coalesced and only the latest
+        line is shown each frame."""
+        self.follow_target = lnum
+        if self.follow_id is None:
+            self.follow_id = self.add_tick_callback(self.on_follow_tick)
+
+    def on_follow_tick(self, widget, frame_clock):
+        self.follow_id = None
+        if self.follow_target != self.followed_line:
+            self.followed_line = self.follow_target
+            self.highlight_line(self.follow_target, 'motion')
+        return False
 
     # Since Gremlin3D reports any errors before GStat emits the 'file-loaded'
     # signal, we have to save the error line here and then do the actual 
@@ -142,6 +326,8 @@ class GcodeView(GtkSource.View):
     def set_line_number(self, lnum):
         if lnum == 0: # 0 will scroll to end, use -1 for that!
             lnum = 1
+        if self.run_view:
+            lnum = self.show_run_window(lnum)
         iter = self.buf.get_iter_at_line(lnum - 1)
         self.scroll_to_iter(iter, 0, True, 0, .5)
 
@@ -149,15 +335,22 @@ class GcodeView(GtkSource.View):
         if lnum == 0: # 0 will scroll to end, use -1 for that!
             lnum = 1
         self.grab_focus()
+        if self.run_view:
+            lnum = self.show_run_window(lnum)
         iter = self.buf.get_iter_at_line(lnum - 1)
         self.scroll_to_iter(iter, 0, True, 0, .5)
         self.buf.place_cursor(iter)
 
     def get_program_length(self):
+        if self.run_view and self.gcode_file is not None:
+            return self.gcode_file.get_line_count()
         return self.buf.get_line_count()
 
     # If no "save as" file name specified save to the current file in preview
     def save(self, fn=None):
+        if self.run_view or self.is_loading():
+            log.error('Can not save "{0}", the whole file is not loaded'.format(self.current_file))
+            return
         if fn is None:
             fn = self.current_file
         text = self.buf.get_text(self.buf.get_start_iter(), self.buf.get_end_iter(), include_hidden_chars=True)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Copy, move and trash files from a pool of worker threads, so large
+#   transfers (from a USB stick for example) don't block the GUI. Jobs
+#   report their progress and can be cancelled.
+
+# Note:
+#   Progress and done callbacks are always called on the GTK thread.
+#   Files are copied in chunks, using copy_file_range() or sendfile() if
+#   the os module has them, otherwise with plain reads and writes.
+
+import os
+import time
+import errno
+import shutil
+import threading
+import collections
+
+from gi.repository import GLib
+
+from move2trash import move2trash
+
+# Setup logging
+from utilities import logger
+log = logger.get(__name__)
+
+
+# Number of jobs that can run at the same time
+WORKERS = 2
+
+# Bytes copied per chunk, cancel is checked between chunks
+CHUNK_SIZE = 1024 * 1024
+
+# Minimum time in seconds between progress reports
+PROGRESS_INTERVAL = 0.25
+
+# Errors that mean the kernel can't copy between these two files
+COPY_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                    errno.EOPNOTSUPP, errno.EBADF)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class FileJob(object):
+    '''A file operation run by the FileJobQueue.
+
+    Once done `status` is 'INFO', 'ERROR' or 'CANCELLED' and `message`
+    describes the result. `done` and `total` are in bytes.
+    '''
+
+    verb = 'Processing'
+
+    def __init__(self, src, dst=None):
+        self.src = src
+        self.dst = dst
+        self.name = os.path.basename(src)
+
+        self.total = 0
+        self.done = 0
+        self.start_time = None
+        self.status = None
+        self.message = None
+
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+        self._progress_callbacks = []
+        self._done_callbacks = []
+        self._last_report = 0
+
+        # Paths created by the job, removed again if it fails
+        self._created = []
+
+    @property
+    def rate(self):
+        '''Average throughput in bytes per second.'''
+        if not self.start_time:
+            return 0.0
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
+
+    @property
+    def fraction(self):
+        if not self.total:
+            return 1.0 if self.is_done() else 0.0
+        return min(float(self.done) / self.total, 1.0)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def is_done(self):
+        return self._finished.is_set()
+
+    def add_progress_callback(self, callback):
+        self._progress_callbacks.append(callback)
+
+    def add_done_callback(self, callback):
+        self._done_callbacks.append(callback)
+
+    def run(self):
+        '''Called from the worker thread.'''
+        self.start_time = time.time()
+        try:
+            self.check_cancelled()
+            self.total = self.get_total()
+            self._report(force=True)
+            self.status, self.message = self.execute()
+        except JobCancelled:
+            self._cleanup()
+            self.status = 'CANCELLED'
+            self.message = '{} "{}" cancelled'.format(self.verb, self.name)
+        except Exception as e:
+            if not isinstance(e, (IOError, OSError, shutil.Error)):
+                log.exception(e)
+            self._cleanup()
+            self.status = 'ERROR'
+            self.message = '{} "{}" failed: {}'.format(self.verb, self.name, e)
+        self._finished.set()
+        GLib.idle_add(self._call, self._done_callbacks)
+
+    def execute(self):
+        '''Do the work, returns (status, message).'''
+        raise NotImplementedError
+
+    def get_total(self):
+        return 0
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def add_done(self, count):
+        self.done += count
+        self._report()
+
+    def _report(self, force=False):
+        now = time.time()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            GLib.idle_add(self._call, self._progress_callbacks)
+
+    def _call(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                log.exception(e)
+        return False
+
+    def _cleanup(self):
+        for path in reversed(self._created):
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    os.rmdir(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+        self._created = []
+
+    # =======================================
+    #   Copy helpers
+    # =======================================
+
+    def _get_size(self, path):
+        '''Returns the number of bytes that copying `path` will copy.'''
+        if os.path.islink(path):
+            return 0
+        if not os.path.isdir(path):
+            return os.stat(path).st_size
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                fname = os.path.join(root, name)
+                if not os.path.islink(fname):
+                    try:
+                        total += os.stat(fname).st_size
+                    except OSError:
+                        pass
+        return total
+
+    def _copy(self, src, dst):
+        '''Copy a file or directory tree, like shutil.copy2/copytree.'''
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+            self._created.append(dst)
+        elif os.path.isdir(src):
+            os.mkdir(dst)
+            self._created.append(dst)
+            for name in sorted(os.listdir(src)):
+                self._copy(os.path.join(src, name), os.path.join(dst, name))
+            shutil.copystat(src, dst)
+        else:
+            self._copy_file(src, dst)
+            shutil.copystat(src, dst)
+
+    def _copy_file(self, src, dst):
+        infd = os.open(src, os.O_RDONLY)
+        try:
+            outfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            self._created.append(dst)
+            try:
+                self._copy_data(infd, outfd)
+            finally:
+                os.close(outfd)
+        finally:
+            os.close(infd)
+
+    def _copy_data(self, infd, outfd):
+        offset = 0
+        for copy_chunk in (_copy_file_range, _sendfile, _read_write):
+            if copy_chunk is None:
+                continue
+            try:
+                while True:
+                    self.check_cancelled()
+                    count = copy_chunk(infd, outfd, offset)
+                    if not count:
+                        return
+                    offset += count
+                    self.add_done(count)
+            except OSError as e:
+                # Only fall back if nothing has been copied yet
+                if e.errno not in COPY_UNSUPPORTED or offset:
+                    raise
+
+
+# Each of these copies the next chunk of `infd`, starting at `offset`, to
+# the end of `outfd` and returns the number of bytes copied
+
+if hasattr(os, 'copy_file_range'):
+    def _copy_file_range(infd, outfd, offset):
+        return os.copy_file_range(infd, outfd, CHUNK_SIZE, offset, offset)
+else:
+    _copy_file_range = None
+
+if hasattr(os, 'sendfile'):
+    def _sendfile(infd, outfd, offset):
+        return os.sendfile(outfd, infd, offset, CHUNK_SIZE)
+else:
+    _sendfile = None
+
+def _read_write(infd, outfd, offset):
+    buf = os.read(infd, CHUNK_SIZE)
+    written = 0
+    while written < len(buf):
+        written += os.write(outfd, buf[written:])
+    return len(buf)
+
+
+class CopyJob(FileJob):
+    verb = 'Copying'
+
+    def get_total(self):
+        return self._get_size(self.src)
+
+    def execute(self):
+        self._copy(self.src, self.dst)
+        self._created = []
+        msg = 'Copied "{0}" to "{1}"'.format(self.name, os.path.dirname(self.dst))
+        return 'INFO', msg
+
+
+class MoveJob(FileJob):
+    verb = 'Moving'
+
+    def get_total(self):
+        # Moves on the same volume are just renamed
+        if self._same_device():
+            return 0
+        return self._get_size(self.src)
+
+    def _same_device(self):
+        dst_dir = os.path.dirname(self.dst)
+        return os.lstat(self.src).st_dev == os.lstat(dst_dir).st_dev
+
+    def execute(self):
+        if self._same_device():
+            os.rename(self.src, self.dst)
+        else:
+            self._copy(self.src, self.dst)
+            # Can't cancel once the source starts being removed
+            self.check_cancelled()
+            self._created = []
+            if os.path.isdir(self.src) and not os.path.islink(self.src):
+                shutil.rmtree(self.src)
+            else:
+                os.remove(self.src)
+        msg = 'Moved "{0}" to "{1}"'.format(self.name, os.path.dirname(self.dst))
+        return 'INFO', msg
+
+
+class TrashJob(FileJob):
+    verb = 'Trashing'
+
+    def execute(self):
+        result, msg = move2trash(self.src)
+        return result, msg
+
+
+class FileJobQueue(object):
+    '''Runs FileJobs on a pool of worker threads, in the order they were
+    added, up to `workers` at a time.'''
+
+    def __init__(self, workers=WORKERS):
+        self.jobs = collections.deque()
+        self.condition = threading.Condition()
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run,
+                                      name='FileJobQueue-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, job):
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify()
+        return job
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                job = self.jobs.popleft()
+            try:
+                job.run()
+            except Exception as e:
+                log.exception(e)
+
+
+queue = FileJobQueue()
+
+def put(job):
+    return queue.put(job)
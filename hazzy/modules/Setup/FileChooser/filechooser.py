@@ -22,7 +22,8 @@
 #   TBA
 
 import os
-import shutil
+import stat
+import bisect
 import gi
 
 gi.require_version('Gtk', '3.0')
@@ -32,15 +33,19 @@ gi.require_version('Gio', '2.0')
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import Gio
+from gi.repository import GLib
 from gi.repository import GObject
 
 from datetime import datetime
 
 from utilities import logger
+from utilities import ini_info
+from utilities import program_info
+from utilities import program_search
 from widget_factory.TouchPads import keyboard
 
 # Import our own file utility modules
-from move2trash import move2trash
+import file_jobs
 from userdirectories import UserDirectories
 from bookmarks import BookMarks
 from icons import Icons
@@ -52,6 +57,15 @@ UIDIR = os.path.join(PYDIR, 'ui')
 # Set up logging
 log = logger.get(__name__)
 
+# Directories are listed asynchronously, this many entries at a time
+BATCH_SIZE = 200
+
+# The file info needed for each entry, all from a single stat
+FILE_ATTRIBUTES = ','.join([Gio.FILE_ATTRIBUTE_STANDARD_NAME,
+                            Gio.FILE_ATTRIBUTE_STANDARD_TYPE,
+                            Gio.FILE_ATTRIBUTE_STANDARD_SIZE,
+                            Gio.FILE_ATTRIBUTE_TIME_MODIFIED])
+
 class FileChooser(Gtk.Bin):
     __gtype_name__ = 'FileChooser'
     __gsignals__ = {
@@ -88,6 +102,8 @@ class FileChooser(Gtk.Bin):
         self.file_treeview = self.builder.get_object("file_treeview")
         self.bookmark_listbox = self.builder.get_object("bookmark_listbox")
 
+        self.search_entry = self.builder.get_object("search_entry")
+
         # Enable DnD ToDo implement DnD
         self.file_treeview.enable_model_drag_source(Gdk.ModifierType.BUTTON1_MASK,
                                     [('text/plain', 0, 0)], 
@@ -120,10 +136,30 @@ class FileChooser(Gtk.Bin):
         self._hidden_exts = ['.desktop']
         self._copy = True
         self._selection = None
+        self.selected_row = None
         self.nav_btn_list = []
         self.nav_btn_path_dict = {}
         self.eject_btn_path_dict = {}
 
+        # The Gio.Cancellable of the directory listing in progress, the
+        # callbacks to call once it is done, and the sort keys of the rows
+        # in the file_liststore, which is kept sorted as entries arrive
+        self._listing = None
+        self._listed_callbacks = []
+        self._row_keys = []
+
+        # The Gio.FileMonitor watching the current directory, changes it
+        # reports are applied to the file_liststore in place
+        self._monitor = None
+        self.program_prefix = ini_info.get_program_prefix()
+
+        # The directory that was shown before searching, None if not
+        # showing search results
+        self._search_dir = None
+
+        # Copy, move and trash jobs that have not finished yet
+        self._jobs = []
+
         # Initialize
         self._init_nav_buttons()
 
@@ -214,11 +250,26 @@ class FileChooser(Gtk.Bin):
     def on_arrow_right_clicked(self, widget, data=None):
         pass
 
-    def _fill_file_liststore(self, path=None):
+    def _fill_file_liststore(self, path=None, callback=None):
+        """List the current directory, or `path` if given. The listing is
+        done asynchronously and the rows are added in batches, `callback`
+        is called once the whole directory has been listed."""
+        if self._listing is not None:
+            # Stop listing the previous directory
+            self._listing.cancel()
+            self._listing = None
+        self._listed_callbacks = []
+
         model = self.file_liststore
         model.clear()
+        self._row_keys = []
         self.selected_row = None
 
+        if self._search_dir is not None:
+            # Leave the search results
+            self._search_dir = None
+            self.search_entry.set_text('')
+
         if path:
             self._cur_dir = path
             # Reset scrollbars since display has changed
@@ -227,38 +278,19 @@ class FileChooser(Gtk.Bin):
         if self._cur_dir is None:
             self._cur_dir = self.userdirs.get_XDG_directory('XDG_DESKTOP_DIR')
 
-        files = []
-        folders = []
-        if self._filter:
-            exts = self._filters[self._filter]
-        else:
-            exts = '*' # Don't filter
-        names = os.listdir(self._cur_dir)
-        for name in names:
-            if name[0] == '.' and not self._show_hidden:
-                continue
-            path = os.path.join(self._cur_dir, name)
-            if os.path.islink(path):
-                path = os.readlink(path)
-            if os.path.isdir(path):
-                folders.append(name)
-            elif os.path.isfile(path):
-                ext = os.path.splitext(name)[1]
-                if '*' in exts or ext in exts and not ext in self._hidden_exts:
-                    files.append(name)
-
-        folders.sort(key=str.lower, reverse=False)
-        for fname in folders:
-            fpath = os.path.join(self._cur_dir, fname)
-            icon = self.icons.get_for_directory(fpath)
-            model.append([0, icon, fname, None, None])
+        if callback is not None:
+            self._listed_callbacks.append(callback)
 
-        files.sort(key=str.lower, reverse=False)
-        for fname in files:
-            fpath = os.path.join(self._cur_dir, fname)
-            icon = self.icons.get_for_file(fname)
-            size, date = self._get_file_data(fpath)
-            model.append([0, icon, fname, size, date])
+        cancellable = Gio.Cancellable()
+        self._listing = cancellable
+        gfile = Gio.File.new_for_path(self._cur_dir)
+        self._watch_directory(gfile)
+        gfile.enumerate_children_async(FILE_ATTRIBUTES,
+                                       Gio.FileQueryInfoFlags.NONE,
+                                       GLib.PRIORITY_DEFAULT,
+                                       cancellable,
+                                       self._on_enumerate_children,
+                                       cancellable)
 
         self._update_nav_buttons()
 
@@ -279,30 +311,232 @@ class FileChooser(Gtk.Bin):
         self.builder.get_object('copy_button').set_sensitive(False)
         self.builder.get_object('delete_button').set_sensitive(False)
 
-    def _get_file_data(self, fpath):
-        size = os.path.getsize(fpath)
-        if size >= 1E9:
-            size_str = "{:.1f} GB".format(size / 1E9)
-        elif size >= 1E6:
-            size_str = "{:.1f} MB".format(size / 1E6)
-        elif size >= 1E3:
-            size_str = "{:.1f} KB".format(size / 1E3)
+    def on_search_changed(self, entry):
+        query = entry.get_text()
+        if not query.strip():
+            if self._search_dir is not None:
+                self._fill_file_liststore(self._search_dir)
+            return
+        self._show_search_results(query)
+
+    def on_search_stopped(self, entry):
+        entry.set_text('')
+
+    def _show_search_results(self, query):
+        """Replace the listing with the programs matching `query`. The
+        rows are named by their path relative to the program directory."""
+        if self._listing is not None:
+            self._listing.cancel()
+            self._listing = None
+        self._listed_callbacks = []
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+
+        if self._search_dir is None:
+            self._search_dir = self._cur_dir
+
+        prefix = os.path.realpath(self.program_prefix)
+        self._cur_dir = prefix
+        self.file_liststore.clear()
+        self._row_keys = []
+        self.selected_row = None
+        self.file_vadj.set_value(0)
+
+        for path in program_search.search(query):
+            self._insert_path(os.path.relpath(path, prefix))
+
+        self._update_nav_buttons()
+
+    def _on_enumerate_children(self, gfile, result, cancellable):
+        try:
+            enumerator = gfile.enumerate_children_finish(result)
+        except GLib.Error as e:
+            if not cancellable.is_cancelled():
+                log.error('Could not list "{}": {}'.format(gfile.get_path(), e.message))
+                self._finish_listing(cancellable)
+            return
+        enumerator.next_files_async(BATCH_SIZE, GLib.PRIORITY_DEFAULT,
+                                    cancellable, self._on_next_files, cancellable)
+
+    def _on_next_files(self, enumerator, result, cancellable):
+        try:
+            infos = enumerator.next_files_finish(result)
+        except GLib.Error as e:
+            if not cancellable.is_cancelled():
+                log.error('Error listing directory: {}'.format(e.message))
+            infos = []
+        if cancellable.is_cancelled() or not infos:
+            enumerator.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+            self._finish_listing(cancellable)
+            return
+
+        for info in infos:
+            self._add_file_info(info)
+
+        enumerator.next_files_async(BATCH_SIZE, GLib.PRIORITY_DEFAULT,
+                                    cancellable, self._on_next_files, cancellable)
+
+    def _finish_listing(self, cancellable):
+        if cancellable is not self._listing:
+            return
+        self._listing = None
+        self._index_programs()
+        callbacks = self._listed_callbacks
+        self._listed_callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def _index_programs(self):
+        # Count the lines of the programs in the program directory in the
+        # background, so they are ready when a program is selected
+        prefix = os.path.join(os.path.realpath(self.program_prefix), '')
+        cur_dir = os.path.join(os.path.realpath(self._cur_dir), '')
+        if not cur_dir.startswith(prefix):
+            return
+        paths = [os.path.join(self._cur_dir, key[2])
+                 for key in self._row_keys if key[0]]
+        program_info.scan(paths)
+
+    def _when_listed(self, callback):
+        """Call `callback` once the current directory has been listed."""
+        if self._listing is None:
+            callback()
+        else:
+            self._listed_callbacks.append(callback)
+
+    def _watch_directory(self, gfile):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        try:
+            monitor = gfile.monitor_directory(Gio.FileMonitorFlags.NONE, None)
+        except GLib.Error as e:
+            log.warning('Could not watch "{}" for changes: {}'.format(gfile.get_path(), e.message))
+            return
+        monitor.connect('changed', self._on_directory_changed)
+        self._monitor = monitor
+
+    def _on_directory_changed(self, monitor, gfile, other_file, event):
+        if monitor is not self._monitor:
+            return
+        name = gfile.get_basename()
+        if event == Gio.FileMonitorEvent.CREATED:
+            fpath = os.path.join(self._cur_dir, name)
+            if self._is_shown(name, os.path.isdir(fpath)):
+                self._insert_path(name)
+        elif event == Gio.FileMonitorEvent.DELETED:
+            index = self._find_row(name)
+            if index is not None:
+                self._remove_row(index)
+        elif event in (Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                       Gio.FileMonitorEvent.ATTRIBUTE_CHANGED):
+            self._update_row(name)
+
+    def _refresh(self):
+        """Bring the listing up to date after changing the current directory.
+        If it is being watched the changes are applied as they are reported,
+        otherwise it is listed again."""
+        if self._search_dir is not None:
+            self._show_search_results(self.search_entry.get_text())
+        elif self._monitor is None:
+            self._fill_file_liststore()
+
+    def _is_shown(self, name, is_dir):
+        if name[0] == '.' and not self._show_hidden:
+            return False
+        if is_dir:
+            return True
+        if self._filter:
+            exts = self._filters[self._filter]
         else:
-            size_str = "{} bytes".format(size)
-        tstamp = os.path.getmtime(fpath)
+            exts = '*' # Don't filter
+        ext = os.path.splitext(name)[1]
+        return '*' in exts or ext in exts and not ext in self._hidden_exts
+
+    def _add_file_info(self, info):
+        name = info.get_name()
+        file_type = info.get_file_type()
+        if file_type == Gio.FileType.DIRECTORY:
+            if self._is_shown(name, True):
+                self._insert_row(name, True)
+        elif file_type == Gio.FileType.REGULAR:
+            if self._is_shown(name, False):
+                mtime = info.get_attribute_uint64(Gio.FILE_ATTRIBUTE_TIME_MODIFIED)
+                self._insert_row(name, False, info.get_size(), mtime)
+
+    def _get_row_key(self, name, is_dir):
+        # Folders first, then files, both sorted by name
+        return (not is_dir, name.lower(), name)
+
+    def _insert_row(self, name, is_dir, size=None, mtime=None):
+        key = self._get_row_key(name, is_dir)
+        index = bisect.bisect_left(self._row_keys, key)
+        if index < len(self._row_keys) and self._row_keys[index] == key:
+            return index
+        if is_dir:
+            fpath = os.path.join(self._cur_dir, name)
+            row = [0, self.icons.get_for_directory(fpath), name, None, None]
+        else:
+            size_str, date_str = self._format_file_data(size, mtime)
+            row = [0, self.icons.get_for_file(name), name, size_str, date_str]
+        self._row_keys.insert(index, key)
+        self.file_liststore.insert(index, row)
+        return index
+
+    def _insert_path(self, name):
+        """Add a single entry of the current directory, returns its row."""
+        fpath = os.path.join(self._cur_dir, name)
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            return self._insert_row(name, True)
+        return self._insert_row(name, False, st.st_size, st.st_mtime)
+
+    def _update_row(self, name):
+        """Update the size and date shown for a file that has changed."""
+        index = self._find_row(name)
+        if index is None or not self._row_keys[index][0]:
+            return
+        try:
+            st = os.stat(os.path.join(self._cur_dir, name))
+        except OSError:
+            return
+        size_str, date_str = self._format_file_data(st.st_size, st.st_mtime)
+        row = self.file_liststore[index]
+        row[3] = size_str
+        row[4] = date_str
+
+    def _remove_row(self, index):
+        del self._row_keys[index]
+        del self.file_liststore[index]
+
+    def _find_row(self, name):
+        for is_dir in (True, False):
+            key = self._get_row_key(name, is_dir)
+            index = bisect.bisect_left(self._row_keys, key)
+            if index < len(self._row_keys) and self._row_keys[index] == key:
+                return index
+        return None
+
+    def _format_file_data(self, size, tstamp):
+        size_str = self._format_size(size)
         date_str = datetime.fromtimestamp(tstamp).strftime("%m/%d/%y %X")
         return size_str, date_str
 
-    def count_lines(self, filename):
-        lines = 0
-        buf_size = 1024 * 1024
-        with open(filename) as fh:
-            read_f = fh.read
-            buf = read_f(buf_size)
-            while buf:
-                lines += buf.count('\n')
-                buf = read_f(buf_size)
-        return lines + 1
+    def _format_size(self, size):
+        if size >= 1E9:
+            return "{:.1f} GB".format(size / 1E9)
+        elif size >= 1E6:
+            return "{:.1f} MB".format(size / 1E6)
+        elif size >= 1E3:
+            return "{:.1f} KB".format(size / 1E3)
+        return "{} bytes".format(int(size))
+
+    def count_lines(self, filename, callback=None):
+        return program_info.get_line_count(filename, callback)
 
     def on_select_toggled(self, widget, path):
         model = self.file_liststore
@@ -366,8 +600,8 @@ class FileChooser(Gtk.Bin):
         elif os.path.isdir(fpath):
             self._fill_file_liststore(fpath)
         else:
-            # If neither, probably does not exist, so reload
-            self._fill_file_liststore()
+            # If neither, probably does not exist, so remove it
+            self._remove_row(path.get_indices()[0])
 
     def on_file_name_editing_started(self, renderer, entry, row):
         keyboard.show(entry)
@@ -385,7 +619,9 @@ class FileChooser(Gtk.Bin):
             msg = 'Renamed "{}" to "{}"'.format(old_name, new_name)
             log.info(msg)
             self.widget_window.show_info(msg, 2)
-            model[row][2] = new_name
+            # Re-insert the row so the model stays sorted
+            self._remove_row(int(row))
+            self._insert_path(new_name)
         else:
             msg = "Destination file already exists, won't rename"
             log.warning(msg)
@@ -463,18 +699,18 @@ class FileChooser(Gtk.Bin):
 
     # Set cursor at path
     def set_cursor_at_path(self, fpath):
-        model = self.file_liststore
-        tree = self.file_treeview
         if not os.path.exists(fpath):
             return False
         fpath, fname = os.path.split(fpath)
         if fpath != self._cur_dir:
             self._fill_file_liststore(fpath)
-        for row in range(len(model)):
-            if model[row][2] == fname:
-                tree.set_cursor(row)
-                return True
-        return False
+
+        def set_cursor():
+            row = self._find_row(fname)
+            if row is not None:
+                self.file_treeview.set_cursor(row)
+        self._when_listed(set_cursor)
+        return True
 
     # Get paths for selected
     def get_selected(self):
@@ -489,29 +725,31 @@ class FileChooser(Gtk.Bin):
 
     # Check checkbox at file path
     def set_selected(self, fpath):
-        model = self.file_liststore
-        tree = self.file_treeview
         if not os.path.exists(fpath):
             return False
         fpath, fname = os.path.split(fpath)
         if fpath != self._cur_dir:
             self._fill_file_liststore(fpath)
-        for row in range(len(model)):
-            if model[row][2] == fname:
-                model[row][0] = 1
-                return True
-        return False
+
+        def set_selected():
+            row = self._find_row(fname)
+            if row is not None:
+                self.file_liststore[row][0] = 1
+        self._when_listed(set_selected)
+        return True
 
     # Check all checkboxes in current display directory
     def select_all(self, fpath=None):
-        model = self.file_liststore
         if fpath is not None:
             if os.path.isdir(fpath):
                 self._fill_file_liststore(fpath)
             else:
                 return False
-        for row in range(len(model)):
-            model[row][0] = 1
+
+        def select_all():
+            for row in self.file_liststore:
+                row[0] = 1
+        self._when_listed(select_all)
         return True
 
     # Uncheck all checkboxes in current display directory
@@ -593,7 +831,7 @@ class FileChooser(Gtk.Bin):
             for src in self._files:
                 self._move_file(src, dst_dir)
             self._files = None
-        self._fill_file_liststore()
+        self._refresh()
         self.builder.get_object('paste_button').set_sensitive(False)
         return True
 
@@ -606,13 +844,19 @@ class FileChooser(Gtk.Bin):
         if not os.path.exists(path) or path is None:
             return False
         fpath, fname = os.path.split(path)
-        new_name = self._copy_file(path, fdir)
-        for row in range(len(model)):
-            if model[row][2] == new_name:
-                break
-        focus_column = self.builder.get_object('col_file_name')
-        model[row][0] = 1
-        tree.set_cursor(row, focus_column, True)
+
+        def start_rename(job):
+            if job.status != 'INFO' or fpath != self._cur_dir:
+                return
+            row = self._insert_path(os.path.basename(job.dst))
+            if row is None:
+                # The copy was removed or renamed before it could be shown
+                return
+            focus_column = self.builder.get_object('col_file_name')
+            model[row][0] = 1
+            tree.set_cursor(row, focus_column, True)
+
+        self._copy_file(path, fpath, start_rename)
 
     # Create a new folder in the current directory
     def new_folder(self, widegt=None, data=None):
@@ -628,11 +872,9 @@ class FileChooser(Gtk.Bin):
         path = os.path.join(self._cur_dir, name)
         os.makedirs(path)
 
-        self._fill_file_liststore()
-
-        for row in range(len(model)):
-            if model[row][2] == name:
-                break
+        row = self._insert_path(name)
+        if row is None:
+            return
         focus_column = self.builder.get_object('col_file_name')
         model[row][0] = 1
         tree.set_cursor(row, focus_column, True)
@@ -651,11 +893,10 @@ class FileChooser(Gtk.Bin):
         path = os.path.join(self._cur_dir, name)
         with open(path, 'w') as fh:
             pass
-        self._fill_file_liststore()
 
-        for row in range(len(model)):
-            if model[row][2] == name:
-                break
+        row = self._insert_path(name)
+        if row is None:
+            return
         focus_column = self.builder.get_object('col_file_name')
         model[row][0] = 1
         tree.set_cursor(row, focus_column, True)
@@ -675,15 +916,13 @@ class FileChooser(Gtk.Bin):
         paths = self.get_selected()
         if paths is None:
             return
-        num = len(paths)
         for path in paths:
-            result, msg = move2trash(path)
-        self._fill_file_liststore()
+            self._start_job(file_jobs.TrashJob(path))
 
-        if result == 'INFO':
-            self.widget_window.show_info(msg, 2)
-        else:
-            self.widget_window.show_error(msg)
+    # Cancel all copy, move and delete operations in progress
+    def cancel_file_jobs(self, widget=None, data=None):
+        for job in self._jobs:
+            job.cancel()
 
 
     # =======================================
@@ -847,7 +1086,7 @@ class FileChooser(Gtk.Bin):
     #   File utilities
     # =======================================
 
-    def _copy_file(self, src, dst_dir):
+    def _copy_file(self, src, dst_dir, callback=None):
         src_dir, src_name = os.path.split(src)
         dst_name = src_name
 
@@ -873,17 +1112,7 @@ class FileChooser(Gtk.Bin):
                 self.widget_window.show_info(msg, 2)
                 return
 
-        if os.path.isfile(src):
-            shutil.copy2(src, dst)
-
-        else:
-            shutil.copytree(src, dst)
-
-        msg = 'Copied "{0}" to "{1}"'.format(src_name, dst_dir)
-        log.info(msg)
-        self.widget_window.show_info(msg, 2)
-
-        self._fill_file_liststore()
+        self._start_job(file_jobs.CopyJob(src, dst), callback)
         return dst_name
 
 
@@ -907,7 +1136,52 @@ class FileChooser(Gtk.Bin):
                 self.widget_window.show_info(msg, 2)
                 return
 
-        msg = 'Moving "{0}" to "{1}"'.format(src_name, dst_dir)
-        log.info(msg)
-        self.widget_window.show_info(msg, 2)
-        shutil.move(src, dst)
+        self._start_job(file_jobs.MoveJob(src, dst))
+
+    def _start_job(self, job, callback=None):
+        """Run a file operation in the background, `callback` is called
+        with the job once it is done."""
+        job.add_progress_callback(self._on_job_progress)
+        job.add_done_callback(self._on_job_done)
+        if callback is not None:
+            job.add_done_callback(callback)
+        self._jobs.append(job)
+        log.info('{} "{}"'.format(job.verb, job.src))
+        file_jobs.put(job)
+        self._on_job_progress(job)
+
+    def _on_job_progress(self, job):
+        running = [job for job in self._jobs if not job.is_done()]
+        if not running:
+            return
+        done = sum(job.done for job in running)
+        total = sum(job.total for job in running)
+        rate = sum(job.rate for job in running)
+
+        if len(running) == 1:
+            msg = '{} "{}"'.format(running[0].verb, running[0].name)
+        else:
+            msg = '{} file operations'.format(len(running))
+        if total:
+            msg += ' - {} of {} ({}/s)'.format(self._format_size(done),
+                                               self._format_size(total),
+                                               self._format_size(rate))
+            fraction = float(done) / total
+        else:
+            fraction = 0.0
+
+        self.widget_window.show_progress(msg, fraction, self.cancel_file_jobs)
+
+    def _on_job_done(self, job):
+        self._jobs.remove(job)
+        if job.status == 'ERROR':
+            log.error(job.message)
+            self.widget_window.show_error(job.message)
+        else:
+            log.info(job.message)
+            if self._jobs:
+                self._on_job_progress(job)
+            else:
+                self.widget_window.show_info(job.message, 2)
+
+        self._refresh()
@@ -29,6 +29,7 @@ gi.require_version('Gio', '2.0')
 from gi.repository import Gtk
 from gi.repository import Gio
 
+import os
 import mimetypes
 
 import userdirectories
@@ -42,6 +43,20 @@ class Icons():
         self.theme = theme
         self.userdirs = userdirectories.UserDirectories()
 
+        # Icons are shared by all the files with the same extension or MIME
+        # type, and reloaded if the icon theme changes
+        self._mime_types = {}
+        self._file_icons = {}
+        self.theme.connect('changed', self._on_theme_changed)
+
+        self._load_icons()
+
+    def _on_theme_changed(self, theme):
+        self._load_icons()
+
+    def _load_icons(self):
+        self._file_icons.clear()
+
         # get default directory  icon
         if self.theme.has_icon('folder'):
             self.default_icon = self.theme.load_icon('folder', ICONSIZE, 0)
@@ -93,17 +108,25 @@ class Icons():
 
 
     def get_for_file(self, fname):
-        mime = Gio.content_type_guess(fname)
+        ext = os.path.splitext(fname)[1].lower()
+        mime = self._mime_types.get(ext) if ext else None
+        if mime is None:
+            mime = Gio.content_type_guess(fname, None)[0]
+            if ext:
+                self._mime_types[ext] = mime
+
+        icon = self._file_icons.get(mime)
+        if icon is None:
+            icon = self._file_icons[mime] = self._load_file_icon(mime)
+        return icon
+
+    def _load_file_icon(self, mime):
         if mime:
-            icon_name = Gio.content_type_get_icon(str(mime))
+            icon_name = Gio.content_type_get_icon(mime)
             icon = self.theme.choose_icon(icon_name.get_names(), ICONSIZE, 0)
             if icon:
                 return Gtk.IconInfo.load_icon(icon)
-            else:
-                name = Gtk.STOCK_FILE
-        else:
-            name = Gtk.STOCK_FILE
-        return self.theme.load_icon(name, ICONSIZE, 0)
+        return self.theme.load_icon(Gtk.STOCK_FILE, ICONSIZE, 0)
 
 
     # TODO expand for other devices
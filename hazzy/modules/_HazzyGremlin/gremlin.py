@@ -54,6 +54,8 @@ import rs274.interpret
 import linuxcnc
 import gcode
 
+from utilities import preview_cache
+
 import time
 import re
 import tempfile
@@ -62,6 +64,7 @@ import os
 import sys
 
 import thread
+import threading
 
 import logging
 
@@ -69,20 +72,52 @@ from minigl import *
 
 log = logging.getLogger("HAZZY.GREMLIN.GREMLIN")
 
+# The preview is parsed in a background thread
+gobject.threads_init()
+
 
 class DummyProgress:
     def nextphase(self, unused): pass
 
-    def progress(self): pass
+    def progress(self, count, force=False): pass
+
+
+class PreviewProgress:
+    """Progress of a preview being parsed in a background thread. `callback`
+    is called from the parse thread with the phase and the percent done in
+    that phase, at most every `interval` seconds."""
+
+    def __init__(self, callback, interval=0.1):
+        self.callback = callback
+        self.interval = interval
+        self.phase = 0
+        self.total = 1
+        self.last = 0
+
+    def nextphase(self, total):
+        self.phase += 1
+        self.total = max(total, 1)
+        self.progress(0, force=True)
+
+    def progress(self, count, force=False):
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        self.callback(self.phase, min(count * 100 / self.total, 100))
+
+
+class LoadCancelled(Exception):
+    pass
 
 
 class StatCanon(glcanon.GLCanon, rs274.interpret.StatMixin):
-    def __init__(self, colors, geometry, lathe_view_option, stat, random, Gremlin_instance):
+    def __init__(self, colors, geometry, lathe_view_option, stat, random):
         glcanon.GLCanon.__init__(self, colors, geometry)
         rs274.interpret.StatMixin.__init__(self, stat, random)
         self.progress = DummyProgress()
-        self.Gremlin_instance = Gremlin_instance
         self.lathe_view_option = lathe_view_option
+        self.aborted = False
 
     def is_lathe(self): 
         return self.lathe_view_option
@@ -91,10 +126,15 @@ class StatCanon(glcanon.GLCanon, rs274.interpret.StatMixin):
         glcanon.GLCanon.change_tool(self,pocket)
         rs274.interpret.StatMixin.change_tool(self,pocket)
 
+    def check_abort(self):
+        if self.aborted:
+            raise LoadCancelled()
+
     def next_line(self, st):
         self.state = st
         self.lineno = self.state.sequence_number
-        self.Gremlin_instance.fileloading(self.lineno)
+        self.progress.progress(self.lineno)
+        self.check_abort()
 
 
 class Gremlin(gtk.gtkgl.widget.DrawingArea, glnav.GlNavBase,
@@ -177,6 +217,9 @@ class Gremlin(gtk.gtkgl.widget.DrawingArea, glnav.GlNavBase,
 
         self.label = None
 
+        # Canon of the preview being parsed in the background, if any
+        self.loading_canon = None
+
         self.a_axis_wrapped = inifile.find("AXIS_A", "WRAPPED_ROTARY")
         self.b_axis_wrapped = inifile.find("AXIS_B", "WRAPPED_ROTARY")
         self.c_axis_wrapped = inifile.find("AXIS_C", "WRAPPED_ROTARY")
@@ -187,9 +230,10 @@ class Gremlin(gtk.gtkgl.widget.DrawingArea, glnav.GlNavBase,
             live_axis_count += 1
         self.num_joints = int(inifile.find("KINS", "JOINTS") or live_axis_count)
 
-    def fileloading(self, current_line):
-        percent = current_line * 100 / self.line_count
-        if self.percent != percent:
+    def loading_progress(self, phase, percent):
+        if phase != 1:
+            self.label.set_text("Generating Preview. Please wait ...")
+        elif self.percent != percent:
             self.percent = percent
             msg = "Parsing G-code {}%".format(self.percent)
             self.label.set_text(msg)
@@ -285,18 +329,27 @@ class Gremlin(gtk.gtkgl.widget.DrawingArea, glnav.GlNavBase,
         elif not filename and not s.file:
             return
 
+        # Only the latest file is previewed, stop parsing the previous one
+        if self.loading_canon is not None:
+            self.loading_canon.aborted = True
+            self.loading_canon = None
+
         self.label.show()
 
-        self.td = tempfile.mkdtemp()
+        td = tempfile.mkdtemp()
         self._current_file = filename
 
         try:
-            lines = open(self._current_file).readlines()
-            self.line_count = len(lines)
+            # The parse thread reads the machine state from its own stat
+            stat = linuxcnc.stat()
+            stat.poll()
             random = int(self.inifile.find("EMCIO", "RANDOM_TOOLCHANGER") or 0)
-            canon = StatCanon(self.colors, self.get_geometry(),self.lathe_option, s, random, self)
+            canon = StatCanon(self.colors, self.get_geometry(),self.lathe_option, stat, random)
+            canon.progress = PreviewProgress(lambda phase, percent:
+                                             self.parse_progress(canon, phase, percent))
+            canon.loading = True
             parameter = self.inifile.find("RS274NGC", "PARAMETER_FILE")
-            temp_parameter = os.path.join(self.td, os.path.basename(parameter or "linuxcnc.var"))
+            temp_parameter = os.path.join(td, os.path.basename(parameter or "linuxcnc.var"))
             if parameter:
                 shutil.copy(parameter, temp_parameter)
             canon.parameter_file = temp_parameter
@@ -304,26 +357,97 @@ class Gremlin(gtk.gtkgl.widget.DrawingArea, glnav.GlNavBase,
             unitcode = "G{0}".format(20 + (s.linear_units == 1))
             initcode = self.inifile.find("RS274NGC", "RS274NGC_STARTUP_CODE") or ""
 
-            self.load_preview(filename, canon, unitcode, initcode)
-
         except Exception as e:
             log.debug(e)
+            shutil.rmtree(td)
+            return
 
-    def load_preview(self, f, canon, *args):
-        super(Gremlin, self).load_preview(f, canon, *args)
-        log.debug("Load Preview")
+        # Show the program while it is parsed, the segments are drawn as
+        # the parse thread publishes them
+        self.set_canon(canon)
+        self.stale_program()
+        self.loading_canon = canon
 
-    def loading_finished(self, widget, result, seq):
-        self.set_current_view()
-        self.label.hide()
+        parser = threading.Thread(target=self.parse_preview,
+                                  args=(canon, filename, td, unitcode, initcode),
+                                  name='PreviewParser')
+        parser.daemon = True
+        parser.start()
 
+    def parse_preview(self, canon, filename, td, *args):
+        """Parse a program for the preview, runs in a background thread."""
         try:
-            shutil.rmtree(self.td)
+            key = preview_cache.get_key(filename, ('file', canon.parameter_file),
+                                        canon.tools, canon.random, canon.geometry, *args)
+            cached = preview_cache.load(key, canon)
+            if cached is not None:
+                result, seq = cached
+                canon.progress.nextphase(1)
+                canon.build_line_index()
+            else:
+                with open(filename) as f:
+                    line_count = sum(1 for line in f)
+                canon.progress.nextphase(line_count)
+                result, seq = gcode.parse(filename, canon, *args)
+                self.build_preview(canon, result)
+                preview_cache.save(key, canon, result, seq)
+        except LoadCancelled:
+            log.debug("Cancelled preview of {}".format(filename))
+            return
         except Exception as e:
             log.exception(e)
+            gobject.idle_add(self.loading_failed, canon, filename, e)
+            return
+        finally:
+            shutil.rmtree(td)
+        gobject.idle_add(self.loading_finished, canon, result, seq)
+
+    def parse_progress(self, canon, phase, percent):
+        # Called from the parse thread, so publish the segments parsed so
+        # far before the GTK thread draws them
+        canon.publish()
+        gobject.idle_add(self.update_loading, canon, phase, percent)
+
+    @glcanon.with_context
+    def update_loading(self, canon, phase, percent):
+        if canon is not self.loading_canon:
+            return False
+        self.stale_program()
+        self.queue_draw()
+        self.loading_progress(phase, percent)
+        return False
+
+    @glcanon.with_context
+    def loading_finished(self, canon, result, seq):
+        if canon is not self.loading_canon:
+            return False
+        self.loading_canon = None
+        self.show_preview(canon)
+
+        # The highlight can't be drawn until the program has loaded
+        line = self.get_highlight_line()
+        if line is not None:
+            self.update_highlight_variable(None)
+            self.set_highlight_line(line)
+
+        self.set_current_view()
+        self.queue_draw()
+        self.label.hide()
 
         if result > gcode.MIN_ERROR:
                 self.report_gcode_error(result, seq, self._current_file)
+        return False
+
+    @glcanon.with_context
+    def loading_failed(self, canon, filename, error):
+        canon.loading = False
+        if canon is not self.loading_canon:
+            return False
+        self.loading_canon = None
+        self.queue_draw()
+        self.label.hide()
+        log.error("Could not preview {}: {}".format(filename, error))
+        return False
 
     def get_program_alpha(self): return self.program_alpha
 
@@ -20,11 +20,22 @@
 
 # Description:
 #   Collection of linuxcnc.command convenience functions.
+#   Commands are issued in order from a worker thread, so the UI never
+#   blocks waiting for LinuxCNC to acknowledge them.
 #   Incomplete
 
+import time
+import threading
+import collections
+
 import linuxcnc
+
+from gi.repository import GLib
+
 from utilities import ini_info
 from utilities import notifications
+from utilities import status
+from utilities import lazy_import
 
 num_joints = ini_info.get_num_joints()
 no_force_homing = ini_info.get_no_force_homing()
@@ -33,43 +44,219 @@ no_force_homing = ini_info.get_no_force_homing()
 from utilities import logger
 log = logger.get(__name__)
 
-stat = linuxcnc.stat()
-command = linuxcnc.command()
+stat = status.StatProxy()
+# The command channel is opened when the first command is issued. It is
+# only used from the command queue thread, except by estop() and abort()
+# which have their own channel so they never share one with the worker
+command = lazy_import.Lazy(linuxcnc.command, 'linuxcnc.command')
+urgent_command = lazy_import.Lazy(linuxcnc.command, 'linuxcnc.command (urgent)')
+
+# Maximum age in seconds of the status snapshot used to decide whether
+# a command can be issued. Snapshots from the status thread are normally
+# newer than this, so checking them does not require an NML round-trip.
+MAX_AGE = 0.1
+
+# How long to wait for LinuxCNC to complete a mode or state change
+TIMEOUT = 5.0
+
+
+class CommandFuture(object):
+    '''The pending result of a queued command.
+
+    Callbacks added with add_done_callback() are called on the GTK thread
+    with the future as the only argument once the command has completed.
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        '''Block until the command has completed and return its result, or
+        raise its exception. Raises CommandTimeout if it has not completed
+        within `timeout` seconds. Should not be called from the GTK thread.'''
+        if not self._event.wait(timeout):
+            raise CommandTimeout()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        GLib.idle_add(self._call, callback)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            GLib.idle_add(self._call, callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            log.exception(e)
+        return False
+
+
+class CommandCancelled(Exception):
+    pass
+
+class CommandTimeout(Exception):
+    pass
+
+class CommandRejected(Exception):
+    '''The command was not issued because the machine is not ready.'''
+    pass
+
+
+class CommandQueue(object):
+    '''Ordered queue of commands issued from a worker thread.
+
+    Commands queued back to back with the same `merge` key and the same
+    arguments are merged, only the first one is issued and all of them
+    share the same future. This drops repeated requests for the same
+    target, like several clicks on a button while the worker is busy,
+    but never skips a step of a sequence like ESTOP_RESET -> ON.
+    '''
+
+    def __init__(self):
+        self.jobs = collections.deque()
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run, name='CommandQueue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, func, *args, **kwargs):
+        merge = kwargs.get('merge')
+        with self.condition:
+            if merge is not None and self.jobs:
+                job = self.jobs[-1]
+                if job[0] == merge and job[1] == func and job[2] == args:
+                    return job[3]
+            future = CommandFuture()
+            self.jobs.append([merge, func, args, future])
+            self.condition.notify()
+        return future
+
+    def clear(self):
+        '''Drop all commands that have not been started yet.'''
+        with self.condition:
+            jobs = list(self.jobs)
+            self.jobs.clear()
+        for merge, func, args, future in jobs:
+            future.set_exception(CommandCancelled())
+        if jobs:
+            log.debug('Cancelled {} queued commands'.format(len(jobs)))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                merge, func, args, future = self.jobs.popleft()
+            try:
+                result = func(*args)
+            except Exception as e:
+                log.exception(e)
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+queue = CommandQueue()
+
+# Only used from the command queue thread
+worker_stat = status.StatProxy()
+
+def _done(result=None):
+    future = CommandFuture()
+    future.set_result(result)
+    return future
+
+def _rejected(msg):
+    future = CommandFuture()
+    future.set_exception(CommandRejected(msg))
+    return future
+
+def wait_complete(timeout=TIMEOUT):
+    '''Wait for the last command to complete, without holding up the status
+    thread. Returns linuxcnc.RCS_DONE, RCS_ERROR, or -1 on timeout.
+    Only call from the command queue thread.'''
+    serial = command.serial
+    start = time.time()
+    status.invalidate()
+    while time.time() - start < timeout:
+        worker_stat.poll(MAX_AGE)
+        # Snapshots from before the command are never returned after
+        # invalidate(), so these are the results of the command
+        if worker_stat.echo_serial_number >= serial \
+                and worker_stat.state != linuxcnc.RCS_EXEC:
+            return worker_stat.state
+        time.sleep(.005)
+    log.warning('Timed out waiting for command to complete')
+    return -1
 
 def estop():
-    set_state(linuxcnc.STATE_ESTOP)
+    '''E-stop immediately, dropping any queued commands.'''
+    queue.clear()
+    urgent_command.state(linuxcnc.STATE_ESTOP)
+    status.invalidate()
+    return _done()
 
 def estop_reset():
-    set_state(linuxcnc.STATE_ESTOP_RESET)
+    return set_state(linuxcnc.STATE_ESTOP_RESET)
 
 def machine_off():
-    set_state(linuxcnc.STATE_OFF)
+    return set_state(linuxcnc.STATE_OFF)
 
 def machine_on():
-    set_state(linuxcnc.STATE_ON)
+    return set_state(linuxcnc.STATE_ON)
 
 def mist_on():
-    command.mist(1)
+    return queue.put(command.mist, 1)
 
 def mist_off():
-    command.mist(0)
+    return queue.put(command.mist, 0)
 
 def flood_on():
-    command.flood(1)
+    return queue.put(command.flood, 1)
 
 def flood_off():
-    command.flood(0)
+    return queue.put(command.flood, 0)
 
-def auto_run(start_line=0):
-    '''Run loaded program if OK to do so.'''
+def auto_run(start_line=0, max_age=MAX_AGE):
+    '''Run loaded program if OK to do so. Returns a future, which has a
+    CommandRejected exception if the program can't be run.'''
 
-    stat.poll()
-    msg = None
+    stat.poll(max_age)
     if stat.estop:
         msg = "Can't run program when estoped"
     elif not stat.enabled:
         msg = "Can't run program when not enabled"
-    elif not no_force_homing if no_force_homing else not is_homed():
+    elif not no_force_homing if no_force_homing else not stat.all_homed:
         msg = "Can't run program when not homed"
     elif not stat.interp_state == linuxcnc.INTERP_IDLE:
         msg = "Can't run program when interpreter is not idle"
@@ -77,18 +264,22 @@ def auto_run(start_line=0):
         msg = "Can't run program when no file loaded"
     else:
         set_mode(linuxcnc.MODE_AUTO)
-        command.auto(linuxcnc.AUTO_RUN, start_line)
+        future = queue.put(command.auto, linuxcnc.AUTO_RUN, start_line)
         info = "Running the program '{}' from line {}".format(stat.file, start_line)
         notifications.show_success(info, "Program Started!")
         log.info(info)
-    if msg:
-        log.error(msg)
-        notifications.show_error(msg)
-        return msg
+        return future
+    log.error(msg)
+    notifications.show_error(msg)
+    return _rejected(msg)
 
 def abort():
+    '''Abort immediately, dropping any queued commands.'''
     log.debug('Issuing abort command')
-    command.abort()
+    queue.clear()
+    urgent_command.abort()
+    status.invalidate()
+    return _done()
 
 
 def set_mode(mode):
@@ -97,11 +288,14 @@ def set_mode(mode):
     linuxcnc.MODE_MDI
     linuxcnc.MODE_AUTO
     '''
-    stat.poll()
-    if stat.task_mode == mode:
+    return queue.put(_set_mode, mode, merge='mode')
+
+def _set_mode(mode):
+    worker_stat.poll(MAX_AGE)
+    if worker_stat.task_mode == mode:
         return
     command.mode(mode)
-    command.wait_complete()
+    return wait_complete()
 
 def set_state(state):
     '''Set state to one of
@@ -110,11 +304,16 @@ def set_state(state):
     linuxcnc.STATE_ON
     linuxcnc.STATE_OFF
     '''
-    stat.poll()
-    if stat.task_state == state:
+    if state == linuxcnc.STATE_ESTOP:
+        return estop()
+    return queue.put(_set_state, state, merge='state')
+
+def _set_state(state):
+    worker_stat.poll(MAX_AGE)
+    if worker_stat.task_state == state:
         return
     command.state(state)
-    command.wait_complete()
+    return wait_complete()
 
 def set_motion_mode(mode):
     '''Set motion mode to one of
@@ -122,73 +321,80 @@ def set_motion_mode(mode):
     linuxcnc.TRAJ_MODE_TELEOP
     linuxcnc.TRAJ_MODE_COORD
     '''
-    stat.poll()
-    if stat.motion_mode == mode:
+    return queue.put(_set_motion_mode, mode, merge='motion_mode')
+
+def _set_motion_mode(mode):
+    worker_stat.poll(MAX_AGE)
+    if worker_stat.motion_mode == mode:
         return
     command.teleop_enable(0)
     command.traj_mode(mode)
-    command.wait_complete()
+    return wait_complete()
 
-def load_file(fname):
+def load_file(fname, max_age=MAX_AGE):
+    stat.poll(max_age)
     if stat.file != "":
         # Is this needed?
         set_mode(linuxcnc.MODE_MDI)
         set_mode(linuxcnc.MODE_AUTO)
-    command.program_open(fname)
+    return queue.put(command.program_open, fname)
 
-def issue_mdi(mdi_command):
-    '''Issue an MDI command if OK to do so.'''
-    stat.poll()
+def issue_mdi(mdi_command, max_age=MAX_AGE):
+    '''Issue an MDI command if OK to do so. Returns a future, which has a
+    CommandRejected exception if the command can't be issued.'''
+    stat.poll(max_age)
     if stat.estop:
-        log.error("Can't issue MDI when estoped")
+        msg = "Can't issue MDI when estoped"
     elif not stat.enabled:
-        log.error("Can't issue MDI when not enabled")
-    elif not no_force_homing if no_force_homing else not is_homed():
-        log.error("Can't issue MDI when not homed")
+        msg = "Can't issue MDI when not enabled"
+    elif not no_force_homing if no_force_homing else not stat.all_homed:
+        msg = "Can't issue MDI when not homed"
     elif not stat.interp_state == linuxcnc.INTERP_IDLE:
-        log.error("Can't issue MDI when interpreter is not idle")
+        msg = "Can't issue MDI when interpreter is not idle"
     else:
         # Lets do this!
         set_mode(linuxcnc.MODE_MDI)
         log.info("Issuing MDI command: {0}".format(mdi_command))
-        command.mdi(mdi_command)
+        return queue.put(command.mdi, mdi_command)
 #        set_mode(linuxcnc.MODE_MANUAL) # This blocks??
+    log.error(msg)
+    return _rejected(msg)
 
-def set_work_coordinate(axis, position):
+def set_work_coordinate(axis, position, max_age=MAX_AGE):
     '''Set the current coordinates for `axis` to `position`.
     Args:
         axis (str): The axis for which to set the coordinates
         position (float): The desired new coordinates for the axis
     '''
-    stat.poll()
+    stat.poll(max_age)
     cmd = 'G10 L20 P{0:d} {1}{2:.12f}'.format(stat.g5x_index, axis.upper(), position)
-    issue_mdi(cmd)
-    set_mode(linuxcnc.MODE_MANUAL)
+    issue_mdi(cmd, max_age)
+    return set_mode(linuxcnc.MODE_MANUAL)
 
 def home_joint(joint):
     '''Home/Unhome the specified joint, -1 for all.'''
     set_mode(linuxcnc.MODE_MANUAL)
-    stat.poll()
-    if not stat.estop and stat.enabled \
-     and not stat.joint[joint]['homed'] and not stat.joint[joint]['homing']:
+    return queue.put(_home_joint, joint)
+
+def _home_joint(joint):
+    worker_stat.poll(MAX_AGE)
+    if not worker_stat.estop and worker_stat.enabled \
+     and not worker_stat.joint[joint]['homed'] and not worker_stat.joint[joint]['homing']:
         log.info("Homing joint {0}".format(joint))
         command.home(joint)
-    elif stat.joint[joint]['homed']:
+    elif worker_stat.joint[joint]['homed']:
         log.info("joint {0} is already homed, unhoming".format(joint))
-        set_motion_mode(linuxcnc.TRAJ_MODE_FREE)
+        _set_motion_mode(linuxcnc.TRAJ_MODE_FREE)
         command.unhome(joint)
-    elif stat.joint[joint]['homing']:
+    elif worker_stat.joint[joint]['homing']:
         log.error("Homing sequence already in progress")
     else:
         log.error("Can't home joint {0}, check E-stop and machine power".format(joint))
 
-def is_homed():
+def is_homed(max_age=MAX_AGE):
     '''Returns TRUE if all joints are homed.'''
-    stat.poll()
-    for joint in range(num_joints):
-        if not stat.joint[joint]['homed']:
-            return False
-    return True
+    stat.poll(max_age)
+    return stat.all_homed
 
 def is_moving():
     '''Returns TRUE if machine is moving due to MDI, program execution, etc.'''
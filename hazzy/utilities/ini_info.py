@@ -159,6 +159,111 @@ def get_position_feedback():
     else:
         return False
 
+def get_status_poll_rate():
+    # rate in Hz at which the status thread polls linuxcnc.stat
+    temp = ini.find('DISPLAY', 'STATUS_POLL_RATE')
+    if not temp:
+        return 100.0
+    try:
+        rate = float(temp)
+    except ValueError:
+        rate = 0
+    if rate <= 0:
+        log.warning("Invalid [DISPLAY] STATUS_POLL_RATE '{}', using 100Hz".format(temp))
+        return 100.0
+    return rate
+
+def get_dro_refresh_rate():
+    # rate in Hz at which the DROs are redrawn, independent of the status poll rate
+    temp = ini.find('DISPLAY', 'DRO_REFRESH_RATE')
+    if not temp:
+        return 30.0
+    try:
+        rate = float(temp)
+    except ValueError:
+        rate = 0
+    if rate <= 0:
+        log.warning("Invalid [DISPLAY] DRO_REFRESH_RATE '{}', using 30Hz".format(temp))
+        return 30.0
+    return rate
+
+def get_preview_cache_dir():
+    temp = ini.find('DISPLAY', 'PREVIEW_CACHE_DIR')
+    if not temp:
+        path = os.path.join(CONFIG_DIR, 'preview_cache')
+    elif temp.startswith('~'):
+        path = os.path.expanduser(temp)
+    elif not os.path.isabs(temp):
+        path = os.path.join(CONFIG_DIR, temp)
+    else:
+        path = os.path.realpath(temp)
+    return path
+
+def get_preview_cache_size():
+    # maximum size of the preview cache in MB, 0 disables the cache
+    temp = ini.find('DISPLAY', 'PREVIEW_CACHE_SIZE')
+    if not temp:
+        return 200.0
+    try:
+        size = float(temp)
+    except ValueError:
+        log.warning("Invalid [DISPLAY] PREVIEW_CACHE_SIZE '{}', using 200MB".format(temp))
+        return 200.0
+    return max(size, 0.0)
+
+def get_program_info_file():
+    # index of program line counts, extents and run times
+    temp = ini.find('DISPLAY', 'PROGRAM_INFO_FILE')
+    if not temp:
+        path = os.path.join(CONFIG_DIR, 'program_info.json')
+    elif temp.startswith('~'):
+        path = os.path.expanduser(temp)
+    elif not os.path.isabs(temp):
+        path = os.path.join(CONFIG_DIR, temp)
+    else:
+        path = os.path.realpath(temp)
+    return path
+
+def get_program_search_file():
+    # search index of the programs in PROGRAM_PREFIX
+    temp = ini.find('DISPLAY', 'PROGRAM_SEARCH_FILE')
+    if not temp:
+        path = os.path.join(CONFIG_DIR, 'program_search.idx')
+    elif temp.startswith('~'):
+        path = os.path.expanduser(temp)
+    elif not os.path.isabs(temp):
+        path = os.path.join(CONFIG_DIR, temp)
+    else:
+        path = os.path.realpath(temp)
+    return path
+
+def get_program_search_full_text():
+    # index all the text of programs, not just names, headers and tools
+    temp = ini.find('DISPLAY', 'PROGRAM_SEARCH_FULL_TEXT')
+    if temp and temp.lower() in ['1', 'true', 'yes']:
+        return True
+    return False
+
+def get_prewarm_widgets():
+    # create the widgets of hidden screens in the background after startup
+    temp = ini.find('DISPLAY', 'PREWARM_WIDGETS')
+    if temp and temp.lower() in ['0', 'false', 'no']:
+        return False
+    return True
+
+def get_widget_catalog_file():
+    # catalog of the widget packages shown in the widget chooser
+    temp = ini.find('DISPLAY', 'WIDGET_CATALOG_FILE')
+    if not temp:
+        path = os.path.join(CONFIG_DIR, 'widget_catalog.json')
+    elif temp.startswith('~'):
+        path = os.path.expanduser(temp)
+    elif not os.path.isabs(temp):
+        path = os.path.join(CONFIG_DIR, temp)
+    else:
+        path = os.path.realpath(temp)
+    return path
+
 def get_is_lathe():
     temp = ini.find('DISPLAY', 'LATHE')
     if not temp or temp == "0":
@@ -285,7 +390,7 @@ def get_subroutine_paths():
     subroutines_paths = ini.find('RS274NGC', 'SUBROUTINE_PATH')
     if not subroutines_paths:
         log.info("No subroutine folder or program prefix given in ini file")
-        subroutines_paths = program_prefix()
+        subroutines_paths = get_program_prefix()
     if not subroutines_paths:
         return False
     return subroutines_paths
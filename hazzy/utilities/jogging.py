@@ -28,12 +28,13 @@ from gi.repository import Gdk
 import linuxcnc
 
 from utilities import preferences as prefs
+from utilities import status
 from utilities.command import is_homed
 from utilities import logger
 
 log = logger.get(__name__)
 
-stat = linuxcnc.stat()
+stat = status.StatProxy()
 command = linuxcnc.command()
 
 
@@ -50,6 +51,18 @@ KEYBINDINGS = {
 
 is_pressed = {}
 
+# Kept up to date by the preferences, so they aren't looked up each jog
+settings = {}
+
+def _set_use_keyboard(value):
+    settings['use_keyboard'] = value
+
+def _set_velocity(value):
+    settings['velocity'] = value
+
+prefs.on_changed('JOGGING', 'USE_KEYBOARD', _set_use_keyboard, 'YES', bool)
+prefs.on_changed('JOGGING', 'VELOCITY', _set_velocity, 1, float)
+
 def on_key_press_event(widget, event):
 
     keyname = Gdk.keyval_name(event.keyval)
@@ -60,7 +73,7 @@ def on_key_press_event(widget, event):
     if is_pressed.get(keyname, False):
         return True
 
-    if not prefs.get('JOGGING', 'USE_KEYBOARD', 'YES', bool):
+    if not settings['use_keyboard']:
         return False
 
     stat.poll()
@@ -99,7 +112,7 @@ def on_key_release_event(widget, event):
 def jog_start(axis):
     JOGMODE = 0
     dir = axis[0]
-    vel = prefs.get("JOGGING", "VELOCITY", 1, float)
+    vel = settings['velocity']
     axis_num = "xyzabcuvw".index(axis[1])
     log.debug("green<STARTED> jogging {} axis".format(axis))
     command.jog(linuxcnc.JOG_CONTINUOUS, JOGMODE, axis_num, float('{}{}'.format(dir, vel)))
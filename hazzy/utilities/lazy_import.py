@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Stand-ins for modules and objects that are slow to import or create,
+#   so the cost is only paid when they are first used, and a check that
+#   the heavy modules have not been imported before the first window is
+#   built.
+
+# Note:
+#   Usage:
+#       etree = lazy_import.lazy_module('lxml.etree')
+#       command = lazy_import.Lazy(linuxcnc.command, 'linuxcnc.command')
+#   The real module or object is created the first time an attribute of
+#   the stand-in is used. This is thread safe.
+
+import sys
+import threading
+import importlib
+
+# Setup logging
+from utilities import logger
+log = logger.get(__name__)
+
+
+# Modules that are only needed by some widgets or features, and must
+# not be imported before the first window is built
+DEFERRED_MODULES = [
+    'lxml',                 # Layout XML file
+    'gi.repository.Gst',    # Video widget
+    'gi.repository.Vte',    # Terminal widget
+    'OpenGL',               # 3D preview
+    'minigl',               # 3D preview
+    'gcode',                # 3D preview
+]
+
+
+class Lazy(object):
+    '''Calls `factory` to create the real object the first time one of
+    its attributes is used.'''
+
+    def __init__(self, factory, name=None):
+        self._factory = factory
+        self._name = name or getattr(factory, '__name__', repr(factory))
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        obj = self._obj
+        if obj is None:
+            with self._lock:
+                if self._obj is None:
+                    log.debug('Loading "{}"'.format(self._name))
+                    self._obj = self._factory()
+                obj = self._obj
+        return obj
+
+    def is_loaded(self):
+        return self._obj is not None
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __repr__(self):
+        if self._obj is None:
+            return '<lazy {}, not loaded>'.format(self._name)
+        return '<lazy {!r}>'.format(self._obj)
+
+
+def lazy_module(name):
+    '''Returns a stand-in for module `name`, which is imported the first
+    time one of its attributes is used.'''
+    return Lazy(lambda: importlib.import_module(name), name)
+
+def get_deferred_imported():
+    '''Returns the DEFERRED_MODULES that have been imported.'''
+    imported = []
+    for name in DEFERRED_MODULES:
+        if sys.modules.get(name) is not None:
+            imported.append(name)
+    return imported
+
+def check_deferred():
+    '''Log an error if any of the DEFERRED_MODULES have been imported.
+    Returns True if none have.'''
+    imported = get_deferred_imported()
+    if imported:
+        log.error('Imported before the first window was built: {}'
+                  .format(', '.join(imported)))
+        return False
+    return True
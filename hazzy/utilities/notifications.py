@@ -35,8 +35,6 @@ gi.require_version('Notify', '0.7')
 
 from gi.repository import Notify
 
-Notify.init("hazzy")
-
 def show_info(body, summary='INFO', timeout=2000):
     show(summary, body, 'dialog-information', timeout)
 
@@ -53,6 +51,10 @@ def show_success(body, summary='SUCCESS!', timeout=2000):
     show(summary, body, 'emblem-default', timeout)
 
 def show(summary, body, icon_name='dialog-error', timeout=5000):
+    # Connecting to the notification server is left until it is needed
+    if not Notify.is_initted():
+        Notify.init("hazzy")
+
     notification = Notify.Notification(summary=summary,
                                         body=body,
                                         icon_name=icon_name)
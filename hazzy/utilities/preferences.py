@@ -20,6 +20,8 @@
 
 # Description:
 #   Persistent preferences manager using INI format .pref file.
+#   Changes are kept in memory and written to the file once no more have
+#   been made for FLUSH_DELAY ms, and when hazzy quits.
 
 
 # Setting Preference:
@@ -30,16 +32,31 @@
 #    get("section", "option", "default_val", type)
 #    dro_places = get("DROs", "dec_places", 3, int)
 
+# Getting notified of changes:
+#    on_changed("section", "option", callback, "default_val", type)
+#    on_changed("DROs", "dec_places", self.set_dec_places, 3, int)
+#    The callback is called with the current value right away, then with
+#    the new value each time the preference is set to a different value.
+
 import os
 import ast
+import copy
+import atexit
+import tempfile
 
 import ConfigParser
 
+from gi.repository import GLib
+
 from utilities import ini_info
+from utilities import profiler
 
 from utilities import logger
 log = logger.get(__name__)
 
+# Time in ms without changes after which they are written to the file
+FLUSH_DELAY = 1000
+
 
 class Preferences(ConfigParser.RawConfigParser):
 
@@ -57,44 +74,128 @@ class Preferences(ConfigParser.RawConfigParser):
 
         self.optionxform = str  # Needed to maintain options case
 
+        # Parsed values by (section, option, type), so getting a value
+        # does not parse the string every time
+        self.cache = {}
+
+        # (section, option) -> [(callback, default_val, opt_type)]
+        self.callbacks = {}
+
+        # Whether there are changes that have not been written yet, and the
+        # timeout that will write them
+        self.dirty = False
+        self.flush_id = None
+
         self.fn = ini_info.get_preference_file()
         if not os.path.isfile(self.fn):
             log.info("No preference file exists, creating: {}".format(self.fn))
 
-        self.read(self.fn)
+        with profiler.span('preferences read'):
+            self.read(self.fn)
 
     def get_pref(self, section, option, default_val=None, opt_type=bool):
+        key = (section, option, opt_type)
         try:
-            getter = self.getters.get(opt_type)
-            value = getter(section, option, default_val)
-            return value
-        except ConfigParser.NoSectionError:
-            # Add the section and the option
-            log.debug("Adding missing section [{0}]".format(section))
-            self.add_section(section)
-            log.debug('Adding missing option [{0}] "{1}"'.format(section, option))
-            self.set(section, option, default_val)
-        except ConfigParser.NoOptionError:
-            # Add the option
-            log.debug('Adding missing option [{0}] "{1}"'.format(section, option))
-            self.set(section, option, default_val)
+            value = self.cache[key]
+        except KeyError:
+            try:
+                getter = self.getters.get(opt_type)
+                value = getter(section, option, default_val)
+            except ConfigParser.NoSectionError:
+                # Add the section and the option
+                log.debug("Adding missing section [{0}]".format(section))
+                self.add_section(section)
+                log.debug('Adding missing option [{0}] "{1}"'.format(section, option))
+                self.set(section, option, default_val)
+                self.schedule_flush()
+                value = default_val
+            except ConfigParser.NoOptionError:
+                # Add the option
+                log.debug('Adding missing option [{0}] "{1}"'.format(section, option))
+                self.set(section, option, default_val)
+                self.schedule_flush()
+                value = default_val
+            self.cache[key] = value
 
-        with open(self.fn, "w") as fh:
-            self.write(fh)
-
-        return default_val
+        if isinstance(value, (list, dict)):
+            # Don't let the caller change the cached value
+            return copy.deepcopy(value)
+        return value
 
     def set_pref(self, section, option, value):
+        value = str(value)
+        try:
+            if self.get(section, option) == value:
+                return
+        except ConfigParser.Error:
+            pass
+
         try:
-            self.set(section, option, str(value))
+            self.set(section, option, value)
         except ConfigParser.NoSectionError:
             # Add the section and the option
             log.debug('Adding missing option [{0}] "{1}"'.format(section, option))
             self.add_section(section)
-            self.set(section, option, str(value))
+            self.set(section, option, value)
 
-        with open(self.fn, "w") as fh:
-            self.write(fh)
+        for key in self.cache.keys():
+            if key[:2] == (section, option):
+                del self.cache[key]
+
+        self.schedule_flush()
+        self.notify(section, option)
+
+    def on_changed(self, section, option, callback, default_val=None, opt_type=bool):
+        """Call `callback` with the value of the preference as `opt_type`
+        now, and again each time it changes."""
+        callbacks = self.callbacks.setdefault((section, option), [])
+        callbacks.append((callback, default_val, opt_type))
+        callback(self.get_pref(section, option, default_val, opt_type))
+
+    def remove_callback(self, section, option, callback):
+        callbacks = self.callbacks.get((section, option), [])
+        callbacks[:] = [item for item in callbacks if item[0] != callback]
+
+    def notify(self, section, option):
+        for callback, default_val, opt_type in list(self.callbacks.get((section, option), [])):
+            try:
+                callback(self.get_pref(section, option, default_val, opt_type))
+            except Exception as e:
+                log.exception(e)
+
+    def schedule_flush(self):
+        """Write the changes once no more have been made for FLUSH_DELAY ms."""
+        self.dirty = True
+        if self.flush_id is not None:
+            GLib.source_remove(self.flush_id)
+        self.flush_id = GLib.timeout_add(FLUSH_DELAY, self.on_flush_timeout)
+
+    def on_flush_timeout(self):
+        self.flush_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """Write any changes to the preference file now."""
+        if self.flush_id is not None:
+            GLib.source_remove(self.flush_id)
+            self.flush_id = None
+        if not self.dirty:
+            return
+
+        # Write to a temp file and rename, so the preference file is never
+        # left partially written
+        temp = None
+        try:
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(self.fn))
+            with os.fdopen(fd, 'w') as fh:
+                self.write(fh)
+            os.rename(temp, self.fn)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            log.error("Could not save preferences: {}".format(e))
+            if temp is not None and os.path.exists(temp):
+                os.remove(temp)
 
     def get_str(self, section, option, default):
         return self.get(section, option)
@@ -144,8 +245,20 @@ class Preferences(ConfigParser.RawConfigParser):
 
 prefs = Preferences()
 
+# Save any changes that have not been written yet
+atexit.register(prefs.flush)
+
 def set(section, option, value, opt_type=None):
     prefs.set_pref(section, option, value)
 
 def get(section, option, default_val=None, opt_type=None):
     return prefs.get_pref(section, option, default_val, opt_type)
+
+def on_changed(section, option, callback, default_val=None, opt_type=None):
+    prefs.on_changed(section, option, callback, default_val, opt_type)
+
+def remove_callback(section, option, callback):
+    prefs.remove_callback(section, option, callback)
+
+def flush():
+    prefs.flush()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   On-disk cache of parsed g-code previews. Reloading a program that has
+#   not changed restores the toolpath segments, dwells, extents and parse
+#   result from the cache instead of running the interpreter again.
+
+# Note:
+#   The cache key is a hash of the program and everything else that can
+#   change how it is interpreted: the startup code, units, parameter file,
+#   tool table and the o-word subroutine files the program calls. The least
+#   recently used entries are removed when the cache grows over the size
+#   set by [DISPLAY] PREVIEW_CACHE_SIZE.
+
+import os
+import re
+import hashlib
+import tempfile
+import cPickle as pickle
+
+from utilities import ini_info
+
+# Setup logging
+from utilities import logger
+log = logger.get(__name__)
+
+
+# Bump when the format of the cached data changes
+VERSION = 1
+
+SUFFIX = '.preview'
+
+# o<name> call
+SUBROUTINE_CALL = re.compile(r'o\s*<\s*([^>]+?)\s*>\s*call', re.IGNORECASE)
+
+
+class PreviewCache(object):
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.enabled = max_size > 0
+        self.subroutine_dirs = self._get_subroutine_dirs()
+
+        if self.enabled and not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                log.warning("Could not create preview cache directory, "
+                            "caching disabled: {}".format(e))
+                self.enabled = False
+
+    def _get_subroutine_dirs(self):
+        paths = ini_info.get_subroutine_paths() or ''
+        dirs = []
+        for path in paths.split(':'):
+            path = os.path.expanduser(path.strip())
+            if not path:
+                continue
+            if not os.path.isabs(path):
+                path = os.path.join(ini_info.CONFIG_DIR, path)
+            dirs.append(path)
+        prefix = ini_info.get_program_prefix()
+        if prefix not in dirs:
+            dirs.append(prefix)
+        return dirs
+
+    def _find_subroutine(self, name):
+        for path in self.subroutine_dirs:
+            fname = os.path.join(path, name.lower() + '.ngc')
+            if os.path.isfile(fname):
+                return fname
+
+    def _hash_file(self, fname, digest, calls=None):
+        '''Adds the contents of `fname` to `digest`. If `calls` is given
+        the names of the subroutines the file calls are added to it.'''
+        with open(fname, 'rb') as f:
+            for line in f:
+                digest.update(line)
+                if calls is not None and '<' in line:
+                    calls.update(name.lower() for name in SUBROUTINE_CALL.findall(line))
+
+    def get_key(self, filename, *context):
+        '''Returns the cache key for `filename` parsed with `context`, which
+        is anything else that affects the result. Files named in `context`
+        should be passed as ('file', path) so their contents are hashed.'''
+        if not self.enabled:
+            return None
+
+        digest = hashlib.sha1(str(VERSION))
+        for item in context:
+            if isinstance(item, tuple) and len(item) == 2 and item[0] == 'file':
+                digest.update('\0file\0')
+                if item[1] and os.path.isfile(item[1]):
+                    self._hash_file(item[1], digest)
+            else:
+                digest.update('\0' + repr(item))
+
+        # The program and the subroutines it calls, and the ones they call
+        calls = set()
+        digest.update('\0program\0')
+        self._hash_file(filename, digest, calls)
+        done = set()
+        while calls - done:
+            name = min(calls - done)
+            done.add(name)
+            digest.update('\0' + name + '\0')
+            fname = self._find_subroutine(name)
+            if fname is not None:
+                self._hash_file(fname, digest, calls)
+
+        return digest.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.path, key + SUFFIX)
+
+    def load(self, key, canon):
+        '''Restores a cached preview into `canon`, which must not have
+        parsed anything. Returns (result, seq), or None on a cache miss.'''
+        if key is None:
+            return None
+
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            log.warning("Removing unreadable preview cache entry: {}".format(e))
+            self._remove(path)
+            return None
+
+        if data.get('version') != VERSION:
+            return None
+
+        canon.offsets.restore(data['offsets'])
+        for name in ('traverse', 'feed', 'arcfeed'):
+            getattr(canon, name).restore(data[name])
+        canon.dwells[:] = data['dwells']
+        (canon.min_extents, canon.max_extents,
+         canon.min_extents_notool, canon.max_extents_notool) = data['extents']
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        log.debug("Loaded preview from cache {}".format(key))
+        return data['result'], data['seq']
+
+    def save(self, key, canon, result, seq):
+        '''Saves the preview parsed by `canon`, including any parse error.'''
+        if key is None:
+            return
+
+        data = {
+            'version': VERSION,
+            'result': result,
+            'seq': seq,
+            'offsets': list(canon.offsets.offsets),
+            'traverse': canon.traverse.dump(),
+            'feed': canon.feed.dump(),
+            'arcfeed': canon.arcfeed.dump(),
+            'dwells': list(canon.dwells),
+            'extents': (canon.min_extents, canon.max_extents,
+                        canon.min_extents_notool, canon.max_extents_notool),
+        }
+
+        # Write to a temp file and rename, so a reader never sees a
+        # partially written entry
+        temp = None
+        try:
+            fd, temp = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, self._get_path(key))
+        except (IOError, OSError) as e:
+            log.warning("Could not save preview to cache: {}".format(e))
+            if temp is not None:
+                self._remove(temp)
+            return
+
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache is
+        smaller than the maximum size.'''
+        entries = []
+        total = 0
+        for fname in os.listdir(self.path):
+            if not fname.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.path, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            mtime, size, path = entries.pop(0)
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+cache = PreviewCache(ini_info.get_preview_cache_dir(),
+                     ini_info.get_preview_cache_size())
+
+def get_key(filename, *context):
+    return cache.get_key(filename, *context)
+
+def load(key, canon):
+    return cache.load(key, canon)
+
+def save(key, canon, result, seq):
+    cache.save(key, canon, result, seq)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Startup profiler. When hazzy is started with --profile-startup the time
+#   taken by each import and each startup step is recorded, and once the
+#   first frame has been drawn the timings are saved as a Chrome trace
+#   (open it in chrome://tracing) and a summary is logged.
+
+# Note:
+#   This is imported before anything else, so it must only use the
+#   standard library until the logger has been set up. When profiling
+#   is not enabled span() returns a shared do-nothing context manager.
+
+import os
+import sys
+import time
+import json
+import threading
+import __builtin__
+
+
+# Imports that take less than this many seconds are left out of the trace
+MIN_IMPORT_TIME = 0.0005
+
+# Number of lines in the summary
+SUMMARY_LINES = 40
+
+FLAG = '--profile-startup'
+
+start_time = time.time()
+enabled = False
+trace_file = None
+
+_events = []
+_thread_names = {}
+_local = threading.local()
+_import = __builtin__.__import__
+
+
+class Span(object):
+    '''Records the time spent in a `with` block. Spans nest, the time
+    spent in nested spans is subtracted to get the self time.'''
+
+    def __init__(self, name, cat='startup', min_time=0):
+        self.name = name
+        self.cat = cat
+        self.min_time = min_time
+
+    def __enter__(self):
+        stack = _get_stack()
+        stack.append(self)
+        self.children = 0.0
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.time()
+        duration = end - self.start
+        stack = _get_stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += duration
+        if duration >= self.min_time:
+            _add_event(self.name, self.cat, self.start, duration,
+                       self_time=duration - self.children,
+                       depth=len(stack))
+        return False
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_null_span = _NullSpan()
+
+
+def _get_stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+def _add_event(name, cat, start, duration, **args):
+    thread = threading.current_thread()
+    _thread_names[thread.ident] = thread.name
+    _events.append({
+        'name': name,
+        'cat': cat,
+        'ph': 'X',
+        'ts': (start - start_time) * 1e6,
+        'dur': duration * 1e6,
+        'pid': os.getpid(),
+        'tid': thread.ident,
+        'args': args,
+    })
+
+def _profiled_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if fromlist:
+        label = 'from {} import {}'.format(name, ', '.join(fromlist))
+    else:
+        label = 'import {}'.format(name)
+    with Span(label, 'import', MIN_IMPORT_TIME):
+        return _import(name, globals, locals, fromlist, level)
+
+
+def enable(fn=None):
+    '''Start profiling, the trace is saved to `fn` by finish().'''
+    global enabled, trace_file
+    if enabled:
+        return
+    enabled = True
+    trace_file = fn
+    __builtin__.__import__ = _profiled_import
+
+def enable_from_args(argv):
+    '''Enable profiling if `argv` has --profile-startup[=FILE] in it.'''
+    for arg in argv[1:]:
+        if arg == FLAG:
+            enable()
+        elif arg.startswith(FLAG + '='):
+            enable(os.path.expanduser(arg.split('=', 1)[1]))
+    return enabled
+
+def span(name, cat='startup'):
+    '''Returns a context manager that records the time spent in it.'''
+    if not enabled:
+        return _null_span
+    return Span(name, cat)
+
+def mark(name):
+    '''Record an instant event, like the first frame being drawn.'''
+    if not enabled:
+        return
+    thread = threading.current_thread()
+    _thread_names[thread.ident] = thread.name
+    _events.append({
+        'name': name,
+        'cat': 'mark',
+        'ph': 'i',
+        's': 'g',
+        'ts': (time.time() - start_time) * 1e6,
+        'pid': os.getpid(),
+        'tid': thread.ident,
+    })
+
+def get_summary():
+    '''Returns the summary lines, the spans with the most total time first.'''
+    totals = {}
+    for event in _events:
+        if event['ph'] != 'X':
+            continue
+        total, self_time, count = totals.get(event['name'], (0.0, 0.0, 0))
+        totals[event['name']] = (total + event['dur'],
+                                 self_time + event['args']['self_time'] * 1e6,
+                                 count + 1)
+
+    lines = ['{:>9} {:>9} {:>5}  {}'.format('total ms', 'self ms', 'count', 'name')]
+    items = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)
+    for name, (total, self_time, count) in items[:SUMMARY_LINES]:
+        lines.append('{:9.1f} {:9.1f} {:5d}  {}'.format(total / 1000, self_time / 1000,
+                                                        count, name))
+    return lines
+
+def save(fn):
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                 'tid': tid, 'args': {'name': name}}
+                for tid, name in _thread_names.items()]
+    with open(fn, 'w') as fh:
+        json.dump({'traceEvents': metadata + _events,
+                   'displayTimeUnit': 'ms'}, fh)
+
+def finish():
+    '''Stop profiling, save the trace and log the summary.'''
+    global enabled
+    if not enabled:
+        return
+    mark('ready')
+    enabled = False
+    __builtin__.__import__ = _import
+
+    from utilities import logger
+    log = logger.get(__name__)
+
+    fn = trace_file
+    if fn is None:
+        fn = os.path.join(os.environ.get('CONFIG_DIR', os.getcwd()),
+                          'hazzy_startup_trace.json')
+    try:
+        save(fn)
+        log.info('Saved startup trace to "{}"'.format(fn))
+    except (IOError, OSError) as e:
+        log.error('Could not save startup trace: {}'.format(e))
+
+    log.info('Startup took {:.3f} s\n{}'.format(time.time() - start_time,
+                                                '\n'.join(get_summary())))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Persistent index of program file info: line count, size, mtime and,
+#   once the program has been loaded in the preview, its extents and
+#   estimated run time. Saved as JSON in the config dir so big programs
+#   don't have to be read again to show their line count.
+
+# Note:
+#   Entries are keyed by path and are only used while the size and mtime
+#   of the file still match. Line counting and saving are done in a
+#   worker thread, callbacks are called on the GTK thread.
+
+import os
+import json
+import tempfile
+import threading
+import collections
+
+from gi.repository import GLib
+
+from utilities import ini_info
+from utilities import toolpath
+from utilities.constants import Units
+
+# Setup logging
+from utilities import logger
+log = logger.get(__name__)
+
+
+# Bump when the format of the index changes
+VERSION = 1
+
+# Bytes read at a time when counting lines
+BUF_SIZE = 1024 * 1024
+
+# Traverse rate used to estimate run times, in the inches per second the
+# preview canon works in
+MAX_VELOCITY = ini_info.get_max_velocity() / 60
+if ini_info.get_machine_units() == Units.MM:
+    MAX_VELOCITY /= 25.4
+
+
+def count_lines(filename):
+    lines = 0
+    with open(filename, 'rb') as fh:
+        read_f = fh.read
+        buf = read_f(BUF_SIZE)
+        while buf:
+            lines += buf.count('\n')
+            buf = read_f(BUF_SIZE)
+    return lines + 1
+
+
+class ProgramInfo(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        self.jobs = collections.deque()
+        self.condition = threading.Condition()
+
+        self._load()
+
+        self.thread = threading.Thread(target=self._run, name='ProgramInfo')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _load(self):
+        try:
+            with open(self.fn) as fh:
+                data = json.load(fh)
+        except (IOError, OSError):
+            return
+        except ValueError as e:
+            log.warning("Ignoring unreadable program info file: {}".format(e))
+            return
+        if data.get('version') == VERSION:
+            self.entries = data.get('files', {})
+
+    def _save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {'version': VERSION, 'files': dict(self.entries)}
+            self.dirty = False
+
+        # Write to a temp file and rename, so the index is never left
+        # partially written
+        temp = None
+        try:
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(self.fn))
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(data, fh)
+            os.rename(temp, self.fn)
+        except (IOError, OSError) as e:
+            log.warning("Could not save program info: {}".format(e))
+            if temp is not None and os.path.exists(temp):
+                os.remove(temp)
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def get(self, path):
+        '''Returns a dict of the info known about `path`, or None if there
+        is none or the file has changed since it was indexed.'''
+        path = os.path.realpath(path)
+        key = self._stat(path)
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or (entry['size'], entry['mtime']) != key:
+                return None
+            return dict(entry)
+
+    def update(self, path, **info):
+        '''Add info about `path`, for example extents=... or runtime=...
+        Can be called from any thread.'''
+        path = os.path.realpath(path)
+        key = self._stat(path)
+        if key is None:
+            return
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or (entry['size'], entry['mtime']) != key:
+                entry = {'size': key[0], 'mtime': key[1]}
+                self.entries[path] = entry
+            entry.update(info)
+            self.dirty = True
+        if threading.current_thread() is not self.thread:
+            self._put(self._save)
+
+    def update_preview(self, path, canon):
+        '''Add the extents and estimated run time of the program parsed
+        by the preview `canon`. Called from the preview parse thread.'''
+        entry = self.get(path)
+        if entry is not None and 'runtime' in entry:
+            return
+        self.update(path,
+                    extents=[list(canon.min_extents), list(canon.max_extents)],
+                    runtime=toolpath.estimate_runtime(canon, MAX_VELOCITY))
+
+    def get_line_count(self, path, callback=None):
+        '''Returns the number of lines in `path`, counting them if needed.
+        If `callback` is given the lines are counted in the background if
+        needed and the count is passed to it instead.'''
+        entry = self.get(path)
+        if entry is not None and 'lines' in entry:
+            lines = entry['lines']
+        elif callback is not None:
+            # Someone is waiting for this, so count it before any scan()
+            self._put(self._index, path, callback, first=True)
+            return None
+        else:
+            lines = self._index(path)
+
+        if callback is not None:
+            callback(path, lines)
+        return lines
+
+    def scan(self, paths):
+        '''Index `paths` in the background, so their info is ready before
+        it is asked for.'''
+        for path in paths:
+            self._put(self._index, path)
+
+    def _index(self, path, callback=None):
+        entry = self.get(path)
+        if entry is not None and 'lines' in entry:
+            lines = entry['lines']
+        else:
+            try:
+                lines = count_lines(path)
+            except (IOError, OSError) as e:
+                log.warning('Could not count lines in "{}": {}'.format(path, e))
+                lines = None
+            else:
+                self.update(path, lines=lines)
+        if callback is not None:
+            GLib.idle_add(callback, path, lines)
+        return lines
+
+    def _put(self, func, *args, **kwargs):
+        with self.condition:
+            if kwargs.get('first'):
+                self.jobs.appendleft((func, args))
+            else:
+                self.jobs.append((func, args))
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                func, args = self.jobs.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                log.exception(e)
+            # Only save once there is nothing else to do
+            if not self.jobs:
+                self._save()
+
+
+index = ProgramInfo(ini_info.get_program_info_file())
+
+def get(path):
+    return index.get(path)
+
+def update(path, **info):
+    index.update(path, **info)
+
+def update_preview(path, canon):
+    index.update_preview(path, canon)
+
+def get_line_count(path, callback=None):
+    return index.get_line_count(path, callback)
+
+def scan(paths):
+    index.scan(paths)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Search index of the programs in the PROGRAM_PREFIX directory. File
+#   names, the comments at the top of each program and the tools it calls
+#   (T words) are indexed, and optionally the full text. The index is
+#   saved in the config dir and kept up to date by watching the program
+#   directories for changes.
+
+# Note:
+#   Searching matches each word of the query against the start of the
+#   indexed words, so "bracket t12" finds "bracket_v2.ngc" if it calls T12.
+#   Indexing is done in a worker thread, searches can be done from any
+#   thread.
+
+import os
+import re
+import time
+import bisect
+import tempfile
+import threading
+import collections
+import cPickle as pickle
+
+from gi.repository import Gio
+from gi.repository import GLib
+
+from utilities import ini_info
+
+# Setup logging
+from utilities import logger
+log = logger.get(__name__)
+
+
+# Bump when the format of the saved index changes
+VERSION = 1
+
+# Max number of results returned by a search
+MAX_RESULTS = 500
+
+# Only the comments in this many lines at the top of a program are indexed
+HEADER_LINES = 50
+
+# Seconds between updates of the sorted tokens while a directory is scanned
+TOKENS_INTERVAL = 1.0
+
+WORD = re.compile(r'[a-z0-9]+')
+TOOL_CALL = re.compile(r'(?<![a-z])t\s*(\d+)')
+COMMENT = re.compile(r'\(([^)]*)\)|;(.*)')
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+class ProgramSearch(object):
+    def __init__(self, path, fn, exts, full_text=False):
+        self.path = os.path.realpath(path)
+        self.fn = fn
+        self.exts = exts
+        self.full_text = full_text
+
+        # id -> (path, size, mtime, tokens) of each indexed file
+        self.docs = {}
+        self.doc_ids = {}
+        self.next_id = 0
+
+        # token -> set of doc ids, and the sorted tokens for prefix search.
+        # The tokens are sorted in the worker thread once the postings have
+        # changed, until then a search may miss the newest tokens
+        self.postings = {}
+        self.tokens = []
+        self.tokens_changed = False
+
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        # Gio.FileMonitor of each directory being watched
+        self.monitors = {}
+
+        self.jobs = collections.deque()
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run, name='ProgramSearch')
+        self.thread.daemon = True
+        self.thread.start()
+
+        self._put(self._load)
+        self._put(self._scan, self.path)
+
+    # =======================================
+    #   Searching
+    # =======================================
+
+    def search(self, query, limit=MAX_RESULTS):
+        '''Returns the sorted paths of the programs matching every word
+        in `query`.'''
+        words = tokenize(query)
+        if not words:
+            return []
+        with self.lock:
+            matches = None
+            # Most selective words first, so the intersection stays small
+            for word in sorted(words, key=len, reverse=True):
+                ids = self._match(word)
+                matches = ids if matches is None else matches & ids
+                if not matches:
+                    return []
+            paths = [self.docs[doc_id][0] for doc_id in matches]
+        paths.sort()
+        return paths[:limit]
+
+    def _match(self, word):
+        ids = set()
+        tokens = self.tokens
+        index = bisect.bisect_left(tokens, word)
+        while index < len(tokens) and tokens[index].startswith(word):
+            # Tokens removed since they were last sorted have no postings
+            ids.update(self.postings.get(tokens[index], ()))
+            index += 1
+        return ids
+
+    # =======================================
+    #   Indexing, in the worker thread
+    # =======================================
+
+    def _is_program(self, name):
+        return os.path.splitext(name)[1].lower() in self.exts
+
+    def _get_tokens(self, path):
+        tokens = set(tokenize(os.path.splitext(os.path.basename(path))[0]))
+        with open(path) as fh:
+            for lnum, line in enumerate(fh):
+                line = line.lower()
+                if lnum < HEADER_LINES or self.full_text:
+                    for comment in COMMENT.findall(line):
+                        tokens.update(tokenize(comment[0] or comment[1]))
+                if self.full_text:
+                    tokens.update(tokenize(line))
+                if 't' in line:
+                    code = COMMENT.sub('', line)
+                    tokens.update('t' + tool for tool in TOOL_CALL.findall(code))
+        return tokens
+
+    def _index(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._remove(path)
+            return
+        doc_id = self.doc_ids.get(path)
+        if doc_id is not None:
+            doc = self.docs[doc_id]
+            if (doc[1], doc[2]) == (st.st_size, st.st_mtime):
+                return
+
+        try:
+            tokens = self._get_tokens(path)
+        except (IOError, OSError) as e:
+            log.warning('Could not index "{}": {}'.format(path, e))
+            return
+
+        with self.lock:
+            self._remove_doc(path)
+            doc_id = self.next_id
+            self.next_id += 1
+            self.docs[doc_id] = (path, st.st_size, st.st_mtime, tokens)
+            self.doc_ids[path] = doc_id
+            for token in tokens:
+                ids = self.postings.get(token)
+                if ids is None:
+                    self.postings[token] = ids = set()
+                    self.tokens_changed = True
+                ids.add(doc_id)
+            self.dirty = True
+
+    def _remove(self, path):
+        '''Remove `path`, or all the files under it if it is a directory.'''
+        with self.lock:
+            if path in self.doc_ids:
+                self._remove_doc(path)
+                return
+            prefix = os.path.join(path, '')
+            for doc_path in self.doc_ids.keys():
+                if doc_path.startswith(prefix):
+                    self._remove_doc(doc_path)
+        GLib.idle_add(self._unwatch, path)
+
+    def _remove_doc(self, path):
+        doc_id = self.doc_ids.pop(path, None)
+        if doc_id is None:
+            return
+        tokens = self.docs.pop(doc_id)[3]
+        for token in tokens:
+            ids = self.postings[token]
+            ids.discard(doc_id)
+            if not ids:
+                del self.postings[token]
+                self.tokens_changed = True
+        self.dirty = True
+
+    def _scan(self, path):
+        '''Index the programs in the `path` directory tree, and remove the
+        ones that no longer exist.'''
+        found = set()
+        dirs = []
+        last_update = time.time()
+        for root, dirnames, filenames in os.walk(path):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            dirs.append(root)
+            for name in filenames:
+                if self._is_program(name):
+                    fname = os.path.join(root, name)
+                    found.add(fname)
+                    self._index(fname)
+
+            # So programs can be found before a long scan has finished
+            if time.time() - last_update > TOKENS_INTERVAL:
+                self._update_tokens()
+                last_update = time.time()
+
+        prefix = os.path.join(path, '')
+        with self.lock:
+            for doc_path in self.doc_ids.keys():
+                if doc_path.startswith(prefix) and doc_path not in found:
+                    self._remove_doc(doc_path)
+
+        GLib.idle_add(self._watch, dirs)
+        log.debug('Indexed {} programs in "{}"'.format(len(found), path))
+
+    def _load(self):
+        try:
+            with open(self.fn, 'rb') as fh:
+                data = pickle.load(fh)
+        except (IOError, OSError):
+            return
+        except Exception as e:
+            log.warning("Ignoring unreadable program search index: {}".format(e))
+            return
+        if data.get('version') != VERSION or data.get('full_text') != self.full_text:
+            return
+        with self.lock:
+            self.docs = data['docs']
+            self.postings = data['postings']
+            self.doc_ids = dict((doc[0], doc_id) for doc_id, doc in self.docs.items())
+            self.next_id = max(self.docs) + 1 if self.docs else 0
+            self.tokens_changed = True
+
+    def _update_tokens(self):
+        if not self.tokens_changed:
+            return
+        self.tokens_changed = False
+        # The postings are only changed in this thread, so they can be
+        # read without the lock
+        tokens = sorted(self.postings)
+        with self.lock:
+            self.tokens = tokens
+
+    def _save(self):
+        if not self.dirty:
+            return
+        # The index is only changed in this thread, so copies of the dicts
+        # can be pickled without holding up searches
+        with self.lock:
+            data = {
+                'version': VERSION,
+                'full_text': self.full_text,
+                'docs': dict(self.docs),
+                'postings': dict(self.postings),
+            }
+            self.dirty = False
+
+        # Write to a temp file and rename, so the index is never left
+        # partially written
+        temp = None
+        try:
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(self.fn))
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(data, fh, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, self.fn)
+        except (IOError, OSError) as e:
+            log.warning("Could not save program search index: {}".format(e))
+            self.dirty = True
+            if temp is not None and os.path.exists(temp):
+                os.remove(temp)
+
+    def _put(self, func, *args):
+        with self.condition:
+            self.jobs.append((func, args))
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                func, args = self.jobs.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                log.exception(e)
+            self._update_tokens()
+            # Only save once there is nothing else to do
+            if not self.jobs:
+                self._save()
+
+    # =======================================
+    #   Watching for changes, in the GTK thread
+    # =======================================
+
+    def _watch(self, dirs):
+        for path in dirs:
+            if path in self.monitors:
+                continue
+            gfile = Gio.File.new_for_path(path)
+            try:
+                monitor = gfile.monitor_directory(Gio.FileMonitorFlags.NONE, None)
+            except GLib.Error as e:
+                log.warning('Could not watch "{}" for changes: {}'.format(path, e.message))
+                continue
+            monitor.connect('changed', self._on_changed)
+            self.monitors[path] = monitor
+        return False
+
+    def _unwatch(self, path):
+        prefix = os.path.join(path, '')
+        for dir_path in self.monitors.keys():
+            if dir_path == path or dir_path.startswith(prefix):
+                self.monitors.pop(dir_path).cancel()
+        return False
+
+    def _on_changed(self, monitor, gfile, other_file, event):
+        path = gfile.get_path()
+        name = os.path.basename(path)
+        if name.startswith('.'):
+            return
+        if event == Gio.FileMonitorEvent.DELETED:
+            self._put(self._remove, path)
+        elif event == Gio.FileMonitorEvent.CREATED and os.path.isdir(path):
+            self._put(self._scan, path)
+        elif event in (Gio.FileMonitorEvent.CREATED,
+                       Gio.FileMonitorEvent.CHANGES_DONE_HINT):
+            if self._is_program(name):
+                self._put(self._index, path)
+
+
+def _get_exts():
+    return [os.path.splitext(ext)[1].lower() for ext in ini_info.get_file_extentions()]
+
+index = ProgramSearch(ini_info.get_program_prefix(),
+                      ini_info.get_program_search_file(),
+                      _get_exts(),
+                      ini_info.get_program_search_full_text())
+
+def search(query, limit=MAX_RESULTS):
+    return index.search(query, limit)
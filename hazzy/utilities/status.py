@@ -20,14 +20,20 @@
 
 # Description:
 #   emit GObject signals for changes to LinuxCNC status or joint attributes.
+#   linuxcnc.stat is polled in a background thread, and the GTK thread is
+#   only woken when something has changed.
 
 # ToDo:
 #   Clean up and possibly rethink
 
 
 import math
-import linuxcnc
 import time
+import bisect
+import operator
+import threading
+import collections
+import linuxcnc
 import gi
 
 from gi.repository import GObject
@@ -77,6 +83,115 @@ SIGNALS = {
     'file-loaded': 'file'
 }
 
+# Signals that are calculated from the position fields
+POSITION_SIGNALS = ('axis-positions', 'joint-positions')
+
+# Fields used internally which are not connected to a signal
+REQUIRED_FIELDS = ('interp_state', 'call_level', 'homed')
+
+# Marks a previous value as unknown, so the next tick will emit
+_UNSET = object()
+
+# Seconds of position samples kept, see Status.get_position()
+POSITION_HISTORY = 2.0
+
+
+class PollPlan(object):
+    '''Compiled description of what to read from linuxcnc.stat each tick.
+
+    The values are read in one pass with an attrgetter and returned as a
+    flat tuple, the position of each field in the tuple is given by `index`.
+    The axis position fields always come first so they can be sliced off.
+
+    The plan is immutable, a new one is compiled whenever a callback is
+    connected to an attribute that is not already being monitored, or a
+    StatProxy reads an attribute that is not in the current plan.
+    '''
+
+    def __init__(self, axis_fields, joint_field, stat_fields, joint_keys,
+                 extra_fields=(), serial=0):
+        self.axis_fields = tuple(axis_fields)
+        self.joint_field = joint_field
+        self.stat_fields = tuple(stat_fields)
+        self.joint_keys = tuple(joint_keys)
+        self.serial = serial
+
+        fields = []
+        for field in self.axis_fields + (joint_field,) + self.stat_fields + tuple(extra_fields):
+            if field not in fields:
+                fields.append(field)
+        if self.joint_keys and 'joint' not in fields:
+            fields.append('joint')
+        self.fields = tuple(fields)
+        self.index = dict((field, i) for i, field in enumerate(self.fields))
+
+        self.getter = operator.attrgetter(*self.fields)
+
+        self.num_axis = len(self.axis_fields)
+        self.joint_pos_index = self.index[joint_field]
+        self.joint_index = self.index.get('joint')
+        self.stat_items = tuple((self.index[field], field) for field in self.stat_fields)
+
+        self.joint_signals = tuple((key, 'joint-{}'.format(key.replace('_', '-')))
+                                   for key in self.joint_keys)
+
+    def snapshot(self, stat):
+        return self.getter(stat)
+
+
+class StatSnapshot(object):
+    '''Read-only view of the linuxcnc.stat values read in a single poll.
+
+    The fields in the snapshot can be accessed the same as linuxcnc.stat
+    attributes, AttributeError is raised for fields that were not polled.
+    `all_homed` is True if all of the machine's joints are homed. `time` is
+    when the last poll that read these values was made.
+    '''
+
+    __slots__ = ('plan', 'values', 'time', 'all_homed')
+
+    def __init__(self, plan, values, time, num_joints):
+        self.plan = plan
+        self.values = values
+        self.time = time
+        self.all_homed = all(values[plan.index['homed']][:num_joints])
+
+    def __getattr__(self, name):
+        try:
+            return self.values[self.plan.index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class StatProxy(object):
+    '''Drop in replacement for linuxcnc.stat() which reads from the snapshots
+    published by the status acquisition thread instead of from NML.
+
+    poll() pins the latest snapshot, so all the attributes read between polls
+    are consistent with each other, the same as they would be with
+    linuxcnc.stat(). The first read of an attribute that is not in the
+    snapshot falls back to the acquisition thread's stat object and the
+    attribute is included in all subsequent snapshots.
+    '''
+
+    def __init__(self, source=None):
+        self._status = source or status
+        self._snapshot = None
+
+    def poll(self, max_age=None):
+        self._snapshot = self._status.get_snapshot(max_age)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._snapshot is None:
+            self.poll()
+        try:
+            return getattr(self._snapshot, name)
+        except AttributeError:
+            return self._status.read(name)
+
+
 class Status(GObject.GObject):
     __gtype_name__ = 'Status'
     __gsignals__ = {
@@ -86,6 +201,7 @@ class Status(GObject.GObject):
         'joint-positions': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
         'axis-positions': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
         'error': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
+        'snapshot': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
     }
 
     def __init__(self, stat=None):
@@ -93,28 +209,68 @@ class Status(GObject.GObject):
 
         self.signals = GObject.signal_list_names(self)
 
+        # Only ever polled from the acquisition thread, or under self.lock
         self.stat = stat or linuxcnc.stat()
         self.error = linuxcnc.error_channel()
+        self.lock = threading.Lock()
+
+        self.poll_rate = ini_info.get_status_poll_rate()
 
         self.report_actual_position = ini_info.get_position_feedback()
         axes = ini_info.get_axis_list()
         self.axis_list = ['xyzabcuvw'.index(axis) for axis in axes]
         self.num_joints = ini_info.get_num_joints()
 
+        if self.report_actual_position:
+            self.pos_field = 'actual_position'
+            self.joint_pos_field = 'joint_actual_position'
+        else:
+            self.pos_field = 'position'
+            self.joint_pos_field = 'joint_position'
+
         self.file = None
 
+        # Attributes and joint keys which have callbacks connected, and
+        # attributes read through a StatProxy
         self.registry = []
-        self.old = {}
-
-        self.old['joint'] = getattr(self.stat, 'joint')
+        self.joint_registry = []
+        self.required = list(REQUIRED_FIELDS)
+
+        # Bumped whenever the lists above change, the acquisition
+        # thread compiles a new plan when it no longer matches
+        self.plan_serial = 0
+        self.plan = None
+
+        # Double buffered snapshots, written only by the acquisition thread
+        self.buffers = [None, None]
+        self.buffer_index = 0
+        self.invalidated = 0
+        self.errors = collections.deque()
+        self.pending = False
+
+        # (time, position) of every poll, newest last, so position readers
+        # can sample at their own rate, see get_position()
+        history = max(int(POSITION_HISTORY * self.poll_rate), 2)
+        self.samples = collections.deque(maxlen=history)
+        self.samples_lock = threading.Lock()
+
+        # GTK thread state, the previous values laid out the same as the plan
+        self.snapshot = None
+        self.old_plan = None
+        self.old = ()
+        self.old_joints = None
+        self.forced = set()
 
         # Setup joint dict signals
-        self.joint_keys = self.old['joint'][0].keys() # keys() is slow, but we only use it on init
+        self.joint_keys = self.stat.joint[0].keys() # keys() is slow, but we only use it on init
         for key in self.joint_keys:
             key = 'joint-{}'.format(key)
             GObject.signal_new(key.replace('_', '-'), self, GObject.SignalFlags.RUN_FIRST, None, (int, object))
 
+        # Per tick timing of the acquisition thread, see get_timing()
         self.max_time = 0
+        self.last_time = 0
+        self.total_time = 0
         self.counter = 0
 
         # Connect internally used signal callbacks
@@ -122,7 +278,12 @@ class Status(GObject.GObject):
         self.on_changed('stat.mcodes', self._update_active_mcodes)
         self.on_changed('stat.file', self._update_file)
 
-        GLib.timeout_add(50, self._periodic)
+        # Do one poll now, so there is a snapshot before the thread starts
+        self._poll()
+
+        self.thread = threading.Thread(target=self._acquire, name='StatusAcquisition')
+        self.thread.daemon = True
+        self.thread.start()
 
     # This allows monitoring any of the linuxcnc.stat attributes
     # and connecting a callback to be called on attribute value change
@@ -135,14 +296,18 @@ class Status(GObject.GObject):
                     and attribute not in self.registry:
                 GObject.signal_new(attribute, self, GObject.SignalFlags.RUN_FIRST, None, (object,))
                 self.registry.append(attribute)
+                self.plan_serial += 1
 
             self.connect(attribute, callback)
 
             # Cause update
             if attribute in SIGNALS.keys():
-                self.old[SIGNALS[attribute]] = None
+                self._force_update(SIGNALS[attribute])
+            elif attribute.replace('_', '-') in POSITION_SIGNALS:
+                self._force_update(self.pos_field)
+                self._force_update(self.joint_pos_field)
             else:
-                self.old[attribute] = None
+                self._force_update(attribute)
 
         else:
             log.error('linuxcnc.stat object has no attribute "{}"'.format(attribute))
@@ -151,6 +316,12 @@ class Status(GObject.GObject):
         if attribute in self.joint_keys:
             sig_name = 'joint-{}'.format(attribute)
             self.connect(sig_name, callback)
+            if attribute not in self.joint_registry:
+                self.joint_registry.append(attribute)
+                self.plan_serial += 1
+            # Cause update
+            self.old_joints = None
+            self._wake()
         else:
             log.error('linuxcnc.stat.joint object has no attribute "{}"'.format(attribute))
 
@@ -161,57 +332,256 @@ class Status(GObject.GObject):
         elif kind == 'joint':
             self._connect_joint_callback(name, callback)
 
-
-    def _periodic(self):
-#        start_time = time.time()
-        try:
-
+    def get_snapshot(self, max_age=None):
+        '''Returns the most recent StatSnapshot.
+
+        If `max_age` is given, and the last poll was more than `max_age`
+        seconds ago or before the last call to invalidate(), stat is polled
+        directly instead of waiting for the acquisition thread.
+        '''
+        snapshot = self.buffers[self.buffer_index]
+        if max_age is None:
+            return snapshot
+
+        # The time is read from the snapshot itself, so a snapshot from
+        # before invalidate() is never taken for a newer one
+        poll_time = snapshot.time
+        if poll_time >= self.invalidated and time.time() - poll_time <= max_age:
+            return snapshot
+
+        plan = snapshot.plan
+        with self.lock:
+            poll_time = time.time()
             self.stat.poll()
+            values = plan.snapshot(self.stat)
+        return StatSnapshot(plan, values, poll_time, self.num_joints)
+
+    def invalidate(self):
+        '''Mark the current snapshot as out of date, should be called after
+        issuing a command so get_snapshot(max_age) won't return stale values.'''
+        self.invalidated = time.time()
+
+    def read(self, attribute):
+        '''Read an attribute that is not in the snapshots directly from the
+        acquisition thread's stat object, and add it to subsequent snapshots.'''
+        with self.lock:
+            value = getattr(self.stat, attribute)
+        if attribute not in self.required and not callable(value):
+            self.required.append(attribute)
+            self.plan_serial += 1
+        return value
+
+    def _force_update(self, field):
+        # Mark the previous value of field as unknown so it will
+        # be emitted on the next dispatch
+        self.forced.add(field)
+        self._wake()
+
+    def _apply_forced(self, plan):
+        old = list(self.old)
+        for field in list(self.forced):
+            index = plan.index.get(field)
+            if index is not None:
+                old[index] = _UNSET
+                self.forced.discard(field)
+        self.old = tuple(old)
+
+    def _compile_plan(self):
+        serial = self.plan_serial
+        axis_fields = (self.pos_field, 'dtg', 'g5x_offset', 'g92_offset',
+                       'tool_offset', 'rotation_xy')
+        plan = PollPlan(axis_fields, self.joint_pos_field, tuple(self.registry),
+                        tuple(self.joint_registry), tuple(self.required), serial)
+        log.debug('Compiled status poll plan with {} fields'.format(len(plan.fields)))
+        return plan
+
+    # Acquisition thread
+
+    def _acquire(self):
+        interval = 1.0 / self.poll_rate
+        while True:
+            start_time = time.time()
+            try:
+                self._poll()
+            except Exception as e:
+                log.exception(e)
+            elapsed = time.time() - start_time
+            self._update_timing(elapsed)
+            if elapsed < interval:
+                time.sleep(interval - elapsed)
+
+    def get_position(self, at=None):
+        '''Returns (time, position) of the newest position sample. Can be
+        called from any thread.
+
+        If `at` is given the position at that time is interpolated from
+        the samples either side of it. Times outside of the last
+        POSITION_HISTORY seconds get the oldest or newest sample. Returns
+        None if there are no samples yet.
+        '''
+        with self.samples_lock:
+            if not self.samples:
+                return None
+            if at is None or at >= self.samples[-1][0]:
+                return self.samples[-1]
+            samples = list(self.samples)
+
+        times = [sample[0] for sample in samples]
+        index = bisect.bisect_right(times, at)
+        if index == 0:
+            return samples[0]
+        (t0, p0), (t1, p1) = samples[index - 1], samples[index]
+        frac = (at - t0) / (t1 - t0)
+        return at, tuple(a + (b - a) * frac for a, b in zip(p0, p1))
+
+    def get_positions(self, since=0):
+        '''Returns the (time, position) samples newer than `since`, oldest
+        first. Can be called from any thread. Returns an empty list if
+        there are no samples yet.'''
+        with self.samples_lock:
+            samples = list(self.samples)
+        times = [sample[0] for sample in samples]
+        return samples[bisect.bisect_right(times, since):]
+
+    def get_velocity(self, period=0.1):
+        '''Returns the XYZ speed in machine units per second, averaged over
+        the last `period` seconds of position samples. Returns None if
+        there are no samples yet.'''
+        newest = self.get_position()
+        if newest is None:
+            return None
+        t1, p1 = newest
+        t0, p0 = self.get_position(t1 - period)
+        if t1 <= t0:
+            return 0.0
+        return math.sqrt(sum((b - a) ** 2 for a, b in zip(p0[:3], p1[:3]))) / (t1 - t0)
+
+    def _poll(self):
+        plan = self.plan
+        if plan is None or plan.serial != self.plan_serial:
+            plan = self.plan = self._compile_plan()
+
+        with self.lock:
+            poll_time = time.time()
+            self.stat.poll()
+            values = plan.snapshot(self.stat)
+
+        sample = (poll_time, values[plan.index[self.pos_field]])
+        with self.samples_lock:
+            self.samples.append(sample)
+
+        # Check for errors
+        error = self.error.poll()
+        if error:
+            self.errors.append(error)
+            self._wake()
+
+        # Only publish a new snapshot if something changed
+        current = self.buffers[self.buffer_index]
+        if current is None or current.plan is not plan or current.values != values:
+            index = 1 - self.buffer_index
+            self.buffers[index] = StatSnapshot(plan, values, poll_time, self.num_joints)
+            self.buffer_index = index
+            self._wake()
+        else:
+            # Nothing changed, but the values are as of this poll
+            current.time = poll_time
 
-            # Status updates
-            for attribute in self.registry:
-                old = self.old[attribute]
-
-                new = getattr(self.stat, attribute)
-
-                if old != new:
-                    self.old[attribute] = new
-                    self.emit(attribute, new)
+    def _wake(self):
+        # Schedule a dispatch on the GTK thread, unless one is already pending
+        if not self.pending:
+            self.pending = True
+            GLib.idle_add(self._dispatch)
 
-            # Joint updates
-            new = getattr(self.stat, 'joint')
-            old = self.old['joint']
-            self.old['joint'] = new
+    # GTK thread
 
-#            start = time.time()
-            for joint in range(self.num_joints):
-                if new[joint] != old[joint]:
-                    #print '\nJoint {}'.format(joint)
-                    changed_items = tuple(set(new[joint].items())-set(old[joint].items()))
-                    for item in changed_items:
-#                        print 'JOINT_{0} {1}: {2}'.format(joint, item[0], item[1])
-                        key = 'joint-{}'.format(item[0].replace('_', '-'))
-                        self.emit(key, joint, item[1])
-
-#            print start - time.time()
-
-#            # Always update joint/axis positions
-            calc = time.time()
-            self._update_axis_positions()
-            self._update_joint_positions()
-#            print 'Calc time: ', time.time() - calc
-
-            # Check for errors
-            error = self.error.poll()
-            if error:
-                self._on_error(error)
+    def _dispatch(self):
+        self.pending = False
+        try:
+            while self.errors:
+                self._on_error(self.errors.popleft())
+
+            snapshot = self.get_snapshot()
+            if snapshot is not None:
+                self.snapshot = snapshot
+                plan = snapshot.plan
+                if plan is not self.old_plan:
+                    self._carry_over(plan)
+                if self.forced:
+                    self._apply_forced(plan)
+                self._process(plan, snapshot.values)
+                self.emit('snapshot', snapshot)
 
         except Exception as e:
             log.exception(e)
 
-#        print 'Loop time: ', time.time() - start_time
+        return False
 
-        return True
+    def _carry_over(self, plan):
+        # Carry over the previous values for fields that were already
+        # monitored, anything new is unset so it will be emitted.
+        if self.old_plan is not None:
+            previous = dict(zip(self.old_plan.fields, self.old))
+        else:
+            previous = {}
+        self.old = tuple(previous.get(field, _UNSET) for field in plan.fields)
+        self.old_plan = plan
+
+    def _process(self, plan, new):
+        old = self.old
+        self.old = new
+
+        # Status updates
+        for index, attribute in plan.stat_items:
+            value = new[index]
+            if value != old[index]:
+                self.emit(attribute, value)
+
+        # Joint updates
+        if plan.joint_keys:
+            new_joints = new[plan.joint_index]
+            old_joints = self.old_joints
+            self.old_joints = new_joints
+            for joint in range(self.num_joints):
+                new_joint = new_joints[joint]
+                old_joint = old_joints[joint] if old_joints else None
+                if new_joint == old_joint:
+                    continue
+                for key, signal in plan.joint_signals:
+                    value = new_joint[key]
+                    if old_joint is None or old_joint[key] != value:
+                        self.emit(signal, joint, value)
+
+        # Only update joint/axis positions if something moved
+        num_axis = plan.num_axis
+        if new[:num_axis] != old[:num_axis]:
+            self._update_axis_positions(*new[:num_axis])
+
+        index = plan.joint_pos_index
+        if new[index] != old[index]:
+            self.emit('joint-positions', new[index])
+
+    def _update_timing(self, elapsed):
+        self.last_time = elapsed
+        self.total_time += elapsed
+        self.counter += 1
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    def get_timing(self):
+        '''Returns a dict of the acquisition loop timing statistics, in seconds.'''
+        return {
+            'ticks': self.counter,
+            'last': self.last_time,
+            'max': self.max_time,
+            'mean': self.total_time / self.counter if self.counter else 0,
+        }
+
+    def reset_timing(self):
+        self.max_time = 0
+        self.last_time = 0
+        self.total_time = 0
+        self.counter = 0
 
     def _update_active_gcodes(self, widget, gcodes):
         formated_gcodes = []
@@ -233,29 +603,19 @@ class Status(GObject.GObject):
         self.emit('formated-mcodes', formated_mcodes)
 
     def _update_file(self, widget, file):
-        if self.stat.interp_state == linuxcnc.INTERP_IDLE \
-                and self.stat.call_level == 0:
+        if self.snapshot.interp_state == linuxcnc.INTERP_IDLE \
+                and self.snapshot.call_level == 0:
             self.emit('file-loaded', file)
             log.debug('File loaded: "{}"'.format(file))
 
-    def _update_axis_positions(self):
-
-        if self.report_actual_position:
-            pos = self.stat.actual_position
-        else:
-            pos = self.stat.position
-
-        dtg = self.stat.dtg
-        g5x_offset = self.stat.g5x_offset
-        g92_offset = self.stat.g92_offset
-        tool_offset = self.stat.tool_offset
+    def _update_axis_positions(self, pos, dtg, g5x_offset, g92_offset, tool_offset, rotation_xy):
 
         rel = [0] * 9
         for axis in self.axis_list:
             rel[axis] = pos[axis] - g5x_offset[axis] - tool_offset[axis]
 
-        if self.stat.rotation_xy != 0:
-            t = math.radians(-self.stat.rotation_xy)
+        if rotation_xy != 0:
+            t = math.radians(-rotation_xy)
             xr = rel[0] * math.cos(t) - rel[1] * math.sin(t)
             yr = rel[0] * math.sin(t) + rel[1] * math.cos(t)
             rel[0] = xr
@@ -266,15 +626,6 @@ class Status(GObject.GObject):
 
         self.emit('axis-positions', tuple([pos, tuple(rel), tuple(dtg)]))
 
-    def _update_joint_positions(self):
-
-        if self.report_actual_position:
-            pos = self.stat.joint_actual_position
-        else:
-            pos = self.stat.joint_position
-
-        self.emit('joint-positions', pos)
-
     def _on_error(self, error):
         kind, msg = error
 
@@ -313,6 +664,21 @@ status = Status()
 def on_changed(attribute, callback):
     status.on_changed(attribute, callback)
 
+def get_position(at=None):
+    return status.get_position(at)
+
+def get_positions(since=0):
+    return status.get_positions(since)
+
+def get_velocity(period=0.1):
+    return status.get_velocity(period)
+
+def get_snapshot(max_age=None):
+    return status.get_snapshot(max_age)
+
+def invalidate():
+    status.invalidate()
+
 # These are used only for logging purposes
 def _log_task_state(widget, task_state):
     state_str = STATES.get(task_state, 'UNKNOWN')
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Compact storage for the toolpath segments of a g-code preview, and
+#   drawing of them from OpenGL vertex buffers with glDrawArrays.
+#   Used by GLCanon instead of lists of tuples and display lists, which use
+#   a lot of memory and take a very long time to compile for programs with
+#   millions of segments.
+
+# Note:
+#   The vertex buffers require PyOpenGL, if it is not installed GLCanon
+#   falls back to drawing the program with display lists. NumPy is used
+#   to speed up packing the vertices if it is available.
+
+import math
+import array
+import bisect
+
+# PyOpenGL is slow to import, so it is only imported by available(), when
+# a toolpath is first going to be drawn
+GL = None
+_gl_imported = False
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Setup logging
+from utilities import logger
+log = logger.get(__name__)
+
+
+AXES = 'XYZABCUVW'
+
+# The component of the drawn xyz position each linear axis maps to
+LINEAR_AXES = {'X': 0, 'Y': 1, 'Z': 2, 'U': 0, 'V': 1, 'W': 2}
+
+# Segment kinds, in the order they are stored in the vertex buffer
+KINDS = ('traverse', 'feed', 'arcfeed')
+
+IDENTITY = ((0, 0, 1), (1, 1, 1), (2, 2, 1))
+
+# Number of segments passed to linuxcnc.draw_lines at a time
+CHUNK_SIZE = 10000
+
+
+def parse_geometry(geometry):
+    '''Parse a [DISPLAY] GEOMETRY string into (component, axis, sign) terms,
+    the same way linuxcnc.draw_lines maps the nine axis positions onto xyz.
+
+    Returns None if the geometry has rotary axes, since those can't be
+    drawn as a linear projection of the positions.
+    '''
+    terms = []
+    sign = 1
+    for letter in geometry.upper():
+        if letter == '-':
+            sign = -1
+        elif letter in LINEAR_AXES:
+            terms.append((LINEAR_AXES[letter], AXES.index(letter), sign))
+            sign = 1
+        elif letter in 'ABC':
+            return None
+    return tuple(terms)
+
+
+def _import_gl():
+    global GL, _gl_imported
+    if not _gl_imported:
+        _gl_imported = True
+        try:
+            from OpenGL import GL
+        except ImportError:
+            GL = None
+    return GL
+
+
+def available(geometry):
+    '''Returns True if a toolpath with `geometry` can be drawn from vertex buffers.'''
+    return _import_gl() is not None and parse_geometry(geometry) is not None
+
+
+def projection(geometry):
+    '''Returns a function mapping a nine axis position to a drawn xyz position.'''
+    terms = parse_geometry(geometry)
+    if terms == IDENTITY:
+        return lambda pos: pos[:3]
+
+    def project(pos):
+        xyz = [0.0, 0.0, 0.0]
+        for component, axis, sign in terms:
+            xyz[component] += sign * pos[axis]
+        return xyz
+
+    return project
+
+
+class Toolpath(object):
+    '''The segments of a preview packed for drawing with glDrawArrays.
+
+    Segments of each kind are stored contiguously as pairs of xyz float32
+    vertices, so each kind is drawn in its own colour with a single call.
+    `lines` holds the g-code line number of each segment in the same order,
+    and `ranges` maps each kind to its (first vertex, vertex count).
+    '''
+
+    def __init__(self, geometry):
+        self.identity = parse_geometry(geometry) == IDENTITY
+        self.project = projection(geometry)
+        self.vertices = array.array('f')
+        self.lines = array.array('I')
+        self.ranges = {}
+        self.buffer = None
+
+    @classmethod
+    def from_canon(cls, canon):
+        toolpath = cls(canon.geometry)
+        for kind in KINDS:
+            toolpath.pack(kind, getattr(canon, kind))
+        toolpath.upload()
+        return toolpath
+
+    def pack(self, kind, segments):
+        first = len(self.lines) * 2
+        if self.identity and isinstance(segments, SegmentStore):
+            segments.pack_xyz(self.vertices, self.lines)
+        else:
+            project = self.project
+            extend = self.vertices.extend
+            append_line = self.lines.append
+            for segment in segments:
+                append_line(max(segment[0], 0))
+                extend(project(segment[1]))
+                extend(project(segment[2]))
+        self.ranges[kind] = (first, len(self.lines) * 2 - first)
+
+    def upload(self):
+        '''Copy the vertices to a GL vertex buffer, must be called with the
+        GL context current. The client side copy is released afterwards.'''
+        data = self.vertices.tostring()
+        self.buffer = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffer)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, len(data), data, GL.GL_STATIC_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        self.vertices = None
+        log.debug('Uploaded {} toolpath segments to vertex buffer'.format(len(self.lines)))
+
+    def draw(self, kind):
+        first, count = self.ranges.get(kind, (0, 0))
+        self.draw_range(first, count)
+
+    def draw_segments(self, kind, first, last):
+        '''Draw segments first to last (exclusive) of one kind.'''
+        start = self.ranges.get(kind, (0, 0))[0]
+        self.draw_range(start + first * 2, (last - first) * 2)
+
+    def draw_range(self, first, count):
+        if not count or self.buffer is None:
+            return
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffer)
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glVertexPointer(3, GL.GL_FLOAT, 0, None)
+        GL.glDrawArrays(GL.GL_LINES, first, count)
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+    def delete(self):
+        '''Free the GL vertex buffer, must be called with the GL context current.'''
+        if self.buffer is not None:
+            GL.glDeleteBuffers(1, [self.buffer])
+            self.buffer = None
+
+
+class OffsetTable(object):
+    '''Deduplicated table of the (x, y, z) tool length offsets used in a
+    program, so segments only need to store an index into it.'''
+
+    def __init__(self):
+        self.offsets = []
+        self.indexes = {}
+
+    def get_index(self, offset):
+        offset = tuple(offset)
+        index = self.indexes.get(offset)
+        if index is None:
+            index = self.indexes[offset] = len(self.offsets)
+            self.offsets.append(offset)
+        return index
+
+    def __getitem__(self, index):
+        return self.offsets[index]
+
+    def restore(self, offsets):
+        del self.offsets[:]
+        self.indexes.clear()
+        for offset in offsets:
+            self.get_index(offset)
+
+
+class SegmentStore(object):
+    '''Columnar store for toolpath segments of one kind.
+
+    Only the xyz start and end positions are stored for each segment, along
+    with the line number and, for feeds, the feedrate. The other six axes
+    are only stored once a segment that uses them is added. Tool offsets
+    are stored as runs of indexes into a shared OffsetTable, since they
+    only change on tool changes.
+
+    Segments arrive in program order, so consecutive segments from the same
+    line are recorded as runs, and indexed by line number for highlighting.
+
+    Iterating or indexing the store gives the same tuples GLCanon used to
+    keep in lists, for code that has not been converted to use the columns.
+    '''
+
+    COLUMNS = ('lines', 'start', 'end', 'feedrate', 'run_starts', 'run_offsets',
+               'line_starts', 'line_numbers')
+
+    def __init__(self, offsets, feedrate=False):
+        self.offsets = offsets
+        self.has_feedrate = feedrate
+
+        self.lines = array.array('i')
+        self.start = array.array('d')
+        self.end = array.array('d')
+        self.feedrate = array.array('d')
+
+        # ABCUVW start and end positions, 12 per segment, None until used
+        self.extra = None
+
+        # First segment and offset table index of each run of segments
+        # with the same tool offset
+        self.run_starts = array.array('i')
+        self.run_offsets = array.array('i')
+
+        # First segment and line number of each run of segments from the
+        # same line, and the line number -> [(first, last)] index of them
+        self.line_starts = array.array('i')
+        self.line_numbers = array.array('i')
+        self.line_index = None
+
+        # Number of segments that can be drawn while the store is still
+        # being filled by a background parse, None once it is complete
+        self.published = None
+
+    def __len__(self):
+        return len(self.lines)
+
+    def dump(self):
+        '''Returns the columns as a dict of (typecode, bytes), for caching.'''
+        state = {}
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            state[name] = column.typecode, column.tostring()
+        if self.extra is not None:
+            state['extra'] = self.extra.typecode, self.extra.tostring()
+        return state
+
+    def restore(self, state):
+        '''Replace the segments with ones from dump(). The offset table
+        must be restored separately.'''
+        for name in self.COLUMNS:
+            typecode, data = state[name]
+            column = array.array(typecode)
+            column.fromstring(data)
+            setattr(self, name, column)
+        self.extra = None
+        if 'extra' in state:
+            typecode, data = state['extra']
+            self.extra = array.array(typecode)
+            self.extra.fromstring(data)
+        self.line_index = None
+        self.published = None
+
+    def append(self, lineno, start, end, feedrate, offset_index):
+        count = len(self.lines)
+        self.lines.append(lineno)
+        self.start.extend(start[:3])
+        self.end.extend(end[:3])
+        if self.has_feedrate:
+            self.feedrate.append(feedrate)
+
+        if not self.line_numbers or self.line_numbers[-1] != lineno:
+            self.line_starts.append(count)
+            self.line_numbers.append(lineno)
+            self.line_index = None
+
+        if not self.run_offsets or self.run_offsets[-1] != offset_index:
+            self.run_starts.append(count)
+            self.run_offsets.append(offset_index)
+
+        if self.extra is not None:
+            self.extra.extend(start[3:9])
+            self.extra.extend(end[3:9])
+        elif any(start[3:9]) or any(end[3:9]):
+            self.extra = array.array('d', [0.0]) * (12 * count)
+            self.extra.extend(start[3:9])
+            self.extra.extend(end[3:9])
+
+    def position(self, index):
+        '''Returns the nine axis start and end positions of a segment.'''
+        i = index * 3
+        start = tuple(self.start[i:i + 3])
+        end = tuple(self.end[i:i + 3])
+        if self.extra is None:
+            return start + (0.0,) * 6, end + (0.0,) * 6
+        i = index * 12
+        return start + tuple(self.extra[i:i + 6]), end + tuple(self.extra[i + 6:i + 12])
+
+    def build_line_index(self):
+        index = {}
+        count = len(self.lines)
+        starts = self.line_starts
+        for run, lineno in enumerate(self.line_numbers):
+            if run + 1 < len(starts):
+                last = starts[run + 1]
+            else:
+                last = count
+            index.setdefault(lineno, []).append((starts[run], last))
+        self.line_index = index
+
+    def line_ranges(self, lineno):
+        '''Returns a list of (first, last) segment ranges from `lineno`.'''
+        if self.line_index is None:
+            self.build_line_index()
+        return self.line_index.get(lineno, ())
+
+    def add_points(self, first, last, sums):
+        '''Add the xyz start and end points of segments first to last to
+        the [x, y, z] sums, returns the number of points added.'''
+        for axis in range(3):
+            sums[axis] += sum(self.start[first * 3 + axis:last * 3:3])
+            sums[axis] += sum(self.end[first * 3 + axis:last * 3:3])
+        return (last - first) * 2
+
+    def tool_offset(self, index):
+        run = bisect.bisect_right(self.run_starts, index) - 1
+        return self.offsets[self.run_offsets[run]]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.lines)
+        start, end = self.position(index)
+        if self.has_feedrate:
+            return (self.lines[index], start, end, self.feedrate[index], self.tool_offset(index))
+        return (self.lines[index], start, end, self.tool_offset(index))
+
+    def __iter__(self):
+        for index in xrange(len(self.lines)):
+            yield self[index]
+
+    def publish(self, complete=False):
+        '''Make the segments added so far visible to chunks(). The parse
+        thread appends to the columns one at a time, so the GTK thread only
+        reads segments that were complete when they were published.'''
+        if complete:
+            self.published = None
+        else:
+            self.published = len(self.lines)
+
+    def chunks(self, size=CHUNK_SIZE):
+        '''Yields the segments as lists of tuples, for linuxcnc.draw_lines.'''
+        count = len(self.lines) if self.published is None else self.published
+        for first in xrange(0, count, size):
+            yield [self[index] for index in xrange(first, min(first + size, count))]
+
+    def runs(self):
+        '''Yields (first, last, tool offset) for each run of segments.'''
+        count = len(self.lines)
+        for i, first in enumerate(self.run_starts):
+            if i + 1 < len(self.run_starts):
+                last = self.run_starts[i + 1]
+            else:
+                last = count
+            yield first, last, self.offsets[self.run_offsets[i]]
+
+    def extents(self, min_extents, max_extents, min_notool, max_notool):
+        '''Expand the given [x, y, z] extents to include all the segments,
+        the notool extents exclude the tool offset.'''
+        for first, last, offset in self.runs():
+            for axis in range(3):
+                lo = min(min(self.start[first * 3 + axis:last * 3:3]),
+                         min(self.end[first * 3 + axis:last * 3:3]))
+                hi = max(max(self.start[first * 3 + axis:last * 3:3]),
+                         max(self.end[first * 3 + axis:last * 3:3]))
+                min_extents[axis] = min(min_extents[axis], lo)
+                max_extents[axis] = max(max_extents[axis], hi)
+                min_notool[axis] = min(min_notool[axis], lo - offset[axis])
+                max_notool[axis] = max(max_notool[axis], hi - offset[axis])
+
+    def get_time(self, rate=None):
+        '''Returns the time in seconds to move along the segments, at their
+        own feedrates or at `rate` if given. Acceleration is ignored.'''
+        count = len(self.lines)
+        if not count or not (rate or self.has_feedrate):
+            return 0.0
+        if numpy is not None:
+            delta = (numpy.frombuffer(self.end, numpy.float64) -
+                     numpy.frombuffer(self.start, numpy.float64)).reshape(-1, 3)
+            lengths = numpy.sqrt((delta * delta).sum(axis=1))
+            if rate:
+                return float(lengths.sum()) / rate
+            feedrates = numpy.frombuffer(self.feedrate, numpy.float64)
+            moving = feedrates > 0
+            return float((lengths[moving] / feedrates[moving]).sum())
+        start = self.start
+        end = self.end
+        total = 0.0
+        for index in xrange(count):
+            i = index * 3
+            length = math.sqrt((end[i] - start[i]) ** 2 +
+                               (end[i + 1] - start[i + 1]) ** 2 +
+                               (end[i + 2] - start[i + 2]) ** 2)
+            feedrate = rate or self.feedrate[index]
+            if feedrate > 0:
+                total += length / feedrate
+        return total
+
+    def pack_xyz(self, vertices, lines):
+        '''Append the xyz start and end of each segment as float32 vertices,
+        and the line number of each segment as uint32, to the given arrays.'''
+        count = len(self.lines)
+        if numpy is not None:
+            pairs = numpy.empty((count, 2, 3), numpy.float32)
+            pairs[:, 0] = numpy.frombuffer(self.start, numpy.float64).reshape(-1, 3)
+            pairs[:, 1] = numpy.frombuffer(self.end, numpy.float64).reshape(-1, 3)
+            vertices.fromstring(pairs.tostring())
+            numbers = numpy.maximum(numpy.frombuffer(self.lines, numpy.int32), 0)
+            lines.fromstring(numbers.astype(numpy.uint32).tostring())
+            return
+        start = self.start.tolist()
+        end = self.end.tolist()
+        extend = vertices.fromlist
+        for i in xrange(0, count * 3, 3):
+            extend(start[i:i + 3])
+            extend(end[i:i + 3])
+        lines.extend(max(line, 0) for line in self.lines)
+
+
+def calc_extents(*stores):
+    '''Same as gcode.calc_extents, but for SegmentStores.'''
+    min_extents = [9e99, 9e99, 9e99]
+    max_extents = [-9e99, -9e99, -9e99]
+    min_notool = [9e99, 9e99, 9e99]
+    max_notool = [-9e99, -9e99, -9e99]
+    for store in stores:
+        store.extents(min_extents, max_extents, min_notool, max_notool)
+    return min_extents, max_extents, min_notool, max_notool
+
+
+def estimate_runtime(canon, max_velocity):
+    '''Estimated time in seconds to run the program parsed by `canon`, with
+    traverses at `max_velocity` in canon units per second.'''
+    return (canon.traverse.get_time(max_velocity) +
+            canon.feed.get_time() + canon.arcfeed.get_time())
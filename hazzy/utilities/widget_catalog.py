@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+#   Copyright (c) 2017 Kurt Jacobson
+#      <kurtcjacobson@gmail.com>
+#
+#   This file is part of Hazzy.
+#
+#   Hazzy is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   Hazzy is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Hazzy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Description:
+#   Catalog of the widget packages found in the hazzy modules dir and in
+#   the machine config dir, used by the WidgetChooser. The catalog is
+#   saved as JSON in the config dir along with the mtime of every dir it
+#   was built from, so only the dirs that have changed are read again.
+
+# Note:
+#   A dir is only listed again if its mtime has changed, and a widget.info
+#   file is only read again if it or its dir has changed. So when nothing
+#   has changed building the catalog is just a stat of each dir.
+
+import os
+import sys
+import ast
+import json
+import tempfile
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf
+
+from utilities import ini_info
+from utilities.constants import Paths
+
+# Setup logging
+from utilities import logger
+log = logger.get(__name__)
+
+
+# Bump when the format of the catalog changes
+VERSION = 1
+
+WIDGET_DIRS = [Paths.MODULEDIR, Paths.CONFIGDIR]
+
+# Widget packages are imported relative to the dir they were found in
+for widget_dir in WIDGET_DIRS:
+    if widget_dir not in sys.path:
+        sys.path.append(widget_dir)
+
+
+def read_info(root):
+    '''Returns the info in the widget.info file in `root`.'''
+    info = {}
+    with open(os.path.join(root, 'widget.info'), 'r') as fh:
+        for line in fh:
+            line = line.strip()
+
+            # Skip blank or comment lines
+            if not line or line[0] in ['#', ';']:
+                continue
+
+            key, value = line.split(':')
+            info[key.strip()] = ast.literal_eval(value.strip())
+
+    if info.get('image'):
+        info['image'] = os.path.join(root, info['image'])
+    else:
+        info['image'] = os.path.join(root, 'widget.png')
+
+    # The size of the image, so space can be left for it before it is loaded
+    image_info = GdkPixbuf.Pixbuf.get_file_info(info['image'])
+    if image_info and image_info[0] is not None:
+        info['image_size'] = [image_info[1], image_info[2]]
+    else:
+        info['image_size'] = None
+
+    return info
+
+
+class WidgetCatalog(object):
+    def __init__(self, widget_dirs, fn):
+        self.widget_dirs = widget_dirs
+        self.fn = fn
+        self.categories = None
+
+        # path -> {mtime, subdirs, info_mtime, info} of each dir
+        self.dirs = {}
+        self.dirty = False
+
+    def get_categories(self):
+        '''Returns {category: {package: info}} of all the widget packages.
+        The first call brings the catalog up to date.'''
+        if self.categories is None:
+            self._load()
+            self._refresh()
+            self._save()
+            self.categories = self._get_categories()
+        return self.categories
+
+    def _refresh(self):
+        dirs = {}
+        for widget_dir in self.widget_dirs:
+            self._update(widget_dir, dirs)
+        if set(dirs) != set(self.dirs):
+            self.dirty = True
+        self.dirs = dirs
+
+    def _update(self, path, dirs):
+        '''Bring the entry of `path` and the dirs under it up to date,
+        adding them to `dirs`.'''
+        if path in dirs:
+            return
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+
+        entry = self.dirs.get(path)
+        if entry is None or entry['mtime'] != mtime:
+            try:
+                names = os.listdir(path)
+            except OSError as e:
+                log.warning('Could not list "{}": {}'.format(path, e))
+                return
+            subdirs = []
+            for name in names:
+                fname = os.path.join(path, name)
+                if not name.startswith('.') and os.path.isdir(fname) \
+                        and not os.path.islink(fname):
+                    subdirs.append(name)
+            entry = {
+                'mtime': mtime,
+                'subdirs': sorted(subdirs),
+                'info_mtime': None if 'widget.info' in names else False,
+                'info': None,
+            }
+            self.dirty = True
+
+        if entry['info_mtime'] is not False:
+            self._update_info(path, entry)
+
+        dirs[path] = entry
+        for name in entry['subdirs']:
+            self._update(os.path.join(path, name), dirs)
+
+    def _update_info(self, path, entry):
+        try:
+            mtime = os.stat(os.path.join(path, 'widget.info')).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == entry['info_mtime']:
+            return
+        entry['info_mtime'] = mtime
+        entry['info'] = None
+        self.dirty = True
+        if mtime is None:
+            return
+        try:
+            entry['info'] = read_info(path)
+        except Exception as e:
+            log.error('Could not read "{}": {}'.format(os.path.join(path, 'widget.info'), e))
+
+    def _get_categories(self):
+        categories = {}
+        for widget_dir in self.widget_dirs:
+            prefix = os.path.join(widget_dir, '')
+            for root, entry in self.dirs.items():
+                info = entry['info']
+                if info is None or not root.startswith(prefix):
+                    continue
+
+                # Ignore directories starting with '_'
+                if os.path.basename(root).startswith('_'):
+                    continue
+
+                path = os.path.relpath(root, widget_dir).split('/')
+
+                # Determine package for import, and category name for display
+                if len(path) == 1:
+                    category = info.get('category') or 'Uncategorized'
+                    package = path[0]
+                elif len(path) == 2:
+                    category = info.get('category') or path[0]
+                    package = path[1]
+                else:
+                    continue
+
+                info = dict(info)
+                info['import_str'] = '.'.join(path)
+
+                log.debug("LOADING: {} in {} category".format(package, category))
+
+                categories.setdefault(category, {})[package] = info
+        return categories
+
+    def _load(self):
+        try:
+            with open(self.fn) as fh:
+                data = json.load(fh)
+        except (IOError, OSError):
+            return
+        except ValueError as e:
+            log.warning("Ignoring unreadable widget catalog: {}".format(e))
+            return
+        if data.get('version') == VERSION:
+            self.dirs = data.get('dirs', {})
+
+    def _save(self):
+        if not self.dirty:
+            return
+        data = {'version': VERSION, 'dirs': self.dirs}
+
+        # Write to a temp file and rename, so the catalog is never left
+        # partially written
+        temp = None
+        try:
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(self.fn))
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(data, fh)
+            os.rename(temp, self.fn)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            log.warning("Could not save widget catalog: {}".format(e))
+            if temp is not None and os.path.exists(temp):
+                os.remove(temp)
+
+
+catalog = WidgetCatalog(WIDGET_DIRS, ini_info.get_widget_catalog_file())
+
+def get_categories():
+    return catalog.get_categories()
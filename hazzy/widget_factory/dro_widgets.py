@@ -45,6 +45,77 @@ from widget_factory.TouchPads import keyboard
 
 log = logger.get(__name__)
 
+class DroRenderer(object):
+    '''Updates the text of all the DroEntries at most `rate` times a second.
+
+    Positions from the status are only stored when they arrive, the entries
+    are then updated together from a single frame clock tick callback on
+    each window, so however often the positions change each DRO is only
+    redrawn once per frame. Entries that are not mapped are skipped.
+    '''
+
+    def __init__(self, rate):
+        # Frame clock times are in microseconds
+        self.interval = 1000000 / rate
+        self.entries = []
+        self.positions = None
+        self.connected = False
+
+        # Pending tick callback id and last render time of each window
+        self.ticks = {}
+        self.last_render = {}
+
+    def add(self, entry):
+        if not self.connected:
+            status.on_changed('stat.axis-positions', self.on_positions_changed)
+            self.connected = True
+        self.entries.append(entry)
+        entry.connect('map', self.queue_render)
+        entry.connect('destroy', self.remove)
+
+    def remove(self, entry):
+        if entry in self.entries:
+            self.entries.remove(entry)
+
+    def on_positions_changed(self, widget, positions):
+        self.positions = positions
+        self.queue_render()
+
+    def queue_render(self, *args):
+        if self.positions is None:
+            return
+        for entry in self.entries:
+            if not entry.get_mapped():
+                continue
+            toplevel = entry.get_toplevel()
+            if toplevel in self.ticks:
+                continue
+            if toplevel not in self.last_render:
+                self.last_render[toplevel] = 0
+                toplevel.connect('destroy', self.on_toplevel_destroyed)
+            self.ticks[toplevel] = toplevel.add_tick_callback(self.on_tick)
+
+    def on_tick(self, toplevel, frame_clock):
+        frame_time = frame_clock.get_frame_time()
+        if frame_time - self.last_render[toplevel] < self.interval:
+            # Too soon, wait for a later frame
+            return True
+        self.last_render[toplevel] = frame_time
+        del self.ticks[toplevel]
+
+        positions = self.positions
+        for entry in self.entries:
+            if entry.get_mapped() and entry.get_toplevel() is toplevel:
+                entry.render(positions)
+        return False
+
+    def on_toplevel_destroyed(self, toplevel):
+        self.ticks.pop(toplevel, None)
+        self.last_render.pop(toplevel, None)
+
+renderer = DroRenderer(ini_info.get_dro_refresh_rate())
+
+
 class DroType:
     ABS = 0
     REL = 1
@@ -108,6 +179,11 @@ class DroEntry(Gtk.EventBox):
         self.has_focus = False
         self.selected = False
 
+        # The last position and text shown, so unchanged DROs are skipped
+        self.fmt = '{{:.{}f}}'.format(self.dec_plcs)
+        self.pos = None
+        self.text = None
+
         self.connect('button-press-event', self.on_eventbox_clicked)
         self.entry.connect('button-press-event', self.on_button_press)
         self.entry.connect('button-release-event', self.on_button_release)
@@ -116,15 +192,29 @@ class DroEntry(Gtk.EventBox):
         self.entry.connect('key-press-event', self.on_key_press)
         self.entry.connect('activate', self.on_activate)
 
-        status.on_changed('stat.axis-positions', self._update_dro)
+        renderer.add(self)
         status.on_changed('stat.program_units', self._update_units)
 
-    def _update_dro(self, widget, positions):
-        if not self.has_focus: # Don't step on user trying to enter value
-            pos = positions[self.dro_type][self.axis_num] * self.factor
+    def render(self, positions):
+        '''Called by the DroRenderer with the latest positions.'''
+        if self.has_focus: # Don't step on user trying to enter value
+            return
+
+        pos = positions[self.dro_type][self.axis_num]
+        if pos == self.pos:
+            return
+        self.pos = pos
+
+        text = self.fmt.format(pos * self.factor)
+        if text != self.text:
+            self.text = text
+            self.entry.set_text(text)
 
-            pos_str = '{:.{dec_plcs}f}'.format(pos, dec_plcs=self.dec_plcs)
-            self.entry.set_text(pos_str)
+    def invalidate(self):
+        '''Redraw on the next frame even if the position has not changed.'''
+        self.pos = None
+        self.text = None
+        renderer.queue_render()
 
     def _update_units(self, status, units):
         if units == self.machine_units:
@@ -135,6 +225,8 @@ class DroEntry(Gtk.EventBox):
             self.dec_plcs = self.in_decimal_places
         else:
             self.dec_plcs = self.mm_decimal_places
+        self.fmt = '{{:.{}f}}'.format(self.dec_plcs)
+        self.invalidate()
 
     def on_button_press(self, widegt, event, data=None):
         if event.type == Gdk.EventType.DOUBLE_BUTTON_PRESS \
@@ -173,6 +265,8 @@ class DroEntry(Gtk.EventBox):
         self.entry.select_region(0, 0)
         self.get_toplevel().set_focus(None)
         self.has_focus = False
+        # The text may have been edited
+        self.invalidate()
 
     def set_editable(self, editable):
         self.entry.set_sensitive(editable) # For rendering insensitive colors
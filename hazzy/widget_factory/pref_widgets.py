@@ -21,7 +21,8 @@
 # Description:
 #   These are convenience widgets for use when developing new widgets.
 #   They are used for displaying and setting the various types of
-#   preferences that a widget might have.
+#   preferences that a widget might have. They stay in sync with the
+#   preference, and emit 'value-changed' however it is changed.
 
 # ToDo:
 #   Add slider pref widgets, rethink how widget groups should be done.
@@ -55,9 +56,18 @@ class PrefEntry(Gtk.Entry):
         self.connect('focus-out-event', self.on_focus_out)
         self.connect('key-press-event', self.on_key_press)
         self.connect('activate', self.on_activate)
+        self.connect('destroy', self.on_destroy)
 
-        self.value = prefs.get(self.section, self.option, self.default_value, str)
+        prefs.on_changed(self.section, self.option, self.on_pref_changed,
+                         self.default_value, str)
+
+    def on_pref_changed(self, value):
+        self.value = value
         self.set_text(str(self.value))
+        self.emit('value-changed', self.value)
+
+    def on_destroy(self, widget):
+        prefs.remove_callback(self.section, self.option, self.on_pref_changed)
 
     def on_activate(self, widget):
         self.set_preference()
@@ -74,9 +84,7 @@ class PrefEntry(Gtk.Entry):
         value = self.get_text()
         if value == self.value:
             return
-        self.value = value
-        prefs.set(self.section, self.option, self.value, str)
-        self.emit('value-changed', self.value)
+        prefs.set(self.section, self.option, value, str)
         self.select_region(0, 0)
         self.get_toplevel().set_focus(None)
 
@@ -105,25 +113,31 @@ class PrefComboBox(Gtk.ComboBox):
         self.pack_start(renderer_text, True)
         self.add_attribute(renderer_text, "text", 0)
 
-        self.item = prefs.get(self.section, self.option, self.default_item, str)
-        self.set_selected(self.item)
+        self.item = None
+        prefs.on_changed(self.section, self.option, self.on_pref_changed,
+                         self.default_item, str)
 
         self.connect("changed", self.on_selection_changed)
+        self.connect('destroy', self.on_destroy)
 
     def set_selected(self, item):
+        prefs.set(self.section, self.option, item)
+
+    def on_pref_changed(self, item):
         for row in range(len(self.model)):
             if self.model[row][0] == item:
-                self.set_active_iter(self.model.get_iter(row))
                 self.item = item
+                self.set_active_iter(self.model.get_iter(row))
                 self.emit('value-changed', self.item)
                 break
 
     def on_selection_changed(self, widget):
         tree_iter = widget.get_active_iter()
-        if tree_iter != None:
-            self.item = self.model[tree_iter][0]
-            prefs.set(self.section, self.option, self.item)
-            self.emit('value-changed', self.item)
+        if tree_iter != None and self.model[tree_iter][0] != self.item:
+            prefs.set(self.section, self.option, self.model[tree_iter][0])
+
+    def on_destroy(self, widget):
+        prefs.remove_callback(self.section, self.option, self.on_pref_changed)
 
 
 class PrefCheckButton(Gtk.CheckButton):
@@ -140,15 +154,25 @@ class PrefCheckButton(Gtk.CheckButton):
         self.default_value = default_value
 
         self.connect('toggled', self.on_toggle)
+        self.connect('destroy', self.on_destroy)
 
-        self.state = prefs.get(self.section, self.option, self.default_value, bool)
-        self.set_active(self.state)
+        self.state = None
+        prefs.on_changed(self.section, self.option, self.on_pref_changed,
+                         self.default_value, bool)
 
-    def on_toggle(self, widget):
-        self.state = self.get_active()
-        prefs.set(self.section, self.option, self.state)
+    def on_pref_changed(self, state):
+        self.state = state
+        if self.get_active() != state:
+            self.set_active(state)
         self.emit('value-changed', self.state)
 
+    def on_toggle(self, widget):
+        if self.get_active() != self.state:
+            prefs.set(self.section, self.option, self.get_active())
+
+    def on_destroy(self, widget):
+        prefs.remove_callback(self.section, self.option, self.on_pref_changed)
+
 
 class PrefSwitch(Gtk.Switch):
     __gtype_name__ = 'PrefSwitch'
@@ -164,15 +188,26 @@ class PrefSwitch(Gtk.Switch):
         self.default_value = default_value
 
         self.connect('state-set', self.on_state_set)
+        self.connect('destroy', self.on_destroy)
 
-        self.state = prefs.get(self.section, self.option, self.default_value, bool)
-        self.set_active(self.state)
+        self.state = None
+        prefs.on_changed(self.section, self.option, self.on_pref_changed,
+                         self.default_value, bool)
 
-    def on_state_set(self, widget, event):
-        self.state = not self.get_state() # Don't know why need to invert
-        prefs.set(self.section, self.option, self.state)
+    def on_pref_changed(self, state):
+        self.state = state
+        if self.get_active() != state:
+            self.set_active(state)
         self.emit('value-changed', self.state)
 
+    def on_state_set(self, widget, event):
+        state = not self.get_state() # Don't know why need to invert
+        if state != self.state:
+            prefs.set(self.section, self.option, state)
+
+    def on_destroy(self, widget):
+        prefs.remove_callback(self.section, self.option, self.on_pref_changed)
+
 
 class PrefFeild(Gtk.Box):
     def __init__(self, feild, group):